@@ -19,66 +19,246 @@
 # The sccuracy is calculated by comparing the face vectors of the test images with the reference vectors of known persons.
 # The dataset used for testing contains 2400 images of 80 persons (30 images per person).
 # The dataset can be downloaded from GitHub: https://github.com/oscardelgado02/Face-Dataset---2400-IMG-and-80-LABELS
+# A single run evaluates a whole range of tolerances, e.g. to write the sweep with FAR/FRR and the EER:
+#   python3 accuracy.py DATA --sweep 0.30:0.80:0.005 --report report.json
 
+import argparse
+import csv
+import hashlib
+import inspect
+import json
+import numpy as np
 import os
-from hf_vectorizer import get_face_vector, compare_vectors
 
-def generate_reference_vectors(image_folder):
-    reference_vectors = {}
+import embedding_pool
+import hf_vectorizer
+
+from gallery import GalleryIndex
+
+# Embeddings are cached on disk, keyed by the SHA-1 of the image bytes. Each pipeline
+# configuration has its own cache file, so changing the embedding code never reuses stale vectors.
+CACHE_DIR = ".embedding_cache"
+HASH_CHUNK_SIZE = 1 << 20
+
+def pipeline_config():
+    import face_recognition
+    return {
+        "face_recognition": getattr(face_recognition, "__version__", "unknown"),
+        "get_face_vector": inspect.getsource(hf_vectorizer.get_face_vector_from_image),
+        "detect_face_vector": inspect.getsource(hf_vectorizer.detect_face_vector),
+    }
+
+def config_hash(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class EmbeddingCache:
+    def __init__(self, cache_dir=CACHE_DIR, config=None):
+        self.path = os.path.join(cache_dir, f"embeddings-{config_hash(config or pipeline_config())}.npz")
+        self.vectors = {}
+        # Images without a detectable face are remembered too, so they are not extracted again
+        self.missing = set()
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with np.load(self.path) as data:
+            self.vectors = dict(zip(data["keys"].tolist(), data["vectors"]))
+            self.missing = set(data["missing"].tolist())
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        keys = sorted(self.vectors)
+        vectors = np.stack([self.vectors[key] for key in keys]) if keys else np.empty((0, 128))
+        # Write to a temporary file first, an interrupted run must not leave a truncated cache
+        temp_path = self.path + ".tmp.npz"
+        np.savez(temp_path, keys=np.array(keys, dtype=str), vectors=vectors, missing=np.array(sorted(self.missing), dtype=str))
+        os.replace(temp_path, self.path)
+        self.dirty = False
+
+    def __contains__(self, key):
+        return key in self.vectors or key in self.missing
+
+    def get(self, key):
+        return self.vectors.get(key)
+
+    def put(self, key, vector):
+        if vector is None:
+            self.missing.add(key)
+        else:
+            self.vectors[key] = np.asarray(vector, dtype=np.float64)
+        self.dirty = True
+
+# Return {path: vector or None} for the images, extracting only those missing from the cache,
+# in parallel on all the cores (workers=0 extracts them in this process)
+def extract_vectors(paths, cache=None, workers=None):
+    paths = list(paths)
+    keys = {path: file_hash(path) for path in paths}
+    pending = [path for path in paths if cache is None or keys[path] not in cache]
+    extracted = {}
+
+    if pending:
+        print(f"Extracting {len(pending)} face vectors ({len(paths) - len(pending)} cached)...")
+        pool = embedding_pool.EmbeddingPool(workers=(os.cpu_count() or 1) if workers is None else workers)
+        try:
+            for path, vector in zip(pending, pool.embed_many(pending)):
+                # Errors (timeouts, a busy or broken pool) are not cached, the next run tries the image again.
+                # Only a None returned by the pipeline means the image has no face.
+                if isinstance(vector, Exception):
+                    print(f"Error extracting {path}: {vector}")
+                    extracted[path] = None
+                    continue
+                extracted[path] = vector
+                if cache is not None:
+                    cache.put(keys[path], vector)
+        finally:
+            pool.shutdown()
+            # Whatever was extracted before an interruption is kept for the next run
+            if cache is not None:
+                cache.save()
+
+    return {path: extracted[path] if path in extracted else cache.get(keys[path]) for path in paths}
+
+def generate_reference_vectors(image_folder, cache=None, workers=None):
+    reference_paths = {}
     for person in range(1, 81):  # Persons 1 to 80
         image_path = os.path.join(image_folder, f"{person}_1.png")
         if os.path.exists(image_path):
-            vector = get_face_vector(image_path)
-            if vector is not None:
-                reference_vectors[person] = vector
-            else:
-                print(f"Failed to generate vector for person {person}")
+            reference_paths[person] = image_path
         else:
             print(f"Reference image for person {person} not found")
-    return reference_vectors
 
-def test_accuracy(image_folder, reference_vectors):
-    results = {'TP': 0, 'FP': 0, 'TN': 0, 'FN': 0}
-    processed_images = 0
-    failed_images = 0
+    vectors = extract_vectors(reference_paths.values(), cache, workers)
+    reference_vectors = {}
+    for person, image_path in reference_paths.items():
+        if vectors[image_path] is not None:
+            reference_vectors[person] = vectors[image_path]
+        else:
+            print(f"Failed to generate vector for person {person}")
+    return reference_vectors
 
-    for filename in os.listdir(image_folder):
+def list_test_images(image_folder):
+    test_images = []
+    for filename in sorted(os.listdir(image_folder)):
         person_id = int(filename.split('_')[0])
         if f"{person_id}_1" in filename:
             continue
-        
-        test_vector = get_face_vector(os.path.join(image_folder, filename))
+        test_images.append((filename, person_id))
+    return test_images
+
+def load_test_vectors(image_folder, cache=None, workers=None):
+    test_images = list_test_images(image_folder)
+    vectors = extract_vectors((os.path.join(image_folder, filename) for filename, _ in test_images), cache, workers)
+
+    labels, probes = [], []
+    failed_images = 0
+    for filename, person_id in test_images:
+        test_vector = vectors[os.path.join(image_folder, filename)]
         if test_vector is None:
             print(f"Failed to generate vector for {filename}")
             failed_images += 1
             continue
-        
-        processed_images += 1
-        
-        correct_match = False
-        for ref_person, ref_vector in reference_vectors.items():
-            is_match = compare_vectors(ref_vector, test_vector, tolerance=0.5)
-            
-            if person_id == ref_person:
-                if is_match:
-                    results['TP'] += 1
-                    correct_match = True
-                    break
-            elif is_match:
-                results['FP'] += 1
-                correct_match = True
-                break
-        
-        if not correct_match:
-            if person_id in reference_vectors:
-                results['FN'] += 1
-            else:
-                results['TN'] += 1
-
-    print(f"Processed {processed_images} images successfully.")
+        labels.append(person_id)
+        probes.append(test_vector)
+
+    print(f"Processed {len(probes)} images successfully.")
     print(f"Failed to process {failed_images} images.")
-    
-    return results
+    return np.array(labels, dtype=np.int64), np.array(probes).reshape(len(probes), -1)
+
+# Probe by reference distance matrix, computed once with the gallery's GEMM
+def distance_matrix(probes, reference_vectors):
+    persons = list(reference_vectors)
+    index = GalleryIndex(persons, [str(person) for person in persons], [reference_vectors[p] for p in persons])
+    if len(index) == 0 or len(probes) == 0:
+        return np.empty((len(probes), len(index))), index.ids
+    return index.distances(probes), index.ids
+
+# Evaluate every threshold at once from the distance matrix.
+# Identification (TP/FP/TN/FN): a probe is accepted when its nearest reference is within the threshold,
+# and it is a true positive when that reference is its own person.
+# Verification (FAR/FRR): every probe/reference pair is a genuine or an impostor attempt.
+def sweep_thresholds(distances, probe_labels, reference_labels, thresholds):
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    probe_labels = np.asarray(probe_labels)
+    reference_labels = np.asarray(reference_labels)
+    sweep = {"threshold": thresholds}
+
+    if distances.size:
+        nearest = np.argmin(distances, axis=1)
+        nearest_distances = distances[np.arange(len(distances)), nearest]
+        correct = reference_labels[nearest] == probe_labels
+        accepted = nearest_distances[:, np.newaxis] <= thresholds[np.newaxis, :]
+    else:
+        correct = np.zeros(len(probe_labels), dtype=bool)
+        accepted = np.zeros((len(probe_labels), len(thresholds)), dtype=bool)
+    enrolled = np.isin(probe_labels, reference_labels)
+
+    sweep["TP"] = np.count_nonzero(accepted & correct[:, np.newaxis], axis=0)
+    sweep["FP"] = np.count_nonzero(accepted & ~correct[:, np.newaxis], axis=0)
+    sweep["FN"] = np.count_nonzero(~accepted & enrolled[:, np.newaxis], axis=0)
+    sweep["TN"] = np.count_nonzero(~accepted & ~enrolled[:, np.newaxis], axis=0)
+    sweep["accuracy"] = (sweep["TP"] + sweep["TN"]) / max(len(probe_labels), 1)
+
+    # Sorted distances turn "how many pairs are within t" into a binary search per threshold
+    genuine_mask = probe_labels[:, np.newaxis] == reference_labels[np.newaxis, :]
+    genuine = np.sort(distances[genuine_mask])
+    impostor = np.sort(distances[~genuine_mask])
+    sweep["FAR"] = np.searchsorted(impostor, thresholds, side="right") / max(len(impostor), 1)
+    sweep["FRR"] = 1 - np.searchsorted(genuine, thresholds, side="right") / max(len(genuine), 1)
+    sweep["TAR"] = 1 - sweep["FRR"]
+    return sweep
+
+# Equal error rate, interpolated where FAR and FRR cross
+def equal_error_rate(sweep):
+    difference = sweep["FAR"] - sweep["FRR"]
+    crossings = np.flatnonzero(np.diff(np.sign(difference)) != 0)
+    if len(crossings) == 0:
+        i = int(np.argmin(np.abs(difference)))
+        return float(sweep["threshold"][i]), float((sweep["FAR"][i] + sweep["FRR"][i]) / 2)
+
+    i = crossings[0]
+    weight = difference[i] / (difference[i] - difference[i + 1]) if difference[i] != difference[i + 1] else 0.0
+    threshold = sweep["threshold"][i] + weight * (sweep["threshold"][i + 1] - sweep["threshold"][i])
+    rate = sweep["FAR"][i] + weight * (sweep["FAR"][i + 1] - sweep["FAR"][i])
+    return float(threshold), float(rate)
+
+def threshold_results(sweep, i):
+    return {key: int(sweep[key][i]) for key in ("TP", "FP", "TN", "FN")}
+
+def write_report(sweep, path):
+    eer_threshold, eer = equal_error_rate(sweep)
+    best = int(np.argmax(sweep["accuracy"]))
+    columns = ["threshold", "TP", "FP", "TN", "FN", "accuracy", "FAR", "FRR", "TAR"]
+
+    if path.endswith(".csv"):
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            writer.writerows(zip(*(sweep[column].tolist() for column in columns)))
+    else:
+        report = {
+            "eer": {"threshold": eer_threshold, "rate": eer},
+            "best_accuracy": {"threshold": float(sweep["threshold"][best]), "accuracy": float(sweep["accuracy"][best])},
+            "roc": {"FAR": sweep["FAR"].tolist(), "TAR": sweep["TAR"].tolist()},
+            "thresholds": [dict(zip(columns, row)) for row in zip(*(sweep[column].tolist() for column in columns))],
+        }
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+
+def test_accuracy(image_folder, reference_vectors, tolerance=0.5, cache=None, workers=None):
+    labels, probes = load_test_vectors(image_folder, cache, workers)
+    distances, reference_labels = distance_matrix(probes, reference_vectors)
+    return threshold_results(sweep_thresholds(distances, labels, reference_labels, [tolerance]), 0)
 
 def calculate_accuracy(results):
     total = sum(results.values())
@@ -92,15 +272,39 @@ def calculate_accuracy(results):
     print(f"Accuracy: {accuracy:.2%}")
 
 if __name__ == "__main__":
-    image_folder = "/Users/giovannifilippini/Desktop/Face-Dataset---2400-IMG-and-80-LABELS-main/DATA"
-    
+    parser = argparse.ArgumentParser(description="Measure the face matching accuracy on a labelled dataset")
+    parser.add_argument("image_folder", nargs="?", default="/Users/giovannifilippini/Desktop/Face-Dataset---2400-IMG-and-80-LABELS-main/DATA")
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    parser.add_argument("--sweep", default="0.30:0.80:0.005", help="thresholds to evaluate, as start:stop:step")
+    parser.add_argument("--report", help="write the threshold sweep to this .json or .csv file")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="where extracted face vectors are cached")
+    parser.add_argument("--no-cache", action="store_true", help="extract every face vector again")
+    parser.add_argument("--workers", type=int, default=None, help="extraction processes, one per core by default")
+    args = parser.parse_args()
+
+    cache = None if args.no_cache else EmbeddingCache(args.cache_dir)
+
     print("Generating reference vectors...")
-    reference_vectors = generate_reference_vectors(image_folder)
+    reference_vectors = generate_reference_vectors(args.image_folder, cache, args.workers)
     
     print("Testing accuracy...")
-    results = test_accuracy(image_folder, reference_vectors)
-    
-    calculate_accuracy(results)
+    labels, probes = load_test_vectors(args.image_folder, cache, args.workers)
+    distances, reference_labels = distance_matrix(probes, reference_vectors)
+
+    start, stop, step = (float(value) for value in args.sweep.split(":"))
+    thresholds = np.union1d(np.arange(start, stop + step / 2, step), [args.tolerance])
+    sweep = sweep_thresholds(distances, labels, reference_labels, thresholds)
+
+    calculate_accuracy(threshold_results(sweep, int(np.flatnonzero(np.isclose(thresholds, args.tolerance))[0])))
+
+    eer_threshold, eer = equal_error_rate(sweep)
+    best = int(np.argmax(sweep["accuracy"]))
+    print(f"Equal error rate: {eer:.2%} at {eer_threshold:.3f}")
+    print(f"Best accuracy: {sweep['accuracy'][best]:.2%} at {sweep['threshold'][best]:.3f}")
+
+    if args.report:
+        write_report(sweep, args.report)
+        print(f"Report written to {args.report}")
 
 """
 0.45
@@ -17,57 +17,109 @@
 """
 
 import connexion
-import hf_vectorizer
+import contextlib
+import embedding_pool
+import hmac
+import metrics
 import os
-import psutil
-import requests
+import services
+import sessions
+import startup
+import threading
+import tracing
 
+from a2wsgi import WSGIMiddleware
 from cameraUtils import *
-from database import setup_database
-from flask import render_template, Response, request, redirect, url_for, jsonify
-from hf_vectorizer import base64_encoder, base64_decoder, compare_vectors
-from users import read_all, create, read_one, update, delete
-from toolbox import generate_otp
-
-BASE_URL = "http://localhost:5000/api/users"
-
-app = connexion.App(__name__, specification_dir="./")
+from flask import abort, g, has_request_context, render_template, Response, request, redirect, url_for, jsonify
+from hf_vectorizer import compare_vectors
+from users import read_all, create, read_one, update, delete, user_to_json
+from toolbox import generate_unique_otp
+
+# The process is initialized when the server starts, not when this module is imported
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    startup.initialize()
+    yield
+
+app = connexion.App(__name__, specification_dir="./", lifespan=lifespan)
 app.add_api("swagger.yml")
 
 flask_app = app.app
-flask_app.config["DEBUG"] = True
-
-camera = None
-capture_status = {"status": "not_captured"}
-captured_image_path = PathStorage()
-
-g_name = ""
-g_otp = ""
-g_vector = ""
-g_obtained_vector = ""
-
+# Every synchronous request holds one of these threads until its response ends, streams included
+WSGI_THREADS = int(os.environ.get("DEVISU_WSGI_THREADS", 32))
+
+# Connexion wraps Flask in an a2wsgi WSGIMiddleware of 10 threads and has no option for their number,
+# so the wrapper is replaced by one of the wanted size. Returns False, keeping the default, when the
+# Connexion version lays out its application differently.
+def set_wsgi_threads(app, workers):
+    middleware_app = getattr(app, "_middleware_app", None)
+    wrapper = getattr(middleware_app, "asgi_app", None)
+    if not isinstance(wrapper, WSGIMiddleware):
+        print(f"Cannot size the WSGI thread pool of this Connexion version, DEVISU_WSGI_THREADS={workers} is ignored")
+        return False
+    middleware_app.asgi_app = WSGIMiddleware(wrapper.app, workers=workers)
+    return True
+
+set_wsgi_threads(app, WSGI_THREADS)
+flask_app.config["DEBUG"] = os.environ.get("DEVISU_DEBUG", "0") == "1"
+# Signs the session cookie, which only holds the id of the server-side workflow state
+flask_app.secret_key = os.environ.get("DEVISU_SECRET_KEY") or os.urandom(32)
+
+# Video sources of the kiosks served by this process, e.g. DEVISU_CAMERAS="default=0,kiosk2=1"
+cameras = CameraRegistry(parse_camera_sources(os.environ.get("DEVISU_CAMERAS", f"{sessions.DEFAULT_DEVICE}=0")))
+
+# Capture event streams send a keepalive every heartbeat and end after max duration, the browser then reconnects
+CAPTURE_EVENT_HEARTBEAT = 15.0
+CAPTURE_EVENT_MAX_DURATION = 300.0
+CAPTURE_EVENT_MAX_WAIT = 30.0
+# Requests waiting for a capture hold at most this many threads, so the other pages keep being served
+CAPTURE_EVENT_MAX_STREAMS = int(os.environ.get("DEVISU_CAPTURE_MAX_STREAMS", WSGI_THREADS // 4))
+capture_waiters = threading.BoundedSemaphore(max(1, CAPTURE_EVENT_MAX_STREAMS))
+
+# Workflow state of the current session
 def set_global_name(name):
-    global g_name
-    g_name = name
+    sessions.get_state()["name"] = name
     
 def set_global_otp(otp):
-    global g_otp
-    g_otp = otp
+    sessions.get_state()["otp"] = otp
     
 def set_global_vector(vector):
-    global g_vector
-    g_vector = vector
+    sessions.get_state()["vector"] = vector
     
 def set_global_obtained_vector(vector):
-    global g_obtained_vector
-    g_obtained_vector = vector
+    sessions.get_state()["obtained_vector"] = vector
     
+# Outside of a request there is no current session, so every session is reset
 def reset_globals():
-    global g_name, g_otp, g_vector, g_obtained_vector
-    set_global_name("")
-    set_global_otp("")
-    set_global_vector("")
-    set_global_obtained_vector("")
+    if has_request_context():
+        sessions.reset_state()
+    else:
+        sessions.clear_sessions()
+
+# Every request gets a trace, logged when it ends, and may be sampled by the profiler
+@flask_app.before_request
+def start_request_trace():
+    tracing.start_trace(f"{request.method} {request.path}", method=request.method, path=request.path)
+    g.profile = tracing.profiler.maybe_start(f"{request.method} {request.path}")
+
+@flask_app.after_request
+def record_response_status(response):
+    g.status = response.status_code
+    return response
+
+@flask_app.teardown_request
+def finish_request_trace(error=None):
+    profile = g.pop("profile", None)
+    if profile is not None:
+        tracing.profiler.stop(profile)
+    tracing.finish_trace(status=g.pop("status", 500 if error else None))
+
+# A kiosk selects its camera once with ?device=<id>, the choice is kept in its session
+@flask_app.before_request
+def select_device():
+    device = request.args.get("device")
+    if device is not None and device in cameras:
+        sessions.get_state()["device"] = device
 
 # Main page
 @app.route("/")
@@ -93,75 +145,65 @@ def add_name_post():
 # Step 2: Capture the image of the person
 @app.route("/add_person")
 def add_person():
-    check_system_resources()
     camera_status = initialize_camera()
     
     if camera_status.startswith("Error"):
         return camera_status
 
-    while True:
-        frame_status = camera.get_frame()
-        if frame_status == "captured":
-            break
+    # The capture itself happens in the /video_feed stream, the page polls for it
+    start_capture()
 
-    return render_template("add_person.html", step=2, username=g_name)
+    return render_template("add_person.html", step=2, username=sessions.get_state()["name"])
 
 # Step 3: Generate the face vector and OTP and store it in the database.
 @app.route("/add_vectorization")
 def add_vectorization():
-    global g_otp, g_vector
+    state = sessions.get_state()
 
     try:
-        check_system_resources()
-        camera_status = initialize_camera()
-        if camera_status.startswith("Error"):
-            return render_template("result.html", error=camera_status, step=4, operation="add")
-
-        img_path = camera.get_captured_path()
-        if img_path is None or img_path == "":
-            return render_template("result.html", error="Image path is not available. Please capture an image first.", step=4, operation="add")
+        capture = get_capture()
+        if capture is None:
+            return render_template("result.html", error="Captured image is not available. Please capture an image first.", step=4, operation="add")
 
-        vectorizer = hf_vectorizer.get_face_vector(str(img_path))
+        vectorizer = embedding_pool.embed(capture.image, capture.face_location)
         
         if vectorizer is None:
+            metrics.record_failure("embedding")
             return render_template("result.html", error="Failed to generate face vector from the captured image.", step=4, operation="add")
         
         set_global_vector(vectorizer)
-        set_global_otp(generate_otp())
-        print(f"Generated OTP: {g_otp}")
+        set_global_otp(generate_unique_otp(services.otp_exists))
+        print(f"Generated OTP: {state['otp']}")
 
         return render_template("add_vectorization.html", step=3)
+    except embedding_pool.PoolBusyError as e:
+        metrics.record_failure("embedding_queue")
+        print(f"Embedding pool busy during add vectorization: {str(e)}")
+        return render_template("result.html", error="The server is busy, please try again in a few seconds.", step=4, operation="add")
     except Exception as e:
         print(f"Error during add vectorization: {str(e)}")
         return render_template("result.html", error=f"An error occurred during vectorization: {str(e)}", step=4, operation="add")
     finally:
-        release_camera()
-        delete_all_images()
-        reset_captured_image_path()
+        discard_capture()
 
 # Step 4: Show the result and the OTP to the user.
 @app.route("/add_result")
 def add_result():
-    global g_name, g_otp, g_vector
-
-    new_user = {
-        "id": 0, # Placeholder value, will be ignored by the API
-        "name": g_name,
-        "otp": str(g_otp),
-        "vector": base64_encoder(g_vector)
-    }
-
-    response = requests.post(BASE_URL, json=new_user)
-
-    if response.status_code == 201:
-        created_user = response.json()
-        print(f"User created: {created_user}")
-        tmp_user, tmp_otp = g_name, g_otp
-        return render_template("result.html", step=4, operation="add", result="Person added correctly!", username=tmp_user, otp=tmp_otp)
-    else:
-        print(f"Error creating user: {response.text}")
+    state = sessions.get_state()
+    tmp_user, tmp_otp = state["name"], str(state["otp"])
+
+    if tmp_user == "" or tmp_otp == "" or isinstance(state["vector"], str):
         return render_template("result.html", step=4, operation="add", result="Error creating user", username=tmp_user, otp=tmp_otp)
 
+    try:
+        created_user = services.create_user(tmp_user, tmp_otp, state["vector"])
+    except services.OtpInUseError as e:
+        print(f"Error creating user: {e}")
+        return render_template("result.html", step=4, operation="add", result="Error creating user", username=tmp_user, otp=tmp_otp)
+
+    print(f"User created: {created_user['id']}")
+    return render_template("result.html", step=4, operation="add", result="Person added correctly!", username=tmp_user, otp=tmp_otp)
+
 ### Verify a person in the database ###
 
 # Step 1: Ask for the OTP of the person to verify
@@ -174,7 +216,7 @@ def verify_otp():
         user = get_user_by_otp(otp)
 
         if user:
-            set_global_obtained_vector(base64_decoder(user["vector"]))
+            set_global_obtained_vector(user["vector"])
             return render_template("verify_capture.html", user=user, step=1)
         else:
             return render_template("result.html", error=f"The person with OTP {otp} not found. Please try again.", step=3)
@@ -182,54 +224,51 @@ def verify_otp():
 # Step 2: Capture the image of the person to verify
 @app.route("/verify_capture")
 def verify_capture():
-    check_system_resources()
     camera_status = initialize_camera()
     
     if camera_status.startswith("Error"):
         return camera_status
 
-    while True:
-        frame_status = camera.get_frame()
-        if frame_status == "captured":
-            break
+    # The capture itself happens in the /video_feed stream, the page polls for it
+    start_capture()
     return render_template("verify_capture.html", step=2)
 
 # Step 3: Compare the face vector with the one on the database corresponding to the OTP
 @app.route("/verify_check")
 def verify_check():
-    global g_obtained_vector
+    state = sessions.get_state()
     
     try:
-        check_system_resources()
-        camera_status = initialize_camera()
-        if camera_status.startswith("Error"):
-            return render_template("result.html", error=camera_status, step=3, operation="verify")
-            
-        img_path = camera.get_captured_path()
-        if img_path is None or img_path == "":
-            return render_template("result.html", error="Image path is not available. Please capture an image first.", step=3, operation="verify")
+        capture = get_capture()
+        if capture is None:
+            return render_template("result.html", error="Captured image is not available. Please capture an image first.", step=3, operation="verify")
 
-        generated_vector = hf_vectorizer.get_face_vector(str(img_path))
-        delete_all_images()
-        reset_captured_image_path()
+        generated_vector = embedding_pool.embed(capture.image, capture.face_location)
 
-        if g_obtained_vector is None:
+        if state["obtained_vector"] is None or isinstance(state["obtained_vector"], str):
             return render_template("result.html", error="No face detected during verification.", step=3, operation="verify")
 
         if generated_vector is None:
+            metrics.record_failure("embedding")
             return render_template("result.html", error="Failed to generate face vector from the captured image.", step=3, operation="verify")
 
-        if not compare_vectors(g_obtained_vector, generated_vector):
+        matched = compare_vectors(state["obtained_vector"], generated_vector)
+        metrics.record_match("verify", matched)
+        if not matched:
             print("Verification failed.")
             return render_template("result.html", result="Verification failed.", step=3, operation="verify")
         else:
             print("Verification successful.")
             return render_template("result.html", result="Verification successful!", step=3, operation="verify")
+    except embedding_pool.PoolBusyError as e:
+        metrics.record_failure("embedding_queue")
+        print(f"Embedding pool busy during verification: {str(e)}")
+        return render_template("result.html", error="The server is busy, please try again in a few seconds.", step=3, operation="verify")
     except Exception as e:
         print(f"Error during verification: {str(e)}")
         return render_template("result.html", error=f"An error occurred during verification: {str(e)}", step=3, operation="verify")
     finally:
-        release_camera()
+        discard_capture()
 
 
 ### Remove a person from the database ###
@@ -244,7 +283,7 @@ def delete_otp():
         user = get_user_by_otp(otp)
 
         if user:
-            set_global_obtained_vector(base64_decoder(user["vector"]))
+            set_global_obtained_vector(user["vector"])
             set_global_otp(otp)
             return render_template("delete_capture.html", user=user, step=1)
         else:
@@ -253,188 +292,218 @@ def delete_otp():
 # Step 2: Capture the image of the person to delete
 @app.route("/delete_capture")
 def delete_capture():
-    check_system_resources()
     camera_status = initialize_camera()
     
     if camera_status.startswith("Error"):
         return camera_status
 
-    while True:
-        frame_status = camera.get_frame()
-        if frame_status == "captured":
-            break
+    # The capture itself happens in the /video_feed stream, the page polls for it
+    start_capture()
     return render_template("delete_capture.html", step=2)
 
 # Step 3: Compare the face vector and delete the user if vectors match
 @app.route("/delete_check")
 def delete_check():
-    global g_obtained_vector, g_otp
+    state = sessions.get_state()
 
     try:
-        check_system_resources()
-        camera_status = initialize_camera()
-        if camera_status.startswith("Error"):
-            return render_template("result.html", error=camera_status, step=3, operation="delete")
-
-        img_path = camera.get_captured_path()
-        if img_path is None or img_path == "":
-            return render_template("result.html", error="DELETE: Image path is not available. Please capture an image first.", step=3, operation="delete")
+        capture = get_capture()
+        if capture is None:
+            return render_template("result.html", error="DELETE: Captured image is not available. Please capture an image first.", step=3, operation="delete")
 
-        generated_vector = hf_vectorizer.get_face_vector(str(img_path))
+        generated_vector = embedding_pool.embed(capture.image, capture.face_location)
 
-        if g_obtained_vector is None:
+        if state["obtained_vector"] is None or isinstance(state["obtained_vector"], str):
             return render_template("result.html", error="No face detected during deletion.", step=3, operation="delete")
 
         if generated_vector is None:
+            metrics.record_failure("embedding")
             return render_template("result.html", error="Failed to generate face vector from the captured image.", step=3, operation="delete")
 
-        if not compare_vectors(g_obtained_vector, generated_vector):
+        matched = compare_vectors(state["obtained_vector"], generated_vector)
+        metrics.record_match("delete", matched)
+        if not matched:
             print("Deletion failed.")
             return render_template("result.html", result="Deletion failed.", step=3, operation="delete")
         else:
-            delete_user_by_otp(g_otp)
+            delete_user_by_otp(state["otp"])
             print("Deletion successful!")
             return render_template("result.html", result="Deletion successful!", step=3, operation="delete")
+    except embedding_pool.PoolBusyError as e:
+        metrics.record_failure("embedding_queue")
+        print(f"Embedding pool busy during delete check: {str(e)}")
+        return render_template("result.html", error="The server is busy, please try again in a few seconds.", step=3, operation="delete")
     except Exception as e:
         print(f"Error during delete check: {str(e)}")
         return render_template("result.html", error=f"An error occurred during deletion: {str(e)}", step=3, operation="delete")
     finally:
-        release_camera()
-        delete_all_images()
-        reset_captured_image_path()
+        discard_capture()
 
 
 # utils routes
 @app.route("/video_feed")
 def video_feed():
-    check_system_resources()
     camera_status = initialize_camera()
     
     if camera_status.startswith("Error"):
         return camera_status
     
-    response = Response(generate(camera), mimetype="multipart/x-mixed-replace; boundary=frame")
+    # The generator outlives the request context, so it gets the camera, state and capture key up front
+    state = sessions.get_state()
+    response = Response(generate(get_camera(), state, sessions.get_session_id()), mimetype="multipart/x-mixed-replace; boundary=frame")
     response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     response.headers["Pragma"] = "no-cache"
     response.headers["Expires"] = "0"
     return response
 
+# Polled by the capture pages when Server-Sent Events are not available. With ?wait=<seconds>
+# the request is held until the capture happens or the time is up (long polling).
 @app.route("/check_capture_status")
 def check_capture_status():
-    return capture_status["status"]
+    state = sessions.get_state()
+    wait = min(request.args.get("wait", 0, type=float), CAPTURE_EVENT_MAX_WAIT)
+    # When too many requests are already waiting, the current status is answered right away
+    if wait > 0 and capture_waiters.acquire(blocking=False):
+        try:
+            sessions.wait_for_capture(state, wait)
+        finally:
+            capture_waiters.release()
+    return state["capture_status"]
+
+# Server-Sent Events stream that pushes "captured" as soon as the face of this session is captured
+@app.route("/capture_events")
+def capture_events():
+    state = sessions.get_state()
+    # A stream that does not open makes the page poll the capture status instead
+    if not capture_waiters.acquire(blocking=False):
+        response = Response("Too many capture event streams", status=503)
+        response.headers["Retry-After"] = "1"
+        return response
+    response = Response(generate_capture_events(state), mimetype="text/event-stream")
+    response.call_on_close(capture_waiters.release)
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
 
+# The device stays open between steps and is released by its grabber thread once idle
 @app.route("/release_camera")
 def release_camera_route():
-    release_camera()
-    return "Camera released"
+    return "Camera will be released when idle"
+
+@app.route("/ready")
+def ready():
+    return jsonify(startup.status()), 200 if startup.is_ready() else 503
+
+@app.route("/metrics")
+def metrics_route():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+# Admin switch for the request profiler, e.g. {"enabled": true, "sample_rate": 0.05, "memory": true}.
+# Only available when DEVISU_ADMIN_TOKEN is set, the token is sent in the X-Admin-Token header.
+@app.route("/admin/profiling", methods=["GET", "POST"])
+def admin_profiling():
+    admin_token = os.environ.get("DEVISU_ADMIN_TOKEN")
+    if not admin_token or not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), admin_token):
+        abort(403)
+
+    if request.method == "POST":
+        body = request.get_json(silent=True) or {}
+        try:
+            tracing.profiler.configure(body.get("enabled", False), body.get("sample_rate"), body.get("memory"))
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": str(e)}), 400
+
+    return jsonify(tracing.profiler.status())
 
 @app.route("/users/by_otp/<string:otp>", methods=["GET"])
-def get_user_by_otp(otp):
+def get_user_by_otp_route(otp):
     user = get_user_by_otp(otp)
     
     if user:
-        return user
+        return user_to_json(user)
     else:
         return jsonify({"error": "User not found"}), 404
 
 
 # Utils functions
+def get_camera():
+    return cameras.get(sessions.get_state()["device"])
+
 def initialize_camera():
-    global camera
-    if camera is None:
-        camera = VideoCamera()
+    camera = get_camera()
     camera.initialize_camera()
     if camera.camera_status == "Success":
-        print("Camera initialized successfully.")
-        time.sleep(0.5)  # Short delay after successful initialization
         return "Camera initialized successfully."
     else:
         print("Failed to initialize camera.")
         return "Error: Failed to open the camera."
 
 def release_camera():
-    global camera
-    if camera is not None:
-        camera.release_camera()
-        camera = None
+    cameras.release(sessions.get_state()["device"])
     print("Camera released")
 
-def generate(camera):
+def generate(camera, state, capture_key, encoder=None):
+    encoder = encoder or MJPEGEncoder()
+    frame_interval = 1.0 / STREAM_MAX_FPS
+    next_frame_time = 0.0
+
     while True:
         try:
-            frame = camera.get_frame()
+            delay = next_frame_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            frame = camera.read_frame(capture_key)
             if frame is None:
                 print("Error: Failed to read frame from camera.")
                 time.sleep(0.5)  # Add a delay before retrying
                 continue
-            elif frame == "captured":
-                capture_status["status"] = "captured"
+            elif isinstance(frame, str) and frame == "captured":
+                sessions.mark_captured(state)
                 break
-            yield (b"--frame\r\n"
-                   b"Content-Type: image/jpeg\r\n\r\n" + frame + b"\r\n\r\n")
+
+            next_frame_time = time.monotonic() + frame_interval
+            if encoder.has_changed(frame):
+                yield encoder.encode(frame)
         except Exception as e:
             print(f"Error generating frame: {e}")
             time.sleep(0.5)  # Add a delay before retrying
 
-def delete_all_images():
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    os.chdir(script_dir)
-    
-    for file in os.listdir(script_dir):
-        if file.endswith(".jpg"):
-            file_path = os.path.join(script_dir, file)
-            os.remove(file_path)
-
-def reset_captured_image_path():
-    global camera
-    
-    if camera is not None:
-        camera.captured_image_path.path = ""
+def generate_capture_events(state, heartbeat=CAPTURE_EVENT_HEARTBEAT, max_duration=CAPTURE_EVENT_MAX_DURATION):
+    # The browser reconnects by itself after the stream ends or breaks
+    yield "retry: 1000\n\n"
+    deadline = time.monotonic() + max_duration
+    while time.monotonic() < deadline:
+        if sessions.wait_for_capture(state, min(heartbeat, max(0.0, deadline - time.monotonic()))):
+            yield "event: capture\ndata: captured\n\n"
+            return
+        # Comment lines keep proxies from closing an idle connection
+        yield ": keepalive\n\n"
+
+def start_capture():
+    sessions.get_state()["capture_status"] = "not_captured"
+    discard_capture()
+
+# Captures are stored under the id of the session that made them
+def get_capture():
+    return capture_store.get(sessions.get_session_id())
+
+def discard_capture():
+    capture_store.discard(sessions.get_session_id())
             
 def get_user_by_otp(otp):
-    otp = otp.strip()
-    url = f"{BASE_URL}/by_otp/{otp}"
-    response = requests.get(url)
-
-    if response.status_code == 200:
-        return response.json()
-    elif response.status_code == 404:
-        return None
-    else:
-        return None
+    return services.get_user_by_otp(otp.strip())
     
 def delete_user_by_otp(otp):
     otp = otp.strip()
-    url = f"{BASE_URL}/by_otp/{otp}"
-    response = requests.get(url)
 
-    if response.status_code == 200:
-        user = response.json()
-        user_id = user["id"]
-        delete_url = f"{BASE_URL}/{user_id}"
-        delete_response = requests.delete(delete_url)
-
-        if delete_response.status_code == 200:
-            print(f"User with OTP {otp} deleted successfully.")
-        else:
-            print(f"Failed to delete user with OTP {otp}. Error: {delete_response.text}")
+    if services.delete_user_by_otp(otp):
+        print(f"User with OTP {otp} deleted successfully.")
     else:
         print(f"User with OTP {otp} not found.")
 
 def is_database_empty():
-    users = read_all()
-    print(f"Total users: {len(users)}")
-    return len(users) == 0
-
-def check_system_resources():
-    cpu_percent = psutil.cpu_percent()
-    memory_percent = psutil.virtual_memory().percent
-    print(f"CPU usage: {cpu_percent}%, Memory usage: {memory_percent}%")
-    if cpu_percent > 90 or memory_percent > 90:
-        print("Warning: System resources are very high. This might affect camera performance.")
-
-# Initialize the database
-setup_database()
+    return not services.has_users()
 
 # Define API routes
 app.add_url_rule("/users", "read_all", read_all, methods=["GET"])
@@ -0,0 +1,156 @@
+"""
+* async_api.py
+*
+* Copyright 2024, Filippini Giovanni
+*
+* Licensed under the Apache License, Version 2.0 (the "License");
+* you may not use this file except in compliance with the License.
+* You may obtain a copy of the License at
+*
+*         https://www.apache.org/licenses/LICENSE-2.0.txt
+*
+* Unless required by applicable law or agreed to in writing, software
+* distributed under the License is distributed on an "AS IS" BASIS,
+* WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+* See the License for the specific language governing permissions and
+* limitations under the License.
+"""
+
+# Async handlers of the REST API, served by serve.py. They implement the same operations as users.py and
+# share the validation and the work of gallery.py, enrollment.py and verification.py: sqlite3, the gallery
+# search and the embedding pool all block, so that work runs in a worker thread and the loop keeps serving
+# other requests.
+# The handlers keep no state of their own, every worker process reads the users from the database.
+
+import asyncio
+
+from connexion.exceptions import ProblemException
+from http import HTTPStatus
+from starlette.responses import PlainTextResponse
+from werkzeug.exceptions import HTTPException
+
+import enrollment
+import gallery
+import services
+import verification
+
+from hf_vectorizer import base64_decoder
+from users import DEFAULT_PAGE_SIZE, user_to_json
+
+# Same problem responses as flask.abort in the synchronous handlers
+def abort(status, detail):
+    raise ProblemException(status=status, title=HTTPStatus(status).phrase, detail=detail)
+
+def vector_from_json(vector):
+    try:
+        return base64_decoder(vector)
+    except (TypeError, ValueError) as e:
+        abort(400, f"Invalid vector: {e}")
+
+async def read_all(limit=DEFAULT_PAGE_SIZE, after=0, fields=None):
+    fields = [field.strip() for field in fields.split(",") if field.strip()] if fields else services.USER_FIELDS
+
+    try:
+        users, next_after = await asyncio.to_thread(services.list_users_page, limit, after, fields)
+    except ValueError as e:
+        abort(400, str(e))
+
+    headers = {"X-Next-Cursor": str(next_after)} if next_after is not None else {}
+    return [user_to_json(user) for user in users], 200, headers
+
+async def count():
+    return {"count": await asyncio.to_thread(services.count_users)}
+
+async def exists():
+    return {"exists": await asyncio.to_thread(services.has_users)}
+
+async def create(body):
+    name = body.get("name")
+    otp = body.get("otp")
+    vector = body.get("vector")
+
+    if not name or not otp or not vector:
+        abort(400, "Invalid input")
+
+    try:
+        created_user = await asyncio.to_thread(services.create_user, name, otp, vector_from_json(vector))
+    except services.OtpInUseError as e:
+        abort(409, str(e))
+    except services.InvalidUserError as e:
+        abort(400, str(e))
+
+    return {"id": created_user["id"], "name": name, "otp": otp, "vector": vector}, 201
+
+async def read_one(userId):
+    user = await asyncio.to_thread(services.get_user, userId)
+
+    if user is None:
+        abort(404, f"User with id {userId} not found")
+
+    return user_to_json(user)
+
+async def update(userId, body):
+    name = body.get("name")
+    otp = body.get("otp")
+    vector = body.get("vector")
+
+    try:
+        updated_user = await asyncio.to_thread(services.update_user, userId, name, otp, vector_from_json(vector))
+    except services.OtpInUseError as e:
+        abort(409, str(e))
+    except services.InvalidUserError as e:
+        abort(400, str(e))
+
+    if updated_user is None:
+        abort(404, f"User with id {userId} not found")
+
+    return {"id": userId, "name": name, "otp": otp, "vector": vector}
+
+async def delete(userId):
+    if not await asyncio.to_thread(services.delete_user, userId):
+        abort(404, f"User with id {userId} not found")
+
+    return PlainTextResponse(f"User with id {userId} successfully deleted")
+
+async def read_by_otp(otp):
+    user = await asyncio.to_thread(services.get_user_by_otp, otp)
+
+    if user is None:
+        abort(404, f"User with OTP {otp} not found")
+
+    return user_to_json(user)
+
+async def check_otp(otp):
+    return {"exists": await asyncio.to_thread(services.otp_exists, otp)}
+
+# The shared handlers of gallery.py, enrollment.py and verification.py reject requests with flask.abort
+def checked(function, *args):
+    try:
+        return function(*args)
+    except HTTPException as e:
+        abort(e.code, e.description)
+
+async def checked_in_thread(function, *args):
+    try:
+        return await asyncio.to_thread(function, *args)
+    except HTTPException as e:
+        abort(e.code, e.description)
+
+async def identify(body):
+    query, k, tolerance = checked(gallery.parse_identify, body)
+    return await checked_in_thread(gallery.identify_matches, query, k, tolerance)
+
+# The embeddings are computed by the pool's processes, the thread only waits for them
+async def bulk_enroll(body=None, images=None):
+    if images:
+        uploads = images if isinstance(images, list) else [images]
+        items = [enrollment.upload_item(upload.filename, await upload.read()) for upload in uploads]
+    else:
+        items = await checked_in_thread(enrollment.directory_items, body)
+
+    return await checked_in_thread(enrollment.enroll_items, items)
+
+# Decoding a batch of images takes a while too, so it runs in the thread with the lookups
+async def verify_batch(body):
+    items, tolerance = checked(verification.parse_batch, body)
+    return await checked_in_thread(verification.verify_items, items, tolerance)
@@ -0,0 +1,270 @@
+"""
+* benchmark.py
+*
+* Copyright 2024, Filippini Giovanni
+*
+* Licensed under the Apache License, Version 2.0 (the "License");
+* you may not use this file except in compliance with the License.
+* You may obtain a copy of the License at
+*
+*         https://www.apache.org/licenses/LICENSE-2.0.txt
+*
+* Unless required by applicable law or agreed to in writing, software
+* distributed under the License is distributed on an "AS IS" BASIS,
+* WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+* See the License for the specific language governing permissions and
+* limitations under the License.
+"""
+
+# Benchmarks of the capture-to-match pipeline that need no camera: frames are synthetic, or read
+# from a folder of recorded images with --frames. Save a baseline and compare later runs against it:
+#   python3 benchmark.py --output baseline.json
+#   python3 benchmark.py --compare baseline.json
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import cv2
+import numpy as np
+
+DEFAULT_GALLERY_SIZES = (1, 100, 10_000, 1_000_000)
+QUICK_GALLERY_SIZES = (1, 100, 10_000)
+REGRESSION_THRESHOLD = 0.20
+
+def measure(fn, iterations, warmup=3):
+    for _ in range(warmup):
+        fn()
+
+    timings = np.empty(iterations)
+    for i in range(iterations):
+        start = time.perf_counter()
+        fn()
+        timings[i] = time.perf_counter() - start
+    return timings
+
+# Latency percentiles in milliseconds, throughput in items per second
+def summarize(timings, items_per_call=1):
+    p50, p95, p99 = np.percentile(timings, [50, 95, 99]) * 1000
+    return {
+        "iterations": len(timings),
+        "p50_ms": float(p50),
+        "p95_ms": float(p95),
+        "p99_ms": float(p99),
+        "mean_ms": float(np.mean(timings) * 1000),
+        "throughput": float(items_per_call * len(timings) / np.sum(timings)) if np.sum(timings) > 0 else float("inf"),
+    }
+
+def load_frames(frames_dir, count=30):
+    if frames_dir:
+        names = sorted(name for name in os.listdir(frames_dir) if name.lower().endswith((".jpg", ".jpeg", ".png", ".bmp")))
+        frames = [cv2.imread(os.path.join(frames_dir, name)) for name in names[:count]]
+        frames = [frame for frame in frames if frame is not None]
+        if frames:
+            return frames
+        print(f"No readable images in {frames_dir}, using synthetic frames")
+
+    rng = np.random.default_rng(0)
+    gradient = np.linspace(0, 255, 640, dtype=np.uint8)[np.newaxis, :, np.newaxis]
+    return [np.clip(gradient + rng.integers(0, 40, (480, 640, 3)), 0, 255).astype(np.uint8) for _ in range(count)]
+
+# Stands in for the FrameGrabber thread, handing out the given frames in a loop
+class SyntheticGrabber:
+    def __init__(self, frames):
+        self.frames = frames
+        self.sequence = 0
+
+    def wait_for_frame(self, after_sequence=0, timeout=None):
+        self.sequence += 1
+        return self.sequence, self.frames[self.sequence % len(self.frames)]
+
+    def is_running(self):
+        return True
+
+    def touch(self):
+        pass
+
+    def stop(self):
+        pass
+
+def bench_camera(frames, iterations):
+    from cameraUtils import MJPEGEncoder, VideoCamera
+
+    camera = VideoCamera()
+    camera.grabber = SyntheticGrabber(frames)
+    camera.camera_status = "Success"
+    camera.capture_key = "benchmark"
+
+    results = {
+        "camera.get_frame": summarize(measure(camera.get_frame, iterations)),
+        "camera.detect_faces": summarize(measure(lambda: camera.detect_faces(frames[0]), iterations)),
+    }
+
+    encoder = MJPEGEncoder()
+    results["camera.mjpeg_encode"] = summarize(measure(lambda: encoder.encode(frames[0]), iterations))
+    camera.grabber = None
+    return results
+
+def bench_vectorizer(frames, iterations):
+    from hf_vectorizer import get_face_vector, get_face_vector_from_image
+
+    frame = frames[0]
+    height, width = frame.shape[:2]
+    location = (height // 4, 3 * width // 4, 3 * height // 4, width // 4)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        image_path = os.path.join(temp_dir, "frame.jpg")
+        cv2.imwrite(image_path, frame)
+        return {
+            "get_face_vector": summarize(measure(lambda: get_face_vector(image_path), iterations, warmup=1)),
+            "get_face_vector_from_image.known_location": summarize(measure(lambda: get_face_vector_from_image(frame, location), iterations, warmup=1)),
+        }
+
+def bench_compare(gallery_sizes, iterations):
+    from gallery import GalleryIndex, IVFIndex
+    from hf_vectorizer import compare_vectors
+
+    rng = np.random.default_rng(0)
+    query = rng.random(128)
+    results = {}
+    for size in gallery_sizes:
+        vectors = rng.random((size, 128), dtype=np.float32)
+        # Fewer rounds on the big galleries, each one already scans the whole matrix
+        rounds = max(3, min(iterations, 10_000_000 // (size * 128) or 1))
+        results[f"compare_vectors.{size}"] = summarize(measure(lambda: compare_vectors(vectors, query), rounds, warmup=1), size)
+
+        index = GalleryIndex(np.arange(size), [""] * size, vectors, dtype=np.float32)
+        results[f"gallery.search.{size}"] = summarize(measure(lambda: index.search(query, k=1), rounds, warmup=1), size)
+
+        # Recall of the IVF index against the exact search, for probes close to enrolled users
+        ivf = IVFIndex(np.arange(size), [""] * size, vectors, dtype=np.float32)
+        probes = vectors[rng.integers(0, size, 20)] + rng.normal(0, 0.01, (20, 128)).astype(np.float32)
+        exact = [match[0][0] for match in index.search(probes, k=1)]
+        approximate = [match[0][0] for match in ivf.search(probes, k=1)]
+        results[f"gallery.ivf_search.{size}"] = summarize(measure(lambda: ivf.search(query, k=1), rounds, warmup=1), size)
+        results[f"gallery.ivf_search.{size}"]["recall"] = float(np.mean(np.equal(exact, approximate)))
+        del vectors, index, ivf
+    return results
+
+def bench_codec(iterations):
+    from hf_vectorizer import base64_decoder, base64_encoder, blob_decoder, blob_encoder
+
+    vector = np.random.default_rng(0).random(128)
+    encoded = base64_encoder(vector)
+    blob = blob_encoder(vector)
+    return {
+        "base64_encoder": summarize(measure(lambda: base64_encoder(vector), iterations)),
+        "base64_decoder": summarize(measure(lambda: base64_decoder(encoded), iterations)),
+        "blob_encoder": summarize(measure(lambda: blob_encoder(vector), iterations)),
+        "blob_decoder": summarize(measure(lambda: blob_decoder(blob), iterations)),
+    }
+
+# The REST CRUD paths, through the Connexion app, on a temporary database
+def bench_users(iterations):
+    import database
+    import services
+    from app import app
+    from hf_vectorizer import base64_encoder
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_file = os.path.join(temp_dir, "benchmark.db")
+        database.setup_database(db_file)
+        saved_database, services.DATABASE = services.DATABASE, db_file
+        try:
+            client = app.test_client()
+            vector = base64_encoder(np.random.default_rng(0).random(128))
+            counter = iter(range(100_000, 1_000_000))
+            created = []
+
+            def create():
+                response = client.post("/api/users", json={"id": 0, "name": "Benchmark", "otp": str(next(counter)), "vector": vector})
+                created.append(response.json()["id"])
+
+            results = {"users.create": summarize(measure(create, iterations))}
+            user_id = created[0]
+            otp = client.get(f"/api/users/{user_id}").json()["otp"]
+            results["users.read_one"] = summarize(measure(lambda: client.get(f"/api/users/{user_id}"), iterations))
+            results["users.read_by_otp"] = summarize(measure(lambda: client.get(f"/api/users/by_otp/{otp}"), iterations))
+            results["users.read_all"] = summarize(measure(lambda: client.get("/api/users?limit=100"), iterations))
+            results["users.update"] = summarize(measure(lambda: client.put(f"/api/users/{user_id}", json={"id": user_id, "name": "Updated", "otp": otp, "vector": vector}), iterations))
+            results["users.delete"] = summarize(measure(lambda: client.delete(f"/api/users/{created.pop()}"), min(iterations, len(created) - 1), warmup=0))
+        finally:
+            services.DATABASE = saved_database
+            database.close_connections()
+    return results
+
+def run(suites, iterations, gallery_sizes, frames_dir=None):
+    frames = load_frames(frames_dir)
+    results = {}
+    if "camera" in suites:
+        results.update(bench_camera(frames, iterations))
+    if "vectorizer" in suites:
+        results.update(bench_vectorizer(frames, max(3, iterations // 10)))
+    if "compare" in suites:
+        results.update(bench_compare(gallery_sizes, iterations))
+    if "codec" in suites:
+        results.update(bench_codec(iterations * 10))
+    if "users" in suites:
+        results.update(bench_users(iterations))
+    return results
+
+# Benchmarks whose p50 got slower than the baseline by more than the threshold
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    regressions = {}
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None or previous["p50_ms"] <= 0:
+            continue
+        change = current["p50_ms"] / previous["p50_ms"] - 1
+        if change > threshold:
+            regressions[name] = change
+    return regressions
+
+def print_results(results, baseline=None):
+    print(f"{'benchmark':<45} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'items/s':>14}")
+    for name, stats in results.items():
+        line = f"{name:<45} {stats['p50_ms']:>10.3f} {stats['p95_ms']:>10.3f} {stats['p99_ms']:>10.3f} {stats['throughput']:>14.1f}"
+        if baseline and name in baseline and baseline[name]["p50_ms"] > 0:
+            line += f"  {stats['p50_ms'] / baseline[name]['p50_ms'] - 1:+.1%}"
+        if "recall" in stats:
+            line += f"  recall {stats['recall']:.2f}"
+        print(line)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the DeVisu pipeline without a camera")
+    parser.add_argument("--suites", default="camera,vectorizer,compare,codec,users", help="comma separated suites to run")
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--gallery-sizes", help="comma separated gallery sizes for compare_vectors")
+    parser.add_argument("--quick", action="store_true", help="skip the 1M gallery")
+    parser.add_argument("--frames", help="folder of recorded frames to use instead of synthetic ones")
+    parser.add_argument("--output", help="save the results as a JSON baseline")
+    parser.add_argument("--compare", help="compare against a JSON baseline, exit with 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help="allowed p50 slowdown, 0.2 = 20%%")
+    args = parser.parse_args()
+
+    if args.gallery_sizes:
+        gallery_sizes = [int(size) for size in args.gallery_sizes.split(",")]
+    else:
+        gallery_sizes = QUICK_GALLERY_SIZES if args.quick else DEFAULT_GALLERY_SIZES
+
+    results = run(set(args.suites.split(",")), args.iterations, gallery_sizes, args.frames)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": sys.version, "platform": platform.platform(), "numpy": np.__version__, "results": results}, f, indent=2)
+        print(f"Baseline saved to {args.output}")
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        for name, change in regressions.items():
+            print(f"Regression: {name} is {change:.1%} slower than the baseline")
+        sys.exit(1 if regressions else 0)
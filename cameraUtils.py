@@ -17,9 +17,196 @@
 """
 
 import cv2
+import numpy as np
+import threading
 import time
 import os
 
+from collections import deque
+from hf_vectorizer import box_to_location
+from metrics import record_failure, timed
+from toolbox import ExpiringStore
+from tracing import span
+from video_sources import open_video_source
+
+# Captured faces are handed to the vectorizer in memory. Set DEVISU_CAPTURE_DEBUG_DIR
+# to also write every capture to that directory as a JPEG.
+CAPTURE_DEBUG_DIR = os.environ.get("DEVISU_CAPTURE_DEBUG_DIR", "")
+CAPTURE_TTL = float(os.environ.get("DEVISU_CAPTURE_TTL", 120))
+CAPTURE_MAX_ENTRIES = int(os.environ.get("DEVISU_CAPTURE_MAX_ENTRIES", 32))
+
+capture_store = ExpiringStore(max_entries=CAPTURE_MAX_ENTRIES, ttl=CAPTURE_TTL)
+
+# The device stays open between requests and is released once no frame has been requested for this long
+CAMERA_IDLE_TIMEOUT = float(os.environ.get("DEVISU_CAMERA_IDLE_TIMEOUT", 30))
+FRAME_BUFFER_SIZE = int(os.environ.get("DEVISU_FRAME_BUFFER_SIZE", 4))
+FRAME_WAIT_TIMEOUT = 1.0
+CAMERA_OPEN_TIMEOUT = 5.0
+MAX_READ_FAILURES = 5
+
+# Face detection runs on a copy of the frame scaled down to DETECTION_WIDTH pixels, once every
+# DETECTION_STRIDE frames; frames in between reuse the last boxes. Once a face is found the next
+# detection only scans the region around it, grown by ROI_MARGIN times the face size on each side.
+DETECTION_WIDTH = int(os.environ.get("DEVISU_DETECTION_WIDTH", 320))
+DETECTION_STRIDE = max(1, int(os.environ.get("DEVISU_DETECTION_STRIDE", 3)))
+ROI_MARGIN = 0.5
+
+# Preview stream settings: frame rate cap, JPEG quality and output scale. A frame that looks like the
+# last one sent is skipped, but one frame is always sent every STREAM_KEYFRAME_INTERVAL seconds.
+STREAM_MAX_FPS = float(os.environ.get("DEVISU_STREAM_MAX_FPS", 15))
+STREAM_JPEG_QUALITY = int(os.environ.get("DEVISU_STREAM_JPEG_QUALITY", 70))
+STREAM_SCALE = float(os.environ.get("DEVISU_STREAM_SCALE", 1.0))
+STREAM_KEYFRAME_INTERVAL = 1.0
+STREAM_CHANGE_THRESHOLD = 1.0
+
+_face_cascade = None
+_face_cascade_lock = threading.Lock()
+
+# The Haar classifier is loaded once per process and shared by every camera
+def get_face_cascade():
+    global _face_cascade
+    with _face_cascade_lock:
+        if _face_cascade is None:
+            _face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+            if _face_cascade.empty():
+                print("Error loading face cascade classifier.")
+        return _face_cascade
+
+# Reads the device on its own thread and keeps the latest frames in a small ring buffer
+class FrameGrabber(threading.Thread):
+    def __init__(self, source=0, buffer_size=FRAME_BUFFER_SIZE, idle_timeout=CAMERA_IDLE_TIMEOUT):
+        super().__init__(name=f"FrameGrabber-{source}", daemon=True)
+        self.source = source
+        self.idle_timeout = idle_timeout
+        self.frames = deque(maxlen=buffer_size)
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.opened = threading.Event()
+        self.running = False
+        self.capture = None
+        self.last_access = time.monotonic()
+
+    def start(self):
+        self.running = True
+        super().start()
+
+    def run(self):
+        self.capture = open_video_source(self.source)
+        if not self.capture.isOpened():
+            print(f"Failed to open the video source {self.source}.")
+            self.running = False
+            self.opened.set()
+            return
+
+        print(f"Camera opened successfully. Backend: {self.capture.getBackendName()}")
+        print(f"Frame width: {self.capture.get(cv2.CAP_PROP_FRAME_WIDTH)}")
+        print(f"Frame height: {self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT)}")
+        print(f"FPS: {self.capture.get(cv2.CAP_PROP_FPS)}")
+        self.opened.set()
+
+        failures = 0
+        try:
+            while self.running:
+                if time.monotonic() - self.last_access > self.idle_timeout:
+                    print(f"Camera idle for {self.idle_timeout}s, releasing it.")
+                    break
+
+                with timed("capture"):
+                    success, frame = self.capture.read()
+                if not success:
+                    record_failure("capture")
+                    failures += 1
+                    if failures >= MAX_READ_FAILURES:
+                        print("Failed to read frame after multiple attempts.")
+                        break
+                    print("Failed to read frame from camera. Retrying...")
+                    time.sleep(0.1)
+                    continue
+
+                failures = 0
+                with self.condition:
+                    self.sequence += 1
+                    self.frames.append((self.sequence, frame))
+                    self.condition.notify_all()
+        finally:
+            self.running = False
+            self.capture.release()
+            with self.condition:
+                self.condition.notify_all()
+            print("Camera released")
+
+    def is_running(self):
+        return self.running and self.is_alive()
+
+    def touch(self):
+        self.last_access = time.monotonic()
+
+    # Return the newest frame more recent than after_sequence, waiting for it if needed
+    def wait_for_frame(self, after_sequence=0, timeout=FRAME_WAIT_TIMEOUT):
+        self.touch()
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.sequence <= after_sequence and self.running:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            if self.frames and self.frames[-1][0] > after_sequence:
+                return self.frames[-1]
+        return None, None
+
+    def stop(self):
+        self.running = False
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout=2)
+
+class CapturedFace:
+    def __init__(self, image, face_location):
+        self.image = image
+        self.face_location = face_location
+
+# Encodes preview frames into multipart/x-mixed-replace parts, reusing its scaling buffers between frames
+class MJPEGEncoder:
+    PART_HEADER = b"--frame\r\nContent-Type: image/jpeg\r\n\r\n"
+    PART_TRAILER = b"\r\n\r\n"
+    SIGNATURE_SIZE = (32, 24)
+
+    def __init__(self, quality=STREAM_JPEG_QUALITY, scale=STREAM_SCALE):
+        self.encode_params = [int(cv2.IMWRITE_JPEG_QUALITY), int(quality)]
+        self.scale = scale
+        self.scaled = None
+        self.signature = np.empty(self.SIGNATURE_SIZE[::-1] + (3,), dtype=np.uint8)
+        self.last_signature = None
+        self.last_sent = 0.0
+
+    # False when the frame is visually the same as the last one sent and a keyframe is not due
+    def has_changed(self, frame):
+        cv2.resize(frame, self.SIGNATURE_SIZE, dst=self.signature, interpolation=cv2.INTER_AREA)
+        now = time.monotonic()
+        if self.last_signature is not None and now - self.last_sent < STREAM_KEYFRAME_INTERVAL:
+            if cv2.norm(self.signature, self.last_signature, cv2.NORM_L1) / self.signature.size < STREAM_CHANGE_THRESHOLD:
+                return False
+
+        if self.last_signature is None:
+            self.last_signature = self.signature.copy()
+        else:
+            np.copyto(self.last_signature, self.signature)
+        self.last_sent = now
+        return True
+
+    def encode(self, frame):
+        if self.scale != 1.0:
+            size = (max(1, round(frame.shape[1] * self.scale)), max(1, round(frame.shape[0] * self.scale)))
+            if self.scaled is None or self.scaled.shape[:2] != (size[1], size[0]):
+                self.scaled = np.empty((size[1], size[0]) + frame.shape[2:], dtype=frame.dtype)
+            cv2.resize(frame, size, dst=self.scaled, interpolation=cv2.INTER_AREA)
+            frame = self.scaled
+
+        ret, jpeg = cv2.imencode(".jpg", frame, self.encode_params)
+        # A single copy into the part, straight from the encoder's buffer
+        return b"".join((self.PART_HEADER, jpeg.data, self.PART_TRAILER))
+
 class PathStorage:
     def __init__(self):
         self._path = ""
@@ -33,82 +220,147 @@ class PathStorage:
         self._path = new_path
 
 class VideoCamera:
-    def __init__(self):
-        self.camera = None
+    def __init__(self, source=0):
+        self.source = source
+        self.grabber = None
+        # Concurrent requests for the same camera must not open the device twice
+        self.grabber_lock = threading.Lock()
+        self.last_sequence = 0
         self.camera_status = "Not Initialized"
         self.face_detected_time = None
         self.captured_image_path = PathStorage()
-        self.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+        self.captured_face_location = None
+        self.capture_key = "default"
+        self.detection_width = DETECTION_WIDTH
+        self.detection_stride = DETECTION_STRIDE
+        self.frame_count = 0
+        self.last_faces = ()
+        self.face_cascade = get_face_cascade()
         if self.face_cascade.empty():
-            print("Error loading face cascade classifier.")
             self.camera_status = "Error"
 
     def initialize_camera(self):
-        if self.camera is not None:
-            self.release_camera()
-        
-        self.camera = cv2.VideoCapture(0)
-        if not self.camera.isOpened():
-            print("Failed to open the camera.")
-            self.camera_status = "Error"
-        else:
-            print(f"Camera opened successfully. Backend: {self.camera.getBackendName()}")
-            print(f"Frame width: {self.camera.get(cv2.CAP_PROP_FRAME_WIDTH)}")
-            print(f"Frame height: {self.camera.get(cv2.CAP_PROP_FRAME_HEIGHT)}")
-            print(f"FPS: {self.camera.get(cv2.CAP_PROP_FPS)}")
-            self.camera_status = "Success"
+        with self.grabber_lock:
+            if self.grabber is not None and self.grabber.is_running():
+                self.grabber.touch()
+                self.camera_status = "Success"
+                return
+
+            with span("camera_open", source=str(self.source)):
+                self.grabber = FrameGrabber(self.source)
+                self.grabber.start()
+                self.grabber.opened.wait(CAMERA_OPEN_TIMEOUT)
+            self.camera_status = "Success" if self.grabber.is_running() else "Error"
 
     def release_camera(self):
-        if self.camera is not None and self.camera.isOpened():
-            self.camera.release()
-            self.camera = None
-            self.camera_status = "Released"
-            print("Camera released")
+        with self.grabber_lock:
+            if self.grabber is not None:
+                self.grabber.stop()
+                self.grabber = None
+                self.camera_status = "Released"
 
     def __del__(self):
         self.release_camera()
 
+    def is_opened(self):
+        return self.grabber is not None and self.grabber.is_running()
+
     def get_frame(self):
-        if self.camera is None or not self.camera.isOpened():
+        frame = self.read_frame()
+        if frame is None or isinstance(frame, str):
+            return frame
+
+        ret, jpeg = cv2.imencode(".jpg", frame)
+        return jpeg.tobytes()
+
+    # Returns the next frame with the detected faces drawn on it, "captured" once a face
+    # has been stable long enough to be captured, or None if no frame is available
+    def read_frame(self, capture_key=None):
+        if not self.is_opened():
             self.initialize_camera()
         
-        if self.camera_status == "Error" or not self.camera.isOpened():
+        if self.camera_status == "Error" or not self.is_opened():
             print("Camera is not available or opened.")
             return None
 
-        max_retries = 5
-        for _ in range(max_retries):
-            success, frame = self.camera.read()
-            if success:
-                break
-            print("Failed to read frame from camera. Retrying...")
-            time.sleep(0.5)
-        
-        if not success:
-            print("Failed to read frame after multiple attempts.")
+        with span("frame_read"):
+            sequence, frame = self.grabber.wait_for_frame(self.last_sequence)
+        if frame is None:
+            print("Failed to read frame from camera.")
             return None
+        self.last_sequence = sequence
 
-        gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        faces = self.face_cascade.detectMultiScale(gray_frame, scaleFactor=1.15, minNeighbors=5, minSize=(30, 30))
+        faces, fresh = self.track_faces(frame)
                         
         if len(faces) == 1:
             if self.face_detected_time is None:
                 self.face_detected_time = time.time()
             elif time.time() - self.face_detected_time >= 2:
-                self.capture_image(frame, faces[0])
+                # Capture with a box detected on this very frame, not one carried over
+                if not fresh:
+                    faces = self.detect_faces(frame)
+                if len(faces) != 1:
+                    self.face_detected_time = None
+                    return self.draw_faces(frame, faces)
+                self.capture_image(frame, faces[0], capture_key)
                 self.face_detected_time = None
-                print(f"CAPTURE_IMAGE FROM FUNCTION: {self.captured_image_path.path}")
                 return "captured"
         else:
             self.face_detected_time = None
 
+        return self.draw_faces(frame, faces)
+
+    def draw_faces(self, frame, faces):
+        # The buffered frame is shared with other readers, draw on a copy
+        if len(faces) > 0:
+            frame = frame.copy()
         for (x, y, w, h) in faces:
             cv2.rectangle(frame, (x, y), (x + w, y + h), (255, 0, 0), 2)
+        return frame
 
-        ret, jpeg = cv2.imencode(".jpg", frame)
-        return jpeg.tobytes()
+    # Returns the face boxes for this frame and whether they were detected on it
+    def track_faces(self, frame):
+        self.frame_count += 1
+        if self.frame_count % self.detection_stride != 0:
+            return self.last_faces, False
+        return self.detect_faces(frame), True
+
+    @timed("detection")
+    def detect_faces(self, frame):
+        faces = ()
+        if len(self.last_faces) == 1:
+            faces = self.detect_in_roi(frame, self.last_faces[0])
+        if len(faces) == 0:
+            faces = self.detect_in_region(frame, 0, 0, frame.shape[1], frame.shape[0])
+        self.last_faces = faces
+        return faces
+
+    def detect_in_roi(self, frame, face):
+        (x, y, w, h) = face
+        margin = int(ROI_MARGIN * max(w, h))
+        x1 = max(x - margin, 0)
+        y1 = max(y - margin, 0)
+        x2 = min(x + w + margin, frame.shape[1])
+        y2 = min(y + h + margin, frame.shape[0])
+        return self.detect_in_region(frame, x1, y1, x2, y2)
+
+    # Detect on frame[y1:y2, x1:x2] scaled like a DETECTION_WIDTH wide frame, in full frame coordinates
+    def detect_in_region(self, frame, x1, y1, x2, y2):
+        scale = min(1.0, self.detection_width / frame.shape[1])
+        region = frame[y1:y2, x1:x2]
+        if scale < 1.0:
+            size = (max(1, round(region.shape[1] * scale)), max(1, round(region.shape[0] * scale)))
+            region = cv2.resize(region, size, interpolation=cv2.INTER_AREA)
 
-    def capture_image(self, frame, face_coords):
+        gray_region = cv2.cvtColor(region, cv2.COLOR_BGR2GRAY)
+        min_size = max(1, round(30 * scale))
+        faces = self.face_cascade.detectMultiScale(gray_region, scaleFactor=1.15, minNeighbors=5, minSize=(min_size, min_size))
+        if len(faces) == 0:
+            return ()
+
+        return [(round(fx / scale) + x1, round(fy / scale) + y1, round(fw / scale), round(fh / scale)) for (fx, fy, fw, fh) in faces]
+
+    def capture_image(self, frame, face_coords, capture_key=None):
         self.captured_image_path.path = ""
 
         (x, y, w, h) = face_coords
@@ -118,33 +370,47 @@ class VideoCamera:
         x2 = min(x + w + padding, frame.shape[1])
         y2 = min(y + h + padding, frame.shape[0])
 
-        face_img = frame[y1:y2, x1:x2]
+        # Copy the crop so the stored face does not keep the whole frame alive
+        face_img = frame[y1:y2, x1:x2].copy()
+        # Haar box in the coordinates of the crop
+        self.captured_face_location = box_to_location((x - x1, y - y1, w, h))
+
+        capture_key = capture_key or self.capture_key
+        capture_store.put(capture_key, CapturedFace(face_img, self.captured_face_location))
+        print(f"CAPTURE_IMAGE FROM CLASS: stored {face_img.shape[1]}x{face_img.shape[0]} face for {capture_key}")
+
+        if CAPTURE_DEBUG_DIR:
+            self.save_debug_image(face_img)
 
+        return self.captured_face_location
+
+    def save_debug_image(self, face_img):
+        os.makedirs(CAPTURE_DEBUG_DIR, exist_ok=True)
         img_filename = "captured_image{}.jpg".format(time.strftime("%Y%m%d-%H%M%S"))
-        cv2.imwrite(img_filename, face_img)
-        path = os.path.abspath(img_filename)
+        path = os.path.abspath(os.path.join(CAPTURE_DEBUG_DIR, img_filename))
 
-        if os.path.exists(path):
+        if cv2.imwrite(path, face_img):
             print(f"Image successfully saved as {path}")
+            self.captured_image_path.path = path
         else:
             print(f"Failed to save image as {path}")
 
-        # Assign the path to the path storage
-        self.captured_image_path.path = path
-        print(f"CAPTURE_IMAGE FROM CLASS: {self.captured_image_path.path}")
-        return path
+    def get_capture(self, capture_key=None):
+        return capture_store.get(capture_key or self.capture_key)
+
+    def discard_capture(self, capture_key=None):
+        capture_store.discard(capture_key or self.capture_key)
+        self.captured_image_path.path = ""
+        self.captured_face_location = None
     
     def ensure_camera_is_open(self):
-        if not self.camera.isOpened():
+        if not self.is_opened():
             print("Attempting to reopen the camera...")
-            self.camera.release()
-            self.camera = cv2.VideoCapture(0)
-            if not self.camera.isOpened():
+            self.initialize_camera()
+            if self.camera_status == "Error":
                 print("Failed to reopen the camera.")
-                self.camera_status = "Error"
             else:
                 print("Camera reopened successfully.")
-                self.camera_status = "Success"
 
     def get_captured_path(self):
         print(f"Retrieving captured path: {self.captured_image_path.path}")
@@ -153,4 +419,50 @@ class VideoCamera:
     def set_captured_path(self, new_path):
         self.captured_image_path.path = new_path
 
+    def get_captured_face_location(self):
+        return self.captured_face_location
+
+# Parse "kiosk1=0,kiosk2=1" into {"kiosk1": 0, "kiosk2": 1}; numeric sources are device indexes
+def parse_camera_sources(spec):
+    sources = {}
+    for entry in spec.split(","):
+        if not entry.strip():
+            continue
+        device_id, _, source = entry.partition("=")
+        source = source.strip()
+        sources[device_id.strip()] = int(source) if source.isdigit() else source
+    return sources
+
+# One VideoCamera per configured device, created on first use, so several kiosks can share a server
+class CameraRegistry:
+    def __init__(self, sources):
+        self.sources = dict(sources)
+        self.cameras = {}
+        self.lock = threading.Lock()
+
+    def __contains__(self, device_id):
+        return device_id in self.sources
+
+    def devices(self):
+        return list(self.sources)
+
+    def get(self, device_id):
+        if device_id not in self.sources:
+            raise KeyError(f"Unknown camera device: {device_id}")
+
+        with self.lock:
+            camera = self.cameras.get(device_id)
+            if camera is None:
+                camera = self.cameras[device_id] = VideoCamera(self.sources[device_id])
+                camera.capture_key = device_id
+            return camera
+
+    def release(self, device_id):
+        with self.lock:
+            camera = self.cameras.pop(device_id, None)
+        if camera is not None:
+            camera.release_camera()
 
+    def release_all(self):
+        for device_id in list(self.cameras):
+            self.release(device_id)
@@ -16,10 +16,52 @@
 * limitations under the License.
 """
 
+import os
 import sqlite3
+import sys
+import threading
 
 from sqlite3 import Error
 
+DATABASE = "users.db"
+
+# Applied once to every pooled connection. WAL lets readers run alongside a writer and,
+# with synchronous=NORMAL, a commit no longer fsyncs a rollback journal.
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA cache_size=-{int(os.environ.get('DEVISU_SQLITE_CACHE_KB', 16384))}",
+    f"PRAGMA mmap_size={int(os.environ.get('DEVISU_SQLITE_MMAP_BYTES', 256 * 1024 * 1024))}",
+    "PRAGMA temp_store=MEMORY",
+)
+# Size of the per-connection prepared statement cache of the sqlite3 module
+STATEMENT_CACHE_SIZE = 256
+BUSY_TIMEOUT = 10.0
+
+_local = threading.local()
+
+SQL_CREATE_USERS_TABLE = """ CREATE TABLE IF NOT EXISTS {table} (
+                                    id integer PRIMARY KEY AUTOINCREMENT,
+                                    name text NOT NULL,
+                                    otp text NOT NULL,
+                                    vector blob NOT NULL
+                                ); """
+
+SQL_CREATE_OTP_INDEX = "CREATE {unique}INDEX IF NOT EXISTS idx_users_otp ON users (otp)"
+
+# Every change to the users table bumps a revision, so each server process can tell that its
+# in-memory gallery is stale, whichever process (or tool) made the change
+SQL_CREATE_REVISION_TABLE = """ CREATE TABLE IF NOT EXISTS users_revision (
+                                    id integer PRIMARY KEY CHECK (id = 0),
+                                    revision integer NOT NULL
+                                ); """
+SQL_INIT_REVISION = "INSERT OR IGNORE INTO users_revision (id, revision) VALUES (0, 0)"
+SQL_CREATE_REVISION_TRIGGER = """ CREATE TRIGGER IF NOT EXISTS users_revision_{event} AFTER {event} ON users
+                                  BEGIN
+                                      UPDATE users_revision SET revision = revision + 1 WHERE id = 0;
+                                  END; """
+SQL_SELECT_REVISION = "SELECT revision FROM users_revision WHERE id = 0"
+
 def create_connection(db_file):
     conn = None
     try:
@@ -29,6 +71,30 @@ def create_connection(db_file):
         print(e)
     return conn
 
+def open_connection(db_file):
+    conn = sqlite3.connect(db_file, timeout=BUSY_TIMEOUT, cached_statements=STATEMENT_CACHE_SIZE)
+    conn.row_factory = sqlite3.Row
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+# Connections are kept per thread and reused by every request served on that thread
+def get_connection(db_file=DATABASE):
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+
+    conn = connections.get(db_file)
+    if conn is None:
+        conn = connections[db_file] = open_connection(db_file)
+    return conn
+
+def close_connections():
+    connections = getattr(_local, "connections", {})
+    while connections:
+        _, conn = connections.popitem()
+        conn.close()
+
 def create_table(conn, create_table_sql):
     try:
         c = conn.cursor()
@@ -36,22 +102,99 @@ def create_table(conn, create_table_sql):
     except Error as e:
         print(e)
 
-def setup_database():
-    database = "users.db"
+def create_otp_index(conn):
+    try:
+        conn.execute(SQL_CREATE_OTP_INDEX.format(unique="UNIQUE "))
+    except sqlite3.IntegrityError:
+        # Existing duplicates must be resolved by hand, keep the lookups indexed meanwhile
+        print("Warning: duplicate OTPs found in the users table, creating a non-unique OTP index.")
+        conn.execute(SQL_CREATE_OTP_INDEX.format(unique=""))
+    except Error as e:
+        print(e)
+
+def create_revision_tracking(conn):
+    try:
+        with conn:
+            conn.execute(SQL_CREATE_REVISION_TABLE)
+            conn.execute(SQL_INIT_REVISION)
+            for event in ("INSERT", "UPDATE", "DELETE"):
+                conn.execute(SQL_CREATE_REVISION_TRIGGER.format(event=event))
+    except Error as e:
+        print(e)
 
-    sql_create_users_table = """ CREATE TABLE IF NOT EXISTS users (
-                                    id integer PRIMARY KEY AUTOINCREMENT,
-                                    name text NOT NULL,
-                                    otp text NOT NULL,
-                                    vector text NOT NULL
-                                ); """
+# Current revision of the users table, None for databases set up before revisions existed
+def get_revision(conn):
+    try:
+        row = conn.execute(SQL_SELECT_REVISION).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return row[0] if row is not None else None
 
+def setup_database(database=DATABASE):
     conn = create_connection(database)
 
     if conn is not None:
-        create_table(conn, sql_create_users_table)
+        create_table(conn, SQL_CREATE_USERS_TABLE.format(table="users"))
+        create_otp_index(conn)
+        create_revision_tracking(conn)
+        conn.close()
     else:
         print("Error! cannot create the database connection.")
 
+# Rewrite the users table with BLOB vectors, converting legacy base64 rows in a single transaction
+def migrate_database(database=DATABASE, dtype=None):
+    from hf_vectorizer import base64_decoder, blob_decoder, blob_encoder
+
+    conn = create_connection(database)
+    if conn is None:
+        print("Error! cannot create the database connection.")
+        return 0
+
+    try:
+        columns = {row[1]: row[2].lower() for row in conn.execute("PRAGMA table_info(users)")}
+        if not columns:
+            print("No users table found, nothing to migrate.")
+            return 0
+
+        rows = conn.execute("SELECT id, name, otp, vector FROM users").fetchall()
+        migrated = []
+        for user_id, name, otp, vector in rows:
+            decoded = base64_decoder(vector) if isinstance(vector, str) else blob_decoder(vector)
+            migrated.append((user_id, name, otp, blob_encoder(decoded, dtype)))
+
+        sequence = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'users'").fetchone()
+
+        # DDL is not covered by the implicit transactions of the sqlite3 module, so manage it explicitly
+        conn.isolation_level = None
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DROP TABLE IF EXISTS users_migration")
+            conn.execute(SQL_CREATE_USERS_TABLE.format(table="users_migration"))
+            conn.executemany("INSERT INTO users_migration (id, name, otp, vector) VALUES (?, ?, ?, ?)", migrated)
+            conn.execute("DROP TABLE users")
+            conn.execute("ALTER TABLE users_migration RENAME TO users")
+            create_otp_index(conn)
+            # The triggers were dropped along with the old table
+            conn.execute(SQL_CREATE_REVISION_TABLE)
+            conn.execute(SQL_INIT_REVISION)
+            for event in ("INSERT", "UPDATE", "DELETE"):
+                conn.execute(SQL_CREATE_REVISION_TRIGGER.format(event=event))
+            conn.execute("UPDATE users_revision SET revision = revision + 1 WHERE id = 0")
+            if sequence is not None:
+                conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'users'", (sequence[0],))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        conn.execute("VACUUM")
+        print(f"Migrated {len(migrated)} users to BLOB vectors.")
+        return len(migrated)
+    finally:
+        conn.close()
+
 if __name__ == "__main__":
-    setup_database()
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        migrate_database(*sys.argv[2:4])
+    else:
+        setup_database()
@@ -0,0 +1,217 @@
+"""
+* embedding_pool.py
+*
+* Copyright 2024, Filippini Giovanni
+*
+* Licensed under the Apache License, Version 2.0 (the "License");
+* you may not use this file except in compliance with the License.
+* You may obtain a copy of the License at
+*
+*         https://www.apache.org/licenses/LICENSE-2.0.txt
+*
+* Unless required by applicable law or agreed to in writing, software
+* distributed under the License is distributed on an "AS IS" BASIS,
+* WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+* See the License for the specific language governing permissions and
+* limitations under the License.
+"""
+
+# Face embeddings are computed in a pool of worker processes that load the dlib models once and
+# stay warm, so the CPU-bound work neither holds the GIL of the web server nor is limited to one core.
+# DEVISU_EMBED_WORKERS=0 computes them in the calling thread instead.
+
+import multiprocessing
+import os
+import threading
+import tracing
+import uuid
+
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from metrics import timed
+from toolbox import ExpiringStore
+
+EMBED_WORKERS = int(os.environ.get("DEVISU_EMBED_WORKERS", os.cpu_count() or 1))
+EMBED_MAX_PENDING = int(os.environ.get("DEVISU_EMBED_MAX_PENDING", 4 * max(EMBED_WORKERS, 1)))
+EMBED_TIMEOUT = float(os.environ.get("DEVISU_EMBED_TIMEOUT", 30))
+EMBED_START_METHOD = os.environ.get("DEVISU_EMBED_START_METHOD", "spawn")
+JOB_TTL = 300
+
+class PoolBusyError(RuntimeError):
+    pass
+
+def warm_up_worker():
+    import numpy as np
+    import hf_vectorizer
+
+    # Importing face_recognition loads the models, one encoding also initialises dlib's buffers
+    hf_vectorizer.get_face_vector_from_image(np.zeros((150, 150, 3), dtype=np.uint8), (25, 125, 125, 25))
+
+def embed_image(image, face_location=None):
+    import hf_vectorizer
+    return hf_vectorizer.get_face_vector_from_image(image, face_location)
+
+def embed_file(image_path, face_location=None):
+    import hf_vectorizer
+    return hf_vectorizer.get_face_vector(image_path, face_location)
+
+# Encoded images (JPEG, PNG...) are decoded in the worker, they are much cheaper to send than pixels
+def embed_encoded(data, face_location=None):
+    import cv2
+    import numpy as np
+    import hf_vectorizer
+
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Could not decode the image")
+    return hf_vectorizer.get_face_vector_from_image(image, face_location)
+
+class EmbeddingPool:
+    def __init__(self, workers=EMBED_WORKERS, max_pending=EMBED_MAX_PENDING, start_method=EMBED_START_METHOD):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.start_method = start_method
+        self.executor = None
+        self.executor_lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.jobs = ExpiringStore(max_entries=max(max_pending * 4, 64), ttl=JOB_TTL)
+
+    def get_executor(self):
+        with self.executor_lock:
+            if self.executor is None:
+                context = multiprocessing.get_context(self.start_method)
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=warm_up_worker)
+            return self.executor
+
+    def start(self):
+        if self.workers > 0:
+            self.get_executor()
+
+    # Queue a job and return its id. When max_pending jobs are already queued the caller gets
+    # PoolBusyError after waiting at most block_timeout seconds for a free slot.
+    def submit(self, fn, *args, block_timeout=0):
+        acquired = self.slots.acquire(timeout=block_timeout) if block_timeout > 0 else self.slots.acquire(blocking=False)
+        if not acquired:
+            raise PoolBusyError("Too many embeddings in progress, try again later")
+
+        try:
+            if self.workers > 0:
+                # The spans of a traced request's job are collected in the worker and come back with the result
+                if tracing.current_trace() is not None:
+                    fn, args = tracing.run_traced, (fn, *args)
+                try:
+                    future = self.get_executor().submit(fn, *args)
+                except BrokenProcessPool:
+                    # A worker died (e.g. killed by the OOM killer), start a fresh pool
+                    print("Embedding pool is broken, restarting it.")
+                    self.reset()
+                    future = self.get_executor().submit(fn, *args)
+            else:
+                future = Future()
+                try:
+                    future.set_result(fn(*args))
+                except Exception as e:
+                    future.set_exception(e)
+        except Exception:
+            self.slots.release()
+            raise
+
+        future.add_done_callback(lambda _: self.slots.release())
+        job_id = uuid.uuid4().hex
+        self.jobs.put(job_id, future)
+        return job_id
+
+    def submit_image(self, image, face_location=None, block_timeout=0):
+        return self.submit(embed_image, image, face_location, block_timeout=block_timeout)
+
+    def submit_file(self, image_path, face_location=None, block_timeout=0):
+        return self.submit(embed_file, image_path, face_location, block_timeout=block_timeout)
+
+    def submit_encoded(self, data, face_location=None, block_timeout=0):
+        return self.submit(embed_encoded, data, face_location, block_timeout=block_timeout)
+
+    def submit_source(self, source, face_location=None, block_timeout=0):
+        if isinstance(source, str):
+            return self.submit_file(source, face_location, block_timeout)
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            return self.submit_encoded(bytes(source), face_location, block_timeout)
+        return self.submit_image(source, face_location, block_timeout)
+
+    # Embed many images (paths, encoded bytes or arrays) keeping at most max_pending of them in flight.
+    # Results come back in order, a failed image yields its exception instead of a vector.
+    def embed_many(self, sources, timeout=EMBED_TIMEOUT):
+        window = deque()
+        for source in sources:
+            if len(window) >= self.max_pending:
+                yield self.collect(window.popleft(), timeout)
+            try:
+                window.append(self.submit_source(source, block_timeout=timeout))
+            except PoolBusyError as e:
+                window.append(e)
+        while window:
+            yield self.collect(window.popleft(), timeout)
+
+    def collect(self, job_id, timeout):
+        if isinstance(job_id, Exception):
+            return job_id
+        try:
+            return self.wait(job_id, timeout)
+        except Exception as e:
+            return e
+
+    def poll(self, job_id):
+        future = self.jobs.get(job_id)
+        if future is None:
+            return {"status": "unknown"}
+        if not future.done():
+            return {"status": "pending"}
+        if future.exception() is not None:
+            return {"status": "failed", "error": str(future.exception())}
+        return {"status": "done", "result": tracing.remote_result(future.result(), record=False)}
+
+    def wait(self, job_id, timeout=EMBED_TIMEOUT):
+        future = self.jobs.get(job_id)
+        if future is None:
+            raise KeyError(f"Unknown embedding job: {job_id}")
+
+        try:
+            return tracing.remote_result(future.result(timeout=timeout))
+        except FutureTimeoutError:
+            # Since Python 3.11 this is the builtin TimeoutError, which the job itself may have raised
+            if future.done():
+                raise
+            raise TimeoutError(f"Embedding job {job_id} did not finish within {timeout}s")
+        finally:
+            if future.done():
+                self.jobs.discard(job_id)
+
+    @timed("embedding")
+    def embed(self, image, face_location=None, timeout=EMBED_TIMEOUT):
+        return self.wait(self.submit_image(image, face_location), timeout)
+
+    def reset(self):
+        with self.executor_lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        with self.executor_lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True, cancel_futures=True)
+                self.executor = None
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = EmbeddingPool()
+        return _pool
+
+def embed(image, face_location=None, timeout=EMBED_TIMEOUT):
+    return get_pool().embed(image, face_location, timeout)
@@ -0,0 +1,172 @@
+"""
+* enrollment.py
+*
+* Copyright 2024, Filippini Giovanni
+*
+* Licensed under the Apache License, Version 2.0 (the "License");
+* you may not use this file except in compliance with the License.
+* You may obtain a copy of the License at
+*
+*         https://www.apache.org/licenses/LICENSE-2.0.txt
+*
+* Unless required by applicable law or agreed to in writing, software
+* distributed under the License is distributed on an "AS IS" BASIS,
+* WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+* See the License for the specific language governing permissions and
+* limitations under the License.
+"""
+
+# Bulk enrollment: every image is labelled with the name of the person it shows, the file
+# "Mario_Rossi.jpg" (or any image inside a "Mario_Rossi/" folder) enrolls "Mario Rossi".
+# Embeddings are computed in parallel by the embedding pool and the users are stored in one transaction.
+
+import os
+
+from flask import abort, request
+from metrics import record_failure
+from toolbox import generate_unique_otp
+
+import embedding_pool
+import services
+
+# Directory imports are only allowed below this root, they are disabled when it is not set
+ENROLL_ROOT = os.environ.get("DEVISU_ENROLL_ROOT")
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+# Attempts to store a batch (and then each user) when its generated OTPs were taken in the meantime
+CREATE_ATTEMPTS = 5
+
+def label_from_filename(filename):
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    return " ".join(stem.replace("_", " ").split())
+
+def is_image(filename):
+    return filename.lower().endswith(IMAGE_EXTENSIONS)
+
+# List (item, name, path) for "<name>.jpg" files and for the first image of each "<name>/" folder
+def scan_directory(directory):
+    items = []
+    for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+        if entry.is_file() and is_image(entry.name):
+            items.append((entry.name, label_from_filename(entry.name), entry.path))
+        elif entry.is_dir():
+            images = sorted(name for name in os.listdir(entry.path) if is_image(name))
+            if images:
+                items.append((os.path.join(entry.name, images[0]), label_from_filename(entry.name), os.path.join(entry.path, images[0])))
+    return items
+
+def resolve_directory(directory):
+    if not ENROLL_ROOT:
+        abort(403, "Directory enrollment is disabled, set DEVISU_ENROLL_ROOT to enable it")
+
+    root = os.path.realpath(ENROLL_ROOT)
+    path = os.path.realpath(os.path.join(root, directory))
+    if os.path.commonpath([root, path]) != root:
+        abort(400, "The directory must be inside the enrollment root")
+    if not os.path.isdir(path):
+        abort(404, f"Directory {directory} not found")
+    return path
+
+# Enroll (item, name, source) tuples, where the source is an image path or encoded image bytes.
+# Returns the per-item report, in the same order as the items.
+def enroll(items, pool=None):
+    pool = pool or embedding_pool.get_pool()
+    items = list(items)
+    report = [{"item": item, "name": name} for item, name, _ in items]
+    users = []
+
+    # Items without a name are rejected before any embedding work is spent on them
+    named = []
+    for entry, (_, name, source) in zip(report, items):
+        if name:
+            named.append((entry, source))
+        else:
+            entry.update(status="failed", error="Missing name")
+
+    results = pool.embed_many(source for _, source in named)
+    for (entry, _), vector in zip(named, results):
+        if isinstance(vector, Exception):
+            record_failure("embedding")
+            entry.update(status="failed", error=str(vector))
+        elif vector is None:
+            record_failure("embedding")
+            entry.update(status="failed", error="No face detected")
+        else:
+            users.append((entry, {"name": entry["name"], "vector": vector}))
+
+    created = 0
+    for (entry, _), user in zip(users, create_users([user for _, user in users])):
+        if isinstance(user, Exception):
+            entry.update(status="failed", error=str(user))
+        else:
+            entry.update(status="created", id=user["id"], otp=user["otp"])
+            created += 1
+
+    return {
+        "created": created,
+        "failed": len(report) - created,
+        "items": report,
+    }
+
+# Store the users with new unique OTPs, returns the created user or the error of each one, in order.
+# The batch is one transaction: when another enrollment takes one of the generated OTPs first, only
+# that OTP is generated again. When the transaction keeps failing, the users are stored one by one
+# so the error stays with the user that caused it.
+def create_users(users):
+    # OTPs must be unique in the table and within the batch
+    batch_otps = set()
+    def new_otp():
+        otp = str(generate_unique_otp(lambda otp: otp in batch_otps or services.otp_exists(otp)))
+        batch_otps.add(otp)
+        return otp
+
+    for user in users:
+        user["otp"] = new_otp()
+
+    for _ in range(CREATE_ATTEMPTS):
+        try:
+            return services.create_users(users)
+        except services.OtpInUseError as e:
+            for user in users:
+                if user["otp"] == e.otp:
+                    user["otp"] = new_otp()
+        except services.InvalidUserError:
+            break
+
+    results = []
+    for user in users:
+        for _ in range(CREATE_ATTEMPTS):
+            try:
+                result = services.create_user(user["name"], user["otp"], user["vector"])
+                break
+            except services.OtpInUseError as e:
+                result = e
+                user["otp"] = new_otp()
+            except services.InvalidUserError as e:
+                result = e
+                break
+        results.append(result)
+    return results
+
+def upload_item(filename, data):
+    return (filename, label_from_filename(filename or ""), data)
+
+# Items of a {"directory": ...} request, read from below the enrollment root
+def directory_items(body):
+    directory = body.get("directory") if isinstance(body, dict) else None
+    if not directory:
+        abort(400, "Send the images as multipart \"images\" or a JSON \"directory\"")
+    return scan_directory(resolve_directory(directory))
+
+def enroll_items(items):
+    if not items:
+        abort(400, "No images to enroll")
+
+    return enroll(items)
+
+def bulk_enroll():
+    if request.files:
+        items = [upload_item(upload.filename, upload.read()) for upload in request.files.getlist("images")]
+    else:
+        items = directory_items(request.get_json(silent=True))
+
+    return enroll_items(items)
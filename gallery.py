@@ -0,0 +1,333 @@
+"""
+* gallery.py
+*
+* Copyright 2024, Filippini Giovanni
+*
+* Licensed under the Apache License, Version 2.0 (the "License");
+* you may not use this file except in compliance with the License.
+* You may obtain a copy of the License at
+*
+*         https://www.apache.org/licenses/LICENSE-2.0.txt
+*
+* Unless required by applicable law or agreed to in writing, software
+* distributed under the License is distributed on an "AS IS" BASIS,
+* WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+* See the License for the specific language governing permissions and
+* limitations under the License.
+"""
+
+import os
+import threading
+import numpy as np
+
+from database import close_connections, get_connection, get_revision, DATABASE
+from flask import abort, request
+from hf_vectorizer import base64_decoder, decode_vector, VECTOR_DTYPE
+from metrics import record_match, timed
+
+DEFAULT_TOLERANCE = 0.45
+
+# Approximate search for large galleries (DEVISU_ANN=ivf): the users are split into NLIST clusters
+# (about sqrt(n) when 0) and a query only scans the NPROBE clusters closest to it. Galleries smaller
+# than MIN_USERS keep the exact scan, which is faster at that size.
+ANN_INDEX = os.environ.get("DEVISU_ANN", "flat")
+ANN_NLIST = int(os.environ.get("DEVISU_ANN_NLIST", 0))
+ANN_NPROBE = int(os.environ.get("DEVISU_ANN_NPROBE", 8))
+ANN_RERANK = int(os.environ.get("DEVISU_ANN_RERANK", 4))
+ANN_MIN_USERS = int(os.environ.get("DEVISU_ANN_MIN_USERS", 20000))
+# Galleries of at least this many users are reloaded in a background thread after a change, the
+# requests keep searching the previous index meanwhile. Smaller ones reload in a few milliseconds.
+BACKGROUND_RELOAD_USERS = int(os.environ.get("DEVISU_GALLERY_BACKGROUND_RELOAD", 10000))
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLES_PER_LIST = 64
+ASSIGN_CHUNK = 16384
+
+class GalleryIndex:
+    def __init__(self, ids, names, vectors, dtype=np.float64):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.names = list(names)
+
+        if len(self.ids) == 0:
+            self.vectors = np.empty((0, 0), dtype=dtype)
+        else:
+            self.vectors = np.ascontiguousarray(np.vstack(vectors), dtype=dtype)
+
+        # Squared norms of the gallery rows, so a query only costs one matrix product
+        self.sq_norms = np.einsum("ij,ij->i", self.vectors, self.vectors)
+        # Row of each user id, built once since the index is shared by the request threads
+        self.positions = {user_id: position for position, user_id in enumerate(self.ids.tolist())}
+
+    @classmethod
+    def from_rows(cls, rows, dtype=np.float64, **options):
+        ids, names, vectors = [], [], []
+        for row in rows:
+            vector = decode_vector(row["vector"])
+            if vectors and len(vector) != len(vectors[0]):
+                print(f"Skipping user {row['id']}: vector has {len(vector)} dimensions, expected {len(vectors[0])}")
+                continue
+            ids.append(row["id"])
+            names.append(row["name"])
+            vectors.append(vector)
+        return cls(ids, names, vectors, dtype=dtype, **options)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def dim(self):
+        return self.vectors.shape[1]
+
+    def distances(self, queries):
+        queries = np.atleast_2d(np.asarray(queries, dtype=self.vectors.dtype))
+        if queries.shape[1] != self.dim:
+            raise ValueError(f"Query has {queries.shape[1]} dimensions, gallery has {self.dim}")
+
+        # ||g - q||^2 = ||g||^2 - 2 g.q + ||q||^2, computed for every pair in a single GEMM
+        sq_queries = np.einsum("ij,ij->i", queries, queries)
+        sq_distances = queries @ self.vectors.T
+        sq_distances *= -2
+        sq_distances += self.sq_norms[np.newaxis, :]
+        sq_distances += sq_queries[:, np.newaxis]
+        np.maximum(sq_distances, 0, out=sq_distances)
+        return np.sqrt(sq_distances, out=sq_distances)
+
+    def search(self, queries, k=1):
+        if len(self) == 0:
+            return [[] for _ in np.atleast_2d(queries)]
+
+        distances = self.distances(queries)
+        k = max(1, min(k, len(self)))
+
+        if k < len(self):
+            candidates = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        else:
+            candidates = np.tile(np.arange(len(self)), (distances.shape[0], 1))
+
+        results = []
+        for query_index, row in enumerate(candidates):
+            order = row[np.argsort(distances[query_index, row], kind="stable")]
+            results.append([(int(self.ids[i]), self.names[i], float(distances[query_index, i])) for i in order])
+        return results
+
+    def exact_distance(self, position, query):
+        return float(np.linalg.norm(self.vectors[position].astype(np.float64) - np.asarray(query, dtype=np.float64)))
+
+    def position_of(self, user_id):
+        return self.positions.get(user_id)
+
+# Index of every vector's nearest centroid, with ||v - c||^2 expanded as in GalleryIndex.distances.
+# Rows are assigned in chunks so the distance block stays small for million-row galleries.
+def nearest_centroids(vectors, centroids, chunk=ASSIGN_CHUNK):
+    sq_centroids = np.einsum("ij,ij->i", centroids, centroids)
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk):
+        block = vectors[start:start + chunk] @ centroids.T
+        block *= -2
+        block += sq_centroids[np.newaxis, :]
+        assignments[start:start + chunk] = np.argmin(block, axis=1)
+    return assignments
+
+# Lloyd's k-means on a sample of the vectors. Empty clusters are moved to random sample points.
+def train_centroids(vectors, nlist, iterations=KMEANS_ITERATIONS, seed=0):
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), nlist * KMEANS_SAMPLES_PER_LIST)
+    sample = vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))] if sample_size < len(vectors) else vectors
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = nearest_centroids(sample, centroids)
+        counts = np.bincount(assignments, minlength=nlist)
+        order = np.argsort(assignments, kind="stable")
+        filled = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts[filled])[:-1]))
+        centroids[filled] = np.add.reduceat(sample[order], starts, axis=0) / counts[filled, np.newaxis]
+
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centroids[empty] = sample[rng.choice(len(sample), len(empty), replace=False)]
+    return centroids
+
+# Inverted file index: each user is stored in the list of its nearest k-means centroid and a query
+# scans only the nprobe lists closest to it, so the cost grows with about sqrt(n) instead of n.
+# The best k * rerank candidates are then ranked again by their exact distance, computed like
+# compare_vectors does. Centroids of a previous index can be reused to skip the k-means training.
+class IVFIndex(GalleryIndex):
+    def __init__(self, ids, names, vectors, dtype=np.float64, nlist=ANN_NLIST, nprobe=ANN_NPROBE, rerank=ANN_RERANK, centroids=None, trained_size=None, seed=0):
+        super().__init__(ids, names, vectors, dtype=dtype)
+        self.nprobe = nprobe
+        self.rerank = rerank
+        self.trained_size = len(self)
+
+        if len(self) == 0:
+            self.centroids = np.empty((0, 0), dtype=self.vectors.dtype)
+            self.lists = np.empty(0, dtype=np.int64)
+            self.offsets = np.zeros(1, dtype=np.int64)
+            return
+
+        if centroids is not None and centroids.shape[1] == self.dim and len(centroids) <= len(self):
+            self.centroids = np.ascontiguousarray(centroids, dtype=self.vectors.dtype)
+            self.trained_size = trained_size or len(self)
+        else:
+            nlist = nlist or int(round(np.sqrt(len(self))))
+            self.centroids = train_centroids(self.vectors, max(1, min(nlist, len(self))), seed=seed)
+
+        # The rows of list l are lists[offsets[l]:offsets[l + 1]]
+        assignments = nearest_centroids(self.vectors, self.centroids)
+        self.lists = np.argsort(assignments, kind="stable")
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(assignments, minlength=len(self.centroids)))))
+        self.sq_centroids = np.einsum("ij,ij->i", self.centroids, self.centroids)
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    # Rows of the nprobe closest lists, and of further lists while there are fewer than k rows
+    def candidates(self, query, k):
+        centroid_distances = self.sq_centroids - 2 * (self.centroids @ query)
+        probed = []
+        found = 0
+        for l in np.argsort(centroid_distances):
+            if len(probed) >= self.nprobe and found >= k:
+                break
+            probed.append(self.lists[self.offsets[l]:self.offsets[l + 1]])
+            found += len(probed[-1])
+        return np.concatenate(probed)
+
+    def search(self, queries, k=1):
+        queries = np.atleast_2d(np.asarray(queries, dtype=self.vectors.dtype))
+        if len(self) == 0:
+            return [[] for _ in queries]
+        if queries.shape[1] != self.dim:
+            raise ValueError(f"Query has {queries.shape[1]} dimensions, gallery has {self.dim}")
+
+        k = max(1, min(k, len(self)))
+        results = []
+        for query in queries:
+            rows = self.candidates(query, k)
+            sq_distances = self.sq_norms[rows] - 2 * (self.vectors[rows] @ query) + query @ query
+
+            shortlist = min(len(rows), k * self.rerank if self.rerank else k)
+            if shortlist < len(rows):
+                selected = np.argpartition(sq_distances, shortlist - 1)[:shortlist]
+                rows, sq_distances = rows[selected], sq_distances[selected]
+
+            if self.rerank:
+                distances = np.linalg.norm(self.vectors[rows].astype(np.float64) - query.astype(np.float64), axis=1)
+            else:
+                distances = np.sqrt(np.maximum(sq_distances, 0))
+
+            order = np.argsort(distances, kind="stable")[:k]
+            results.append([(int(self.ids[rows[i]]), self.names[rows[i]], float(distances[i])) for i in order])
+        return results
+
+_STALE = object()
+
+_index = None
+_index_database = None
+_index_revision = _STALE
+_index_lock = threading.Lock()
+# Counts the invalidations, so a reload that started before one does not mark its index current
+_index_changes = 0
+_reload_thread = None
+
+# The users table as an exact index, or as an IVF index when enabled and the gallery is large enough.
+# An IVF index reuses the centroids of the previous one while the gallery has not doubled since they were trained.
+def load_index(database=DATABASE, previous=None):
+    rows = get_connection(database).execute("SELECT id, name, vector FROM users").fetchall()
+    if ANN_INDEX != "ivf" or len(rows) < ANN_MIN_USERS:
+        return GalleryIndex.from_rows(rows, dtype=VECTOR_DTYPE)
+
+    if isinstance(previous, IVFIndex) and len(rows) <= 2 * previous.trained_size:
+        return IVFIndex.from_rows(rows, dtype=VECTOR_DTYPE, centroids=previous.centroids, trained_size=previous.trained_size)
+    return IVFIndex.from_rows(rows, dtype=VECTOR_DTYPE)
+
+# Body of the background reload: the new index replaces the previous one in a single assignment
+def reload_index(database, revision, previous, changes):
+    global _index, _index_revision, _reload_thread
+    try:
+        index = load_index(database, previous=previous)
+    except Exception as e:
+        index = None
+        print(f"Gallery index reload failed: {e}")
+    finally:
+        close_connections()
+
+    with _index_lock:
+        _reload_thread = None
+        if index is not None and database == _index_database:
+            _index = index
+            _index_revision = revision if changes == _index_changes else _STALE
+            print(f"Gallery index reloaded with {len(_index)} users")
+
+# The cached index is reloaded when this process changed the users (invalidate) and when the
+# revision kept by the database triggers moved, i.e. another worker process changed them
+def get_index(database=None):
+    global _index, _index_database, _index_revision, _reload_thread
+    database = database or DATABASE
+    revision = get_revision(get_connection(database))
+    with _index_lock:
+        if _index is not None and database == _index_database:
+            if revision == _index_revision:
+                return _index
+            if len(_index) >= BACKGROUND_RELOAD_USERS:
+                if _reload_thread is None:
+                    _reload_thread = threading.Thread(target=reload_index, args=(database, revision, _index, _index_changes), daemon=True)
+                    _reload_thread.start()
+                return _index
+
+        _index = load_index(database, previous=_index if database == _index_database else None)
+        _index_database = database
+        _index_revision = revision
+        print(f"Gallery index loaded with {len(_index)} users")
+        return _index
+
+# Wait until a running background reload has replaced the index
+def wait_for_reload(timeout=None):
+    thread = _reload_thread
+    if thread is not None:
+        thread.join(timeout)
+
+# The index is kept until the next get_index, which may reuse its IVF centroids
+def invalidate():
+    global _index_revision, _index_changes
+    with _index_lock:
+        _index_revision = _STALE
+        _index_changes += 1
+
+@timed("compare")
+def identify_vector(vector, k=1, tolerance=DEFAULT_TOLERANCE):
+    index = get_index()
+    matches = []
+    for user_id, name, _ in index.search(vector, k=k)[0]:
+        # The final decision uses the same direct norm as compare_vectors
+        distance = index.exact_distance(index.position_of(user_id), vector)
+        matches.append({"id": user_id, "name": name, "distance": distance, "match": bool(distance <= tolerance)})
+    matches.sort(key=lambda match: match["distance"])
+    return matches
+
+# Check an identification request, returns the query vector, k and tolerance
+def parse_identify(body):
+    vector = body.get("vector")
+
+    if not vector:
+        abort(400, "Invalid input")
+
+    try:
+        query = base64_decoder(vector)
+    except ValueError as e:
+        abort(400, str(e))
+
+    return query, body.get("k", 1), body.get("tolerance", DEFAULT_TOLERANCE)
+
+def identify_matches(query, k=1, tolerance=DEFAULT_TOLERANCE):
+    try:
+        matches = identify_vector(query, k=k, tolerance=tolerance)
+    except ValueError as e:
+        abort(400, str(e))
+
+    record_match("identify", any(match["match"] for match in matches))
+
+    return {"matches": matches}
+
+def identify():
+    return identify_matches(*parse_identify(request.get_json()))
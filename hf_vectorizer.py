@@ -17,37 +17,91 @@
 """
 
 import base64
-import cv2
-import face_recognition
 import numpy as np
+import os
+import struct
+
+from metrics import timed
+from tracing import span
+
+# Storage format for face vectors: an 8 byte header (magic, version, dtype code, dimensions) followed by the raw array
+VECTOR_DTYPE = os.environ.get("DEVISU_VECTOR_DTYPE", "float32")
+BLOB_MAGIC = b"DV"
+BLOB_VERSION = 1
+BLOB_HEADER = struct.Struct("<2sBBI")
+BLOB_DTYPES = {1: np.dtype("<f4"), 2: np.dtype("<f8")}
+BLOB_DTYPE_CODES = {dtype: code for code, dtype in BLOB_DTYPES.items()}
+
+# cv2 and face_recognition are imported where they are used: loading the dlib models takes
+# over a second, which the API processes that only store and compare vectors never need to pay.
+def get_face_vector(image_path, face_location=None):
+    import cv2
 
-def get_face_vector(image_path):
     try:
         image = cv2.imread(image_path)
         if image is None:
             print(f"Failed to read image from path: {image_path}")
             return None
 
-        face_locations = face_recognition.face_locations(image)
-        if len(face_locations) == 0:
-            print("No faces detected in the image.")
-            return None
+        return get_face_vector_from_image(image, face_location)
 
-        top, right, bottom, left = face_locations[0]
-        face_image = image[top:bottom, left:right]
-        face_image_resized = cv2.resize(face_image, (512, 512))
-        face_vector = face_recognition.face_encodings(face_image_resized)
+    except Exception as e:
+        print(f"Error occurred during face vector generation: {e}")
+        return None
 
-        if len(face_vector) == 0:
-            print("Failed to generate face vector from the detected face.")
-            return None
+# Convert an OpenCV (x, y, w, h) box into the (top, right, bottom, left) tuple used by face_recognition
+def box_to_location(box):
+    x, y, w, h = (int(v) for v in box)
+    return (y, x + w, y + h, x)
+
+# Side of the square the face is resized to before it is encoded
+FACE_SIZE = 512
+
+# Encode a BGR image. When the face location is already known (e.g. from the camera's
+# Haar detection) landmarks and encoding run once on it, without detecting the face again.
+def get_face_vector_from_image(image, face_location=None):
+    try:
+        if face_location is not None:
+            face_vector = encode_face(image, face_location, known=True)
+            if face_vector is not None:
+                return face_vector
+            print("Failed to encode the known face location, falling back to face detection.")
 
-        return face_vector[0]
+        return detect_face_vector(image)
 
     except Exception as e:
         print(f"Error occurred during face vector generation: {e}")
         return None
 
+def detect_face_vector(image):
+    import face_recognition
+
+    with span("hog_detect"):
+        face_locations = face_recognition.face_locations(image)
+    if len(face_locations) == 0:
+        print("No faces detected in the image.")
+        return None
+
+    face_vector = encode_face(image, face_locations[0])
+    if face_vector is None:
+        print("Failed to generate face vector from the detected face.")
+    return face_vector
+
+# Both paths encode the input the enrolled vectors were computed from: the BGR face crop resized to
+# FACE_SIZE x FACE_SIZE. A known location is encoded as the whole crop, a detected one is found again
+# inside the crop like before.
+def encode_face(image, face_location, known=False):
+    import cv2
+    import face_recognition
+
+    top, right, bottom, left = (max(0, int(v)) for v in face_location)
+    face_image = cv2.resize(image[top:bottom, left:right], (FACE_SIZE, FACE_SIZE))
+    known_face_locations = [(0, FACE_SIZE, FACE_SIZE, 0)] if known else None
+    with span("encode"):
+        face_vector = face_recognition.face_encodings(face_image, known_face_locations=known_face_locations)
+    return face_vector[0] if len(face_vector) > 0 else None
+
+@timed("compare")
 def compare_vectors(db_vector, camera_vector, tolerance=0.45):
     if db_vector is None or len(db_vector) == 0 or camera_vector is None:
         return False
@@ -57,7 +111,18 @@ def compare_vectors(db_vector, camera_vector, tolerance=0.45):
     
     distances = np.linalg.norm(arracy_vct1 - arracy_vct2, axis=1)
     return np.any(distances <= tolerance)
-    
+
+# Row-wise version of compare_vectors for N (enrolled, probe) pairs: returns the distances and the match decisions
+@timed("compare")
+def compare_vector_pairs(db_vectors, camera_vectors, tolerance=0.45):
+    db_vectors = np.atleast_2d(np.asarray(db_vectors, dtype=np.float64))
+    camera_vectors = np.atleast_2d(np.asarray(camera_vectors, dtype=np.float64))
+    if db_vectors.shape != camera_vectors.shape:
+        raise ValueError(f"Cannot compare {db_vectors.shape} vectors with {camera_vectors.shape} vectors")
+
+    distances = np.linalg.norm(db_vectors - camera_vectors, axis=1)
+    return distances, distances <= tolerance
+
 def base64_encoder(vector):
     face_vector_bytes = vector.tobytes()
     face_vector_base64 = base64.b64encode(face_vector_bytes).decode("utf-8")
@@ -66,4 +131,29 @@ def base64_encoder(vector):
 def base64_decoder(base64_string):
     decoded_bytes = base64.b64decode(base64_string)
     vector = np.frombuffer(decoded_bytes, dtype=np.float64)
-    return vector
\ No newline at end of file
+    return vector
+
+def blob_encoder(vector, dtype=None):
+    dtype = np.dtype(dtype or VECTOR_DTYPE).newbyteorder("<")
+    if dtype not in BLOB_DTYPE_CODES:
+        raise ValueError(f"Unsupported vector dtype: {dtype}")
+
+    vector = np.ascontiguousarray(vector, dtype=dtype).ravel()
+    header = BLOB_HEADER.pack(BLOB_MAGIC, BLOB_VERSION, BLOB_DTYPE_CODES[dtype], vector.size)
+    return header + vector.tobytes()
+
+def blob_decoder(blob):
+    if len(blob) < BLOB_HEADER.size:
+        raise ValueError("Vector blob is too short")
+
+    magic, version, dtype_code, dim = BLOB_HEADER.unpack_from(blob)
+    if magic != BLOB_MAGIC or version != BLOB_VERSION or dtype_code not in BLOB_DTYPES:
+        raise ValueError("Vector blob has an invalid header")
+
+    return np.frombuffer(blob, dtype=BLOB_DTYPES[dtype_code], count=dim, offset=BLOB_HEADER.size)
+
+def decode_vector(value):
+    # Rows written before the BLOB migration still hold base64 text
+    if isinstance(value, str):
+        return base64_decoder(value)
+    return blob_decoder(value)
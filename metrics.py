@@ -0,0 +1,220 @@
+"""
+* metrics.py
+*
+* Copyright 2024, Filippini Giovanni
+*
+* Licensed under the Apache License, Version 2.0 (the "License");
+* you may not use this file except in compliance with the License.
+* You may obtain a copy of the License at
+*
+*         https://www.apache.org/licenses/LICENSE-2.0.txt
+*
+* Unless required by applicable law or agreed to in writing, software
+* distributed under the License is distributed on an "AS IS" BASIS,
+* WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+* See the License for the specific language governing permissions and
+* limitations under the License.
+"""
+
+# Operational metrics, exposed at /metrics in the Prometheus text format:
+# per-stage latency histograms, match and failure counters and the host's CPU and memory usage.
+
+import functools
+import math
+import os
+import threading
+import time
+
+from tracing import record_span
+
+RESOURCE_SAMPLE_INTERVAL = float(os.environ.get("DEVISU_RESOURCE_SAMPLE_INTERVAL", 5))
+RESOURCE_WARNING_PERCENT = 90
+
+# From a 1 ms frame read to a multi-second embedding under load
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.extend(self.render_sample(key, value))
+        return lines
+
+    def render_sample(self, key, value):
+        return [f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}"]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self.key(labels))
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts["buckets"][i] += 1
+                    break
+            counts["sum"] += value
+            counts["count"] += 1
+
+    def get_count(self, **labels):
+        with self.lock:
+            counts = self.values.get(self.key(labels))
+            return counts["count"] if counts else 0
+
+    # Buckets are stored per interval and rendered cumulatively, as Prometheus expects
+    def render_sample(self, key, counts):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts["buckets"]):
+            cumulative += count
+            labels = format_labels(self.labelnames, key, [("le", format_value(bound))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {format_value(counts['sum'])}")
+        lines.append(f"{self.name}_count{labels} {counts['count']}")
+        return lines
+
+STAGE_LATENCY = Histogram("devisu_stage_duration_seconds", "Time spent in each stage of the pipeline.", ("stage",))
+MATCHES = Counter("devisu_matches_total", "Face comparisons by operation and outcome.", ("operation", "result"))
+FAILURES = Counter("devisu_failures_total", "Failures by pipeline stage.", ("stage",))
+CPU_PERCENT = Gauge("devisu_cpu_percent", "Host CPU usage sampled in the background.")
+MEMORY_PERCENT = Gauge("devisu_memory_percent", "Host memory usage sampled in the background.")
+
+REGISTRY = [STAGE_LATENCY, MATCHES, FAILURES, CPU_PERCENT, MEMORY_PERCENT]
+
+# Time a block, or a whole function when used as a decorator, into the stage's histogram.
+# The block is also recorded as a span of the current request's trace.
+class timed:
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        duration = time.perf_counter() - self.start
+        STAGE_LATENCY.observe(duration, stage=self.stage)
+        record_span(self.stage, self.start, duration, **({"error": exc_type.__name__} if exc_type else {}))
+        return False
+
+    def __call__(self, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed(self.stage):
+                return fn(*args, **kwargs)
+        return wrapper
+
+def record_match(operation, matched):
+    MATCHES.inc(operation=operation, result="match" if matched else "no_match")
+
+def record_failure(stage):
+    FAILURES.inc(stage=stage)
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# Samples CPU and memory usage every interval, so requests never wait on psutil
+class ResourceSampler(threading.Thread):
+    def __init__(self, interval=RESOURCE_SAMPLE_INTERVAL):
+        super().__init__(name="ResourceSampler", daemon=True)
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.warning = False
+
+    def sample(self):
+        import psutil
+
+        # cpu_percent without an interval reports the usage since the previous sample
+        cpu_percent = psutil.cpu_percent()
+        memory_percent = psutil.virtual_memory().percent
+        CPU_PERCENT.set(cpu_percent)
+        MEMORY_PERCENT.set(memory_percent)
+
+        high = cpu_percent > RESOURCE_WARNING_PERCENT or memory_percent > RESOURCE_WARNING_PERCENT
+        if high and not self.warning:
+            print(f"Warning: System resources are very high (CPU {cpu_percent}%, memory {memory_percent}%). This might affect camera performance.")
+        self.warning = high
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"Error sampling system resources: {e}")
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+
+_sampler = None
+_sampler_lock = threading.Lock()
+
+def start_resource_sampler(interval=RESOURCE_SAMPLE_INTERVAL):
+    global _sampler
+    with _sampler_lock:
+        if _sampler is None or not _sampler.is_alive():
+            _sampler = ResourceSampler(interval)
+            _sampler.start()
+        return _sampler
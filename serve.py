@@ -0,0 +1,133 @@
+"""
+* serve.py
+*
+* Copyright 2024, Filippini Giovanni
+*
+* Licensed under the Apache License, Version 2.0 (the "License");
+* you may not use this file except in compliance with the License.
+* You may obtain a copy of the License at
+*
+*         https://www.apache.org/licenses/LICENSE-2.0.txt
+*
+* Unless required by applicable law or agreed to in writing, software
+* distributed under the License is distributed on an "AS IS" BASIS,
+* WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+* See the License for the specific language governing permissions and
+* limitations under the License.
+"""
+
+# Native ASGI serving of the REST API with the async handlers of async_api.py:
+#   python3 serve.py --workers 4            the API only, in 4 uvicorn worker processes
+#   python3 serve.py --kiosk                the API plus the kiosk pages of app.py, in one process
+#
+# API workers share nothing but the database: each one keeps its own gallery index and reloads it when
+# the users table revision moves. The kiosk pages own the camera and the capture sessions of the
+# process, so the kiosk mode always runs a single process.
+
+import argparse
+import connexion
+import contextlib
+import metrics
+import os
+import startup
+import tracing
+
+from connexion.middleware import MiddlewarePosition
+from connexion.resolver import Resolver
+from starlette.responses import JSONResponse, PlainTextResponse
+
+import async_api
+
+API_PREFIX = "/api"
+
+# The specification names the synchronous handlers (users.create), the async ones have the same names
+def resolve_async_handler(operation_id):
+    return getattr(async_api, operation_id.rsplit(".", 1)[-1])
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    startup.initialize()
+    yield
+
+async def ready(request):
+    return JSONResponse(startup.status(), status_code=200 if startup.is_ready() else 503)
+
+async def metrics_route(request):
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# One trace per request, logged when the response has been sent
+class TraceMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        tracing.start_trace(f"{scope['method']} {scope['path']}", method=scope["method"], path=scope["path"])
+        status = {}
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["status"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            tracing.finish_trace(**status)
+
+def create_api_app(lifespan=lifespan):
+    api = connexion.AsyncApp(__name__, specification_dir="./", lifespan=lifespan)
+    api.add_api("swagger.yml", resolver=Resolver(resolve_async_handler))
+    api.add_url_rule("/ready", "ready", ready)
+    api.add_url_rule("/metrics", "metrics", metrics_route)
+    api.add_middleware(TraceMiddleware, position=MiddlewarePosition.BEFORE_SWAGGER)
+    return api
+
+app = create_api_app()
+
+# Sends the API to the async handlers and everything else to the kiosk application,
+# whose lifespan initializes the process
+class KioskDispatcher:
+    def __init__(self, api, kiosk):
+        self.api = api
+        self.kiosk = kiosk
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if scope["type"] == "http" and (path == API_PREFIX or path.startswith(API_PREFIX + "/")):
+            await self.api(scope, receive, send)
+        else:
+            await self.kiosk(scope, receive, send)
+
+def create_kiosk_app():
+    import app as kiosk
+
+    return KioskDispatcher(create_api_app(lifespan=None), kiosk.app)
+
+# Every worker process starts its own embedding pool: unless DEVISU_EMBED_WORKERS says otherwise,
+# the pools of all the workers together get one embedding process per CPU
+def share_embed_workers(workers, environ=os.environ):
+    if workers > 1 and "DEVISU_EMBED_WORKERS" not in environ:
+        environ["DEVISU_EMBED_WORKERS"] = str(max(1, (os.cpu_count() or 1) // workers))
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Serve DeVisu with uvicorn")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("DEVISU_API_WORKERS", 1)))
+    parser.add_argument("--kiosk", action="store_true", help="Also serve the kiosk pages, in a single process")
+    args = parser.parse_args()
+
+    if args.kiosk:
+        if args.workers > 1:
+            parser.error("the kiosk pages run in a single process, --workers cannot be used with --kiosk")
+        uvicorn.run("serve:create_kiosk_app", factory=True, host=args.host, port=args.port)
+    else:
+        # The worker processes read the environment when they import embedding_pool
+        share_embed_workers(args.workers)
+        uvicorn.run("serve:app", host=args.host, port=args.port, workers=args.workers)
@@ -0,0 +1,209 @@
+"""
+* services.py
+*
+* Copyright 2024, Filippini Giovanni
+*
+* Licensed under the Apache License, Version 2.0 (the "License");
+* you may not use this file except in compliance with the License.
+* You may obtain a copy of the License at
+*
+*         https://www.apache.org/licenses/LICENSE-2.0.txt
+*
+* Unless required by applicable law or agreed to in writing, software
+* distributed under the License is distributed on an "AS IS" BASIS,
+* WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+* See the License for the specific language governing permissions and
+* limitations under the License.
+"""
+
+# User operations shared by the REST API (users.py) and the web UI (app.py).
+# Users are plain dicts whose "vector" is a NumPy array.
+
+from sqlite3 import IntegrityError
+from database import get_connection, DATABASE
+from hf_vectorizer import blob_encoder, decode_vector
+
+import gallery
+
+from metrics import timed
+
+# Hot statements are kept as constants so the per-connection statement cache prepares them only once
+SQL_SELECT_ALL = "SELECT * FROM users"
+SQL_SELECT_PAGE = "SELECT {fields} FROM users WHERE id > ? ORDER BY id LIMIT ?"
+SQL_COUNT = "SELECT COUNT(*) FROM users"
+SQL_HAS_USERS = "SELECT EXISTS(SELECT 1 FROM users)"
+SQL_SELECT_BY_ID = "SELECT * FROM users WHERE id = ?"
+SQL_SELECT_BY_OTP = "SELECT * FROM users WHERE otp = ?"
+SQL_SELECT_BY_OTPS = "SELECT * FROM users WHERE otp IN ({placeholders})"
+SQL_SELECT_BY_IDS = "SELECT * FROM users WHERE id IN ({placeholders})"
+SQL_OTP_EXISTS = "SELECT EXISTS(SELECT 1 FROM users WHERE otp = ?)"
+SQL_INSERT = "INSERT INTO users (name, otp, vector) VALUES (?, ?, ?)"
+SQL_SELECT_LATEST = "SELECT id, otp FROM users ORDER BY id DESC LIMIT ?"
+SQL_UPDATE = "UPDATE users SET name = ?, otp = ?, vector = ? WHERE id = ?"
+SQL_DELETE = "DELETE FROM users WHERE id = ?"
+SQL_DELETE_BY_OTP = "DELETE FROM users WHERE otp = ?"
+
+USER_FIELDS = ("id", "name", "otp", "vector")
+# Stay below SQLITE_MAX_VARIABLE_NUMBER of older SQLite builds
+MAX_QUERY_VARIABLES = 500
+
+class OtpInUseError(ValueError):
+    def __init__(self, otp):
+        super().__init__(f"OTP {otp} is already in use")
+        self.otp = otp
+
+# Any other constraint the row breaks, e.g. a missing name
+class InvalidUserError(ValueError):
+    pass
+
+def is_otp_conflict(error):
+    return "UNIQUE constraint failed: users.otp" in str(error)
+
+def get_db_connection():
+    return get_connection(DATABASE)
+
+def row_to_user(row):
+    user = dict(row)
+    if "vector" in user:
+        user["vector"] = decode_vector(user["vector"])
+    return user
+
+@timed("db")
+def list_users():
+    conn = get_db_connection()
+    return [row_to_user(row) for row in conn.execute(SQL_SELECT_ALL).fetchall()]
+
+# Keyset pagination on the primary key: each page is an index seek, whatever its position
+@timed("db")
+def list_users_page(limit, after=0, fields=USER_FIELDS):
+    unknown = [field for field in fields if field not in USER_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown user fields: {', '.join(unknown)}")
+
+    # The id is always selected, it is the cursor for the next page
+    columns = ["id"] + [field for field in USER_FIELDS if field in fields and field != "id"]
+    sql = SQL_SELECT_PAGE.format(fields=", ".join(columns))
+    rows = get_db_connection().execute(sql, (after, limit)).fetchall()
+
+    users = [row_to_user(row) for row in rows]
+    next_after = users[-1]["id"] if len(users) == limit else None
+    if "id" not in fields:
+        for user in users:
+            del user["id"]
+    return users, next_after
+
+@timed("db")
+def count_users():
+    return get_db_connection().execute(SQL_COUNT).fetchone()[0]
+
+@timed("db")
+def has_users():
+    return bool(get_db_connection().execute(SQL_HAS_USERS).fetchone()[0])
+
+@timed("db")
+def get_user(user_id):
+    row = get_db_connection().execute(SQL_SELECT_BY_ID, (user_id,)).fetchone()
+    return row_to_user(row) if row is not None else None
+
+@timed("db")
+def get_user_by_otp(otp):
+    row = get_db_connection().execute(SQL_SELECT_BY_OTP, (otp,)).fetchone()
+    return row_to_user(row) if row is not None else None
+
+@timed("db")
+def select_users_in(sql, keys, key_field):
+    keys = list(dict.fromkeys(keys))
+    conn = get_db_connection()
+    users = {}
+    for start in range(0, len(keys), MAX_QUERY_VARIABLES):
+        chunk = keys[start:start + MAX_QUERY_VARIABLES]
+        for row in conn.execute(sql.format(placeholders=", ".join("?" * len(chunk))), chunk):
+            user = row_to_user(row)
+            users[user[key_field]] = user
+    return users
+
+# Look up many users with a few IN queries, returns a dict keyed by id or OTP (missing keys are left out)
+def get_users_by_ids(user_ids):
+    return select_users_in(SQL_SELECT_BY_IDS, user_ids, "id")
+
+def get_users_by_otps(otps):
+    return select_users_in(SQL_SELECT_BY_OTPS, otps, "otp")
+
+@timed("db")
+def otp_exists(otp):
+    return bool(get_db_connection().execute(SQL_OTP_EXISTS, (otp,)).fetchone()[0])
+
+@timed("db")
+def create_user(name, otp, vector):
+    conn = get_db_connection()
+    try:
+        with conn:
+            user_id = conn.execute(SQL_INSERT, (name, otp, blob_encoder(vector))).lastrowid
+    except IntegrityError as e:
+        if is_otp_conflict(e):
+            raise OtpInUseError(otp)
+        raise InvalidUserError(str(e)) from e
+    gallery.invalidate()
+    return {"id": user_id, "name": name, "otp": otp, "vector": vector}
+
+# Insert many users in a single transaction, either all of them are stored or none is
+@timed("db")
+def create_users(users):
+    users = list(users)
+    if not users:
+        return []
+
+    conn = get_db_connection()
+    try:
+        with conn:
+            conn.executemany(SQL_INSERT, ((user["name"], user["otp"], blob_encoder(user["vector"])) for user in users))
+            # The transaction still holds the write lock, so the newest rows are the ones just inserted
+            ids = {row["otp"]: row["id"] for row in conn.execute(SQL_SELECT_LATEST, (len(users),))}
+    except IntegrityError as e:
+        if not is_otp_conflict(e):
+            raise InvalidUserError(str(e)) from e
+        # Report the first OTP that collides, with the table or with an earlier user of the batch
+        seen = set()
+        for user in users:
+            if user["otp"] in seen or otp_exists(user["otp"]):
+                raise OtpInUseError(user["otp"])
+            seen.add(user["otp"])
+        raise
+
+    gallery.invalidate()
+    return [{"id": ids[user["otp"]], "name": user["name"], "otp": user["otp"], "vector": user["vector"]} for user in users]
+
+@timed("db")
+def update_user(user_id, name, otp, vector):
+    conn = get_db_connection()
+    try:
+        with conn:
+            updated = conn.execute(SQL_UPDATE, (name, otp, blob_encoder(vector), user_id)).rowcount
+    except IntegrityError as e:
+        if is_otp_conflict(e):
+            raise OtpInUseError(otp)
+        raise InvalidUserError(str(e)) from e
+
+    if updated == 0:
+        return None
+
+    gallery.invalidate()
+    return {"id": user_id, "name": name, "otp": otp, "vector": vector}
+
+@timed("db")
+def delete_user(user_id):
+    conn = get_db_connection()
+    with conn:
+        deleted = conn.execute(SQL_DELETE, (user_id,)).rowcount
+    if deleted:
+        gallery.invalidate()
+    return deleted > 0
+
+@timed("db")
+def delete_user_by_otp(otp):
+    conn = get_db_connection()
+    with conn:
+        deleted = conn.execute(SQL_DELETE_BY_OTP, (otp,)).rowcount
+    if deleted:
+        gallery.invalidate()
+    return deleted > 0
@@ -0,0 +1,81 @@
+"""
+* sessions.py
+*
+* Copyright 2024, Filippini Giovanni
+*
+* Licensed under the Apache License, Version 2.0 (the "License");
+* you may not use this file except in compliance with the License.
+* You may obtain a copy of the License at
+*
+*         https://www.apache.org/licenses/LICENSE-2.0.txt
+*
+* Unless required by applicable law or agreed to in writing, software
+* distributed under the License is distributed on an "AS IS" BASIS,
+* WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+* See the License for the specific language governing permissions and
+* limitations under the License.
+"""
+
+# Server-side state of the enroll/verify/delete workflows, one entry per browser session.
+# The session cookie only carries a random id, the state itself never leaves the server.
+
+import os
+import threading
+import uuid
+
+from flask import session
+from toolbox import ExpiringStore
+
+SESSION_TTL = float(os.environ.get("DEVISU_SESSION_TTL", 900))
+MAX_SESSIONS = int(os.environ.get("DEVISU_MAX_SESSIONS", 256))
+DEFAULT_DEVICE = "default"
+
+session_store = ExpiringStore(max_entries=MAX_SESSIONS, ttl=SESSION_TTL)
+
+# Wakes up the requests waiting for a capture, each one then checks the state of its own session
+_capture_condition = threading.Condition()
+
+def new_state(device=DEFAULT_DEVICE):
+    return {
+        "name": "",
+        "otp": "",
+        "vector": "",
+        "obtained_vector": "",
+        "capture_status": "not_captured",
+        "device": device,
+    }
+
+def get_session_id():
+    session_id = session.get("sid")
+    if session_id is None:
+        session_id = session["sid"] = uuid.uuid4().hex
+    return session_id
+
+# Each access also renews the session's expiry
+def get_state():
+    session_id = get_session_id()
+    state = session_store.get(session_id)
+    if state is None:
+        state = new_state()
+    session_store.put(session_id, state)
+    return state
+
+def reset_state():
+    state = get_state()
+    device = state["device"]
+    state.clear()
+    state.update(new_state(device))
+    return state
+
+def mark_captured(state):
+    with _capture_condition:
+        state["capture_status"] = "captured"
+        _capture_condition.notify_all()
+
+# Wait until the session's face has been captured, returns False on timeout
+def wait_for_capture(state, timeout):
+    with _capture_condition:
+        return _capture_condition.wait_for(lambda: state["capture_status"] == "captured", timeout)
+
+def clear_sessions():
+    session_store.clear()
@@ -0,0 +1,107 @@
+"""
+* startup.py
+*
+* Copyright 2024, Filippini Giovanni
+*
+* Licensed under the Apache License, Version 2.0 (the "License");
+* you may not use this file except in compliance with the License.
+* You may obtain a copy of the License at
+*
+*         https://www.apache.org/licenses/LICENSE-2.0.txt
+*
+* Unless required by applicable law or agreed to in writing, software
+* distributed under the License is distributed on an "AS IS" BASIS,
+* WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+* See the License for the specific language governing permissions and
+* limitations under the License.
+"""
+
+# Explicit initialization of a server process. Importing the application does no work: the database
+# is set up when the server starts, and the heavy models are only loaded on first use unless
+# DEVISU_WARMUP=1 asks to load them in the background right away. /ready reports when it is done.
+
+import os
+import threading
+import time
+
+from database import setup_database, DATABASE
+
+WARMUP = os.environ.get("DEVISU_WARMUP", "0") == "1"
+
+_state = {"database": "pending", "warmup": "disabled", "steps": {}}
+_state_lock = threading.Lock()
+
+def set_state(key, value):
+    with _state_lock:
+        _state[key] = value
+
+# The steps that failed are also listed under "failed", so /ready says why it answers 503
+def status():
+    with _state_lock:
+        current = {"database": _state["database"], "warmup": _state["warmup"], "steps": dict(_state["steps"])}
+    failed = [name for name, step in current["steps"].items() if step["status"] == "failed"]
+    if failed:
+        current["failed"] = failed
+    return current
+
+# Ready once the database is set up and the warm-up, when requested, has succeeded.
+# A process whose warm-up failed stays out of the load balancer.
+def is_ready():
+    current = status()
+    return current["database"] == "done" and current["warmup"] in ("disabled", "done")
+
+def warm_up_cascade():
+    from cameraUtils import get_face_cascade
+    get_face_cascade()
+
+# Importing face_recognition loads the dlib detector, landmark and encoding models
+def warm_up_models():
+    import face_recognition
+
+def warm_up_inference():
+    import numpy as np
+    from hf_vectorizer import get_face_vector_from_image
+    get_face_vector_from_image(np.zeros((150, 150, 3), dtype=np.uint8), (25, 125, 125, 25))
+
+# Start the worker processes, each one warms itself up before taking its first job
+def warm_up_embedding_pool():
+    import embedding_pool
+
+    pool = embedding_pool.get_pool()
+    if pool.workers > 0:
+        pool.wait(pool.submit(embedding_pool.warm_up_worker), timeout=120)
+
+WARMUP_STEPS = [
+    ("haar_cascade", warm_up_cascade),
+    ("face_models", warm_up_models),
+    ("inference", warm_up_inference),
+    ("embedding_pool", warm_up_embedding_pool),
+]
+
+def warm_up(steps=WARMUP_STEPS):
+    set_state("warmup", "running")
+    failed = False
+    for name, step in steps:
+        start = time.perf_counter()
+        try:
+            step()
+            result = {"status": "done"}
+        except Exception as e:
+            print(f"Warm-up step {name} failed: {e}")
+            result = {"status": "failed", "error": str(e)}
+            failed = True
+        result["seconds"] = round(time.perf_counter() - start, 3)
+        with _state_lock:
+            _state["steps"][name] = result
+    set_state("warmup", "failed" if failed else "done")
+
+def initialize(database=DATABASE, warmup=WARMUP):
+    import metrics
+
+    setup_database(database)
+    set_state("database", "done")
+    metrics.start_resource_sampler()
+
+    if warmup:
+        set_state("warmup", "pending")
+        threading.Thread(target=warm_up, name="WarmUp", daemon=True).start()
@@ -44,6 +44,38 @@ function checkCaptureStatus(redirectUrl) {
         });
 }
 
-function startCheckingCaptureStatus(redirectUrl) {
+function startPollingCaptureStatus(redirectUrl) {
     setInterval(() => checkCaptureStatus(redirectUrl), 500);
 }
+
+// The server pushes the capture event as soon as it happens. Polling is only
+// used when the browser has no EventSource or the event stream is unavailable.
+function startCheckingCaptureStatus(redirectUrl) {
+    if (!window.EventSource) {
+        startPollingCaptureStatus(redirectUrl);
+        return;
+    }
+
+    const events = new EventSource('/capture_events');
+    let connected = false;
+
+    events.addEventListener('open', () => {
+        connected = true;
+    });
+
+    events.addEventListener('capture', event => {
+        if (event.data === 'captured') {
+            events.close();
+            window.location.href = redirectUrl;
+        }
+    });
+
+    events.addEventListener('error', () => {
+        // Once connected the browser reconnects by itself, a stream that never opened is not there
+        if (!connected) {
+            events.close();
+            console.error('Capture events unavailable, polling the capture status instead');
+            startPollingCaptureStatus(redirectUrl);
+        }
+    });
+}
@@ -0,0 +1,136 @@
+import json
+import os
+import tempfile
+import unittest
+import numpy as np
+from unittest.mock import patch
+import accuracy
+
+def fake_embed(image_path, face_location=None):
+    with open(image_path, 'rb') as f:
+        data = f.read()
+    return None if data == b'no face' else np.full(128, float(data.decode()))
+
+class TestEmbeddingCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.images = os.path.join(self.temp_dir.name, 'images')
+        os.makedirs(self.images)
+        self.cache_dir = os.path.join(self.temp_dir.name, 'cache')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write_image(self, filename, data):
+        path = os.path.join(self.images, filename)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_cache_is_reused_between_runs(self):
+        paths = [self.write_image('1_1.png', b'0.1'), self.write_image('1_2.png', b'0.2'), self.write_image('2_1.png', b'no face')]
+        config = {'pipeline': 'test'}
+
+        with patch('embedding_pool.embed_file', side_effect=fake_embed) as mock_embed:
+            first = accuracy.extract_vectors(paths, accuracy.EmbeddingCache(self.cache_dir, config), workers=0)
+            second = accuracy.extract_vectors(paths, accuracy.EmbeddingCache(self.cache_dir, config), workers=0)
+
+        self.assertEqual(mock_embed.call_count, 3)
+        self.assertTrue(np.allclose(second[paths[1]], 0.2))
+        self.assertIsNone(second[paths[2]])
+        self.assertTrue(all(np.array_equal(first[p], second[p]) for p in paths[:2]))
+
+    def test_errors_are_not_cached(self):
+        path = self.write_image('1_1.png', b'0.1')
+        config = {'pipeline': 'test'}
+
+        with patch('embedding_pool.embed_file', side_effect=[TimeoutError('timed out'), np.full(128, 0.1)]) as mock_embed:
+            first = accuracy.extract_vectors([path], accuracy.EmbeddingCache(self.cache_dir, config), workers=0)
+            second = accuracy.extract_vectors([path], accuracy.EmbeddingCache(self.cache_dir, config), workers=0)
+
+        self.assertEqual(mock_embed.call_count, 2)
+        self.assertIsNone(first[path])
+        self.assertTrue(np.allclose(second[path], 0.1))
+
+    def test_cache_keyed_by_content_and_config(self):
+        path = self.write_image('1_1.png', b'0.1')
+        with patch('embedding_pool.embed_file', side_effect=fake_embed) as mock_embed:
+            accuracy.extract_vectors([path], accuracy.EmbeddingCache(self.cache_dir, {'pipeline': 'a'}), workers=0)
+            accuracy.extract_vectors([path], accuracy.EmbeddingCache(self.cache_dir, {'pipeline': 'b'}), workers=0)
+            self.write_image('1_1.png', b'0.3')
+            vectors = accuracy.extract_vectors([path], accuracy.EmbeddingCache(self.cache_dir, {'pipeline': 'a'}), workers=0)
+
+        self.assertEqual(mock_embed.call_count, 3)
+        self.assertTrue(np.allclose(vectors[path], 0.3))
+
+    def test_accuracy_uses_extracted_vectors(self):
+        self.write_image('1_1.png', b'0.1')
+        self.write_image('1_2.png', b'0.1')
+        self.write_image('2_1.png', b'0.9')
+        self.write_image('2_2.png', b'0.5')
+
+        with patch('embedding_pool.embed_file', side_effect=fake_embed):
+            references = accuracy.generate_reference_vectors(self.images, workers=0)
+            results = accuracy.test_accuracy(self.images, references, tolerance=0.5, workers=0)
+
+        self.assertEqual(sorted(references), [1, 2])
+        self.assertEqual(results, {'TP': 1, 'FP': 0, 'TN': 0, 'FN': 1})
+
+class TestThresholdSweep(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.references = {person: rng.random(128) for person in range(1, 6)}
+        self.labels = np.repeat(np.arange(1, 8), 4)
+        noise = rng.normal(0, 0.04, (len(self.labels), 128))
+        self.probes = np.array([self.references.get(label, rng.random(128)) for label in self.labels]) + noise
+
+    def test_sweep_matches_per_threshold_loop(self):
+        distances, reference_labels = accuracy.distance_matrix(self.probes, self.references)
+        thresholds = np.linspace(0.2, 1.0, 17)
+        sweep = accuracy.sweep_thresholds(distances, self.labels, reference_labels, thresholds)
+
+        for i, threshold in enumerate(thresholds):
+            expected = {'TP': 0, 'FP': 0, 'TN': 0, 'FN': 0}
+            for label, probe in zip(self.labels, self.probes):
+                person, distance = min(((p, np.linalg.norm(v - probe)) for p, v in self.references.items()), key=lambda pair: pair[1])
+                if distance <= threshold:
+                    expected['TP' if person == label else 'FP'] += 1
+                else:
+                    expected['FN' if label in self.references else 'TN'] += 1
+            self.assertEqual(accuracy.threshold_results(sweep, i), expected)
+
+            genuine = [np.linalg.norm(self.references[l] - p) for l, p in zip(self.labels, self.probes) if l in self.references]
+            impostor = [np.linalg.norm(v - p) for l, p in zip(self.labels, self.probes) for r, v in self.references.items() if r != l]
+            self.assertAlmostEqual(sweep['FRR'][i], np.mean(np.array(genuine) > threshold))
+            self.assertAlmostEqual(sweep['FAR'][i], np.mean(np.array(impostor) <= threshold))
+
+    def test_equal_error_rate(self):
+        sweep = {'threshold': np.array([0.4, 0.5, 0.6]), 'FAR': np.array([0.0, 0.1, 0.3]), 'FRR': np.array([0.4, 0.3, 0.1])}
+        threshold, rate = accuracy.equal_error_rate(sweep)
+        self.assertAlmostEqual(threshold, 0.55)
+        self.assertAlmostEqual(rate, 0.2)
+
+    def test_write_report(self):
+        distances, reference_labels = accuracy.distance_matrix(self.probes, self.references)
+        sweep = accuracy.sweep_thresholds(distances, self.labels, reference_labels, np.linspace(0.2, 1.0, 9))
+        with tempfile.TemporaryDirectory() as temp_dir:
+            json_path = os.path.join(temp_dir, 'report.json')
+            csv_path = os.path.join(temp_dir, 'report.csv')
+            accuracy.write_report(sweep, json_path)
+            accuracy.write_report(sweep, csv_path)
+
+            with open(json_path) as f:
+                report = json.load(f)
+            with open(csv_path) as f:
+                rows = f.read().splitlines()
+
+        self.assertEqual(len(report['thresholds']), 9)
+        self.assertIn('rate', report['eer'])
+        self.assertEqual(len(report['roc']['FAR']), 9)
+        self.assertEqual(rows[0], 'threshold,TP,FP,TN,FN,accuracy,FAR,FRR,TAR')
+        self.assertEqual(len(rows), 10)
+
+if __name__ == '__main__':
+    unittest.main()
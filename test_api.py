@@ -1,53 +1,41 @@
 import unittest
-from unittest.mock import patch, MagicMock
+import numpy as np
+from unittest.mock import patch
 from app import get_user_by_otp, delete_user_by_otp
 
 class TestAPICalls(unittest.TestCase):
 
-    @patch('app.requests.get')
+    @patch('app.services.get_user_by_otp')
     def test_get_user_by_otp_success(self, mock_get):
-        mock_response = MagicMock()
-        mock_response.status_code = 200
-        mock_response.json.return_value = {'id': 1, 'name': 'John Doe', 'otp': '123456', 'vector': 'base64vector'}
-        mock_get.return_value = mock_response
+        vector = np.random.rand(128)
+        mock_get.return_value = {'id': 1, 'name': 'John Doe', 'otp': '123456', 'vector': vector}
 
-        user = get_user_by_otp('123456')
-        self.assertEqual(user, {'id': 1, 'name': 'John Doe', 'otp': '123456', 'vector': 'base64vector'})
+        user = get_user_by_otp(' 123456 ')
+        mock_get.assert_called_once_with('123456')
+        self.assertEqual(user['name'], 'John Doe')
+        self.assertTrue(np.array_equal(user['vector'], vector))
 
-    @patch('app.requests.get')
+    @patch('app.services.get_user_by_otp')
     def test_get_user_by_otp_not_found(self, mock_get):
-        mock_response = MagicMock()
-        mock_response.status_code = 404
-        mock_get.return_value = mock_response
+        mock_get.return_value = None
 
         user = get_user_by_otp('invalid_otp')
         self.assertIsNone(user)
 
-    @patch('app.requests.get')
-    @patch('app.requests.delete')
-    def test_delete_user_by_otp_success(self, mock_delete, mock_get):
-        mock_get_response = MagicMock()
-        mock_get_response.status_code = 200
-        mock_get_response.json.return_value = {'id': 1, 'name': 'John Doe', 'otp': '123456', 'vector': 'base64vector'}
-        mock_get.return_value = mock_get_response
-
-        mock_delete_response = MagicMock()
-        mock_delete_response.status_code = 200
-        mock_delete.return_value = mock_delete_response
+    @patch('app.services.delete_user_by_otp')
+    def test_delete_user_by_otp_success(self, mock_delete):
+        mock_delete.return_value = True
 
         delete_user_by_otp('123456')
-        mock_delete.assert_called_once()
+        mock_delete.assert_called_once_with('123456')
         
     # Test for delete_user_by_otp when user is not found
-    @patch('app.requests.get')
-    @patch('app.requests.delete')
-    def test_delete_user_by_otp_not_found(self, mock_delete, mock_get):
-        mock_get_response = MagicMock()
-        mock_get_response.status_code = 404
-        mock_get.return_value = mock_get_response
+    @patch('app.services.delete_user_by_otp')
+    def test_delete_user_by_otp_not_found(self, mock_delete):
+        mock_delete.return_value = False
 
         delete_user_by_otp('invalid_otp')
-        mock_delete.assert_not_called()
+        mock_delete.assert_called_once_with('invalid_otp')
         
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -0,0 +1,28 @@
+import unittest
+import numpy as np
+import benchmark
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_summarize(self):
+        stats = benchmark.summarize(np.full(100, 0.002), items_per_call=10)
+        self.assertAlmostEqual(stats['p50_ms'], 2.0)
+        self.assertAlmostEqual(stats['p99_ms'], 2.0)
+        self.assertAlmostEqual(stats['throughput'], 5000.0)
+
+    def test_compare_reports_regressions(self):
+        baseline = {'fast': {'p50_ms': 1.0}, 'slow': {'p50_ms': 1.0}}
+        results = {'fast': {'p50_ms': 1.1}, 'slow': {'p50_ms': 1.5}, 'new': {'p50_ms': 9.0}}
+        regressions = benchmark.compare(results, baseline, threshold=0.2)
+        self.assertEqual(list(regressions), ['slow'])
+        self.assertAlmostEqual(regressions['slow'], 0.5)
+
+    def test_codec_and_compare_suites_run(self):
+        results = benchmark.run({'codec', 'compare'}, iterations=3, gallery_sizes=[1, 10])
+        self.assertIn('base64_decoder', results)
+        self.assertIn('compare_vectors.10', results)
+        self.assertEqual(results['gallery.search.10']['iterations'], 3)
+        self.assertEqual(results['gallery.ivf_search.10']['recall'], 1.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,223 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+import cv2
+import numpy as np
+from unittest.mock import patch
+from cameraUtils import VideoCamera, FrameGrabber, MJPEGEncoder, capture_store, get_face_cascade
+from video_sources import ImageDirectoryCapture, ReplayCapture, open_video_source
+
+class FakeCapture:
+    def __init__(self, *args):
+        self.opened = True
+        self.reads = 0
+
+    def isOpened(self):
+        return self.opened
+
+    def read(self):
+        time.sleep(0.005)
+        self.reads += 1
+        return True, np.full((48, 64, 3), self.reads % 256, dtype=np.uint8)
+
+    def get(self, prop):
+        return 0
+
+    def getBackendName(self):
+        return 'FAKE'
+
+    def release(self):
+        self.opened = False
+
+class TestVideoCamera(unittest.TestCase):
+
+    def setUp(self):
+        self.camera = VideoCamera()
+        self.camera.capture_key = 'test'
+
+    def tearDown(self):
+        capture_store.discard('test')
+
+    def test_capture_image_kept_in_memory(self):
+        frame = np.random.randint(0, 256, (480, 640, 3), dtype=np.uint8)
+        with patch('cameraUtils.cv2.imwrite') as mock_imwrite:
+            self.camera.capture_image(frame, (100, 50, 80, 90))
+            mock_imwrite.assert_not_called()
+
+        capture = self.camera.get_capture()
+        self.assertEqual(capture.image.shape, (130, 120, 3))
+        self.assertEqual(capture.face_location, (20, 100, 110, 20))
+        self.assertTrue(np.array_equal(capture.image, frame[30:160, 80:200]))
+
+    def test_discard_capture(self):
+        frame = np.zeros((480, 640, 3), dtype=np.uint8)
+        self.camera.capture_image(frame, (100, 50, 80, 90))
+        self.camera.discard_capture()
+        self.assertIsNone(self.camera.get_capture())
+
+class TestFaceDetection(unittest.TestCase):
+
+    def setUp(self):
+        self.camera = VideoCamera()
+        self.camera.detection_width = 320
+        self.camera.detection_stride = 3
+        self.frame = np.zeros((480, 640, 3), dtype=np.uint8)
+
+    def test_detection_runs_downscaled(self):
+        with patch.object(self.camera, 'face_cascade') as mock_cascade:
+            mock_cascade.detectMultiScale.return_value = np.array([[50, 40, 30, 30]])
+            faces = self.camera.detect_faces(self.frame)
+            gray_region = mock_cascade.detectMultiScale.call_args[0][0]
+        self.assertEqual(gray_region.shape, (240, 320))
+        self.assertEqual(faces, [(100, 80, 60, 60)])
+
+    def test_detection_limited_to_roi_around_last_face(self):
+        self.camera.last_faces = [(100, 80, 60, 60)]
+        with patch.object(self.camera, 'face_cascade') as mock_cascade:
+            mock_cascade.detectMultiScale.return_value = np.array([[10, 10, 30, 30]])
+            faces = self.camera.detect_faces(self.frame)
+            gray_region = mock_cascade.detectMultiScale.call_args[0][0]
+        self.assertEqual(mock_cascade.detectMultiScale.call_count, 1)
+        self.assertEqual(gray_region.shape, (60, 60))
+        self.assertEqual(faces, [(90, 70, 60, 60)])
+
+    def test_detection_stride_reuses_last_boxes(self):
+        with patch.object(self.camera, 'detect_faces', return_value=[(1, 2, 3, 4)]) as mock_detect:
+            results = [self.camera.track_faces(self.frame) for _ in range(6)]
+        self.assertEqual(mock_detect.call_count, 2)
+        self.assertEqual([fresh for _, fresh in results], [False, False, True, False, False, True])
+
+class TestMJPEGEncoder(unittest.TestCase):
+
+    def test_encode_multipart_part(self):
+        encoder = MJPEGEncoder(quality=50, scale=0.5)
+        part = encoder.encode(np.random.randint(0, 256, (480, 640, 3), dtype=np.uint8))
+        self.assertTrue(part.startswith(MJPEGEncoder.PART_HEADER))
+        self.assertTrue(part.endswith(MJPEGEncoder.PART_TRAILER))
+        self.assertEqual(encoder.scaled.shape, (240, 320, 3))
+
+    def test_unchanged_frames_skipped(self):
+        encoder = MJPEGEncoder()
+        frame = np.random.randint(0, 256, (480, 640, 3), dtype=np.uint8)
+        self.assertTrue(encoder.has_changed(frame))
+        self.assertFalse(encoder.has_changed(frame.copy()))
+        self.assertTrue(encoder.has_changed(255 - frame))
+
+    @patch('cameraUtils.time.monotonic')
+    def test_unchanged_frame_sent_as_keyframe(self, mock_monotonic):
+        encoder = MJPEGEncoder()
+        frame = np.zeros((480, 640, 3), dtype=np.uint8)
+        mock_monotonic.return_value = 10.0
+        self.assertTrue(encoder.has_changed(frame))
+        mock_monotonic.return_value = 11.5
+        self.assertTrue(encoder.has_changed(frame))
+
+class TestFrameGrabber(unittest.TestCase):
+
+    @patch('cameraUtils.cv2.VideoCapture', FakeCapture)
+    def test_wait_for_frame_returns_newer_frames(self):
+        grabber = FrameGrabber(0)
+        grabber.start()
+        try:
+            self.assertTrue(grabber.opened.wait(1))
+            first_sequence, frame = grabber.wait_for_frame(0)
+            self.assertEqual(frame.shape, (48, 64, 3))
+            second_sequence, _ = grabber.wait_for_frame(first_sequence)
+            self.assertGreater(second_sequence, first_sequence)
+        finally:
+            grabber.stop()
+        self.assertFalse(grabber.is_running())
+        self.assertFalse(grabber.capture.isOpened())
+
+    @patch('cameraUtils.cv2.VideoCapture', FakeCapture)
+    def test_releases_device_when_idle(self):
+        grabber = FrameGrabber(0, idle_timeout=0.05)
+        grabber.start()
+        grabber.join(timeout=1)
+        self.assertFalse(grabber.is_running())
+        self.assertFalse(grabber.capture.isOpened())
+
+    @patch('cameraUtils.cv2.VideoCapture', FakeCapture)
+    def test_camera_reuses_running_grabber(self):
+        camera = VideoCamera()
+        try:
+            camera.initialize_camera()
+            grabber = camera.grabber
+            camera.initialize_camera()
+            self.assertIs(camera.grabber, grabber)
+            self.assertIsInstance(camera.get_frame(), bytes)
+        finally:
+            camera.release_camera()
+
+    @patch('cameraUtils.cv2.VideoCapture', FakeCapture)
+    def test_concurrent_requests_open_the_camera_once(self):
+        started = []
+
+        class SlowGrabber(FrameGrabber):
+            def __init__(self, *args, **kwargs):
+                time.sleep(0.05)
+                super().__init__(*args, **kwargs)
+                started.append(self)
+
+        camera = VideoCamera()
+        with patch('cameraUtils.FrameGrabber', SlowGrabber):
+            threads = [threading.Thread(target=camera.initialize_camera) for _ in range(5)]
+            try:
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                self.assertEqual(len(started), 1)
+            finally:
+                for grabber in started:
+                    grabber.stop()
+
+    def test_face_cascade_loaded_once(self):
+        self.assertIs(VideoCamera().face_cascade, get_face_cascade())
+
+class TestVideoSources(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        for i in range(3):
+            cv2.imwrite(os.path.join(self.temp_dir.name, f'{i:03d}.png'), np.full((24, 32, 3), i * 50, dtype=np.uint8))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_image_directory_replays_in_order_and_loops(self):
+        capture = open_video_source(self.temp_dir.name, pace='fast', loop=True)
+        self.assertIsInstance(capture, ReplayCapture)
+        self.assertEqual([int(capture.read()[1][0, 0, 0]) for _ in range(5)], [0, 50, 100, 0, 50])
+
+    def test_replay_without_loop_ends(self):
+        capture = ReplayCapture(ImageDirectoryCapture(self.temp_dir.name), pace='fast', loop=False)
+        self.assertEqual([capture.read()[0] for _ in range(4)], [True, True, True, False])
+
+    def test_realtime_pacing(self):
+        capture = ReplayCapture(ImageDirectoryCapture(self.temp_dir.name), pace='realtime')
+        capture.frame_interval = 0.02
+        start = time.monotonic()
+        for _ in range(6):
+            capture.read()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    @patch('cameraUtils.cv2.VideoCapture', FakeCapture)
+    def test_devices_and_streams_are_not_replayed(self):
+        self.assertIsInstance(open_video_source(0), FakeCapture)
+        self.assertIsInstance(open_video_source('1'), FakeCapture)
+        self.assertIsInstance(open_video_source('rtsp://localhost:8554/kiosk'), FakeCapture)
+
+    def test_camera_reads_image_directory(self):
+        camera = VideoCamera(self.temp_dir.name)
+        try:
+            camera.initialize_camera()
+            self.assertEqual(camera.camera_status, 'Success')
+            self.assertEqual(camera.read_frame().shape, (24, 32, 3))
+        finally:
+            camera.release_camera()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import sqlite3
+import threading
+import unittest
+import numpy as np
+import database
+from hf_vectorizer import base64_encoder, blob_decoder
+from test_support import DatabaseTestCase
+
+class TestDatabase(DatabaseTestCase):
+
+    setup_schema = False
+
+    def test_get_connection_reused_per_thread(self):
+        conn = database.get_connection(self.db_file)
+        self.assertIs(database.get_connection(self.db_file), conn)
+
+        other = []
+        thread = threading.Thread(target=lambda: other.append(database.get_connection(self.db_file)))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], conn)
+
+    def test_get_connection_is_tuned(self):
+        conn = database.get_connection(self.db_file)
+        self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+        self.assertEqual(conn.execute("PRAGMA synchronous").fetchone()[0], 1)
+
+    def test_setup_database_uses_blob_vectors(self):
+        database.setup_database(self.db_file)
+        conn = sqlite3.connect(self.db_file)
+        columns = {row[1]: row[2] for row in conn.execute("PRAGMA table_info(users)")}
+        conn.close()
+        self.assertEqual(columns['vector'].lower(), 'blob')
+
+    def test_migrate_database_converts_base64_rows(self):
+        vector = np.random.rand(128)
+        conn = sqlite3.connect(self.db_file)
+        conn.execute("CREATE TABLE users (id integer PRIMARY KEY AUTOINCREMENT, name text NOT NULL, otp text NOT NULL, vector text NOT NULL)")
+        conn.execute("INSERT INTO users (id, name, otp, vector) VALUES (7, 'John Doe', '123456', ?)", (base64_encoder(vector),))
+        conn.execute("DELETE FROM users WHERE id = 7")
+        conn.execute("INSERT INTO users (id, name, otp, vector) VALUES (5, 'John Doe', '123456', ?)", (base64_encoder(vector),))
+        conn.commit()
+        conn.close()
+
+        self.assertEqual(database.migrate_database(self.db_file, 'float32'), 1)
+
+        conn = sqlite3.connect(self.db_file)
+        user_id, stored = conn.execute("SELECT id, vector FROM users").fetchone()
+        sequence = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'users'").fetchone()[0]
+        conn.close()
+        self.assertEqual(user_id, 5)
+        self.assertEqual(sequence, 7)
+        self.assertIsInstance(stored, bytes)
+        self.assertTrue(np.allclose(blob_decoder(stored), vector, atol=1e-6))
+        self.assertIsNotNone(database.get_revision(database.get_connection(self.db_file)))
+
+    def test_revision_moves_on_every_change(self):
+        database.setup_database(self.db_file)
+        conn = sqlite3.connect(self.db_file)
+        revisions = [database.get_revision(conn)]
+        conn.execute("INSERT INTO users (name, otp, vector) VALUES ('John Doe', '123456', x'00')")
+        conn.commit()
+        revisions.append(database.get_revision(conn))
+        conn.execute("UPDATE users SET name = 'Jane Doe'")
+        conn.commit()
+        revisions.append(database.get_revision(conn))
+        conn.execute("DELETE FROM users")
+        conn.commit()
+        revisions.append(database.get_revision(conn))
+        conn.close()
+        self.assertEqual(revisions, [0, 1, 2, 3])
+
+    def test_revision_is_none_without_tracking(self):
+        conn = sqlite3.connect(self.db_file)
+        self.assertIsNone(database.get_revision(conn))
+        conn.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import threading
+import unittest
+import numpy as np
+from concurrent.futures import Future
+from unittest.mock import patch
+import tracing
+from embedding_pool import EmbeddingPool, PoolBusyError
+
+class TestEmbeddingPool(unittest.TestCase):
+
+    def test_inline_pool_embeds(self):
+        pool = EmbeddingPool(workers=0, max_pending=2)
+        with patch('hf_vectorizer.get_face_vector_from_image', return_value=np.ones(128)) as mock_embed:
+            vector = pool.embed(np.zeros((10, 10, 3), dtype=np.uint8), (1, 9, 9, 1))
+        self.assertEqual(vector.shape, (128,))
+        self.assertEqual(mock_embed.call_args[0][1], (1, 9, 9, 1))
+
+    def test_submit_and_poll(self):
+        pool = EmbeddingPool(workers=0, max_pending=2)
+        job_id = pool.submit(sum, [1, 2, 3])
+        self.assertEqual(pool.poll(job_id), {'status': 'done', 'result': 6})
+        self.assertEqual(pool.poll('missing'), {'status': 'unknown'})
+
+    def test_failed_job(self):
+        pool = EmbeddingPool(workers=0, max_pending=2)
+        job_id = pool.submit(int, 'not a number')
+        self.assertEqual(pool.poll(job_id)['status'], 'failed')
+        with self.assertRaises(ValueError):
+            pool.wait(job_id)
+
+    def test_timeout_raised_by_the_job_is_kept(self):
+        def timed_out_job():
+            raise TimeoutError('camera read timed out')
+
+        pool = EmbeddingPool(workers=0, max_pending=2)
+        with self.assertRaisesRegex(TimeoutError, 'camera read timed out'):
+            pool.wait(pool.submit(timed_out_job))
+
+    def test_wait_times_out(self):
+        pool = EmbeddingPool(workers=0, max_pending=2)
+        pool.jobs.put('pending', Future())
+        with self.assertRaisesRegex(TimeoutError, 'did not finish within 0.01s'):
+            pool.wait('pending', timeout=0.01)
+
+    def test_backpressure(self):
+        pool = EmbeddingPool(workers=0, max_pending=1)
+        release = threading.Event()
+        started = threading.Event()
+
+        def slow_job():
+            started.set()
+            release.wait(2)
+
+        worker = threading.Thread(target=pool.submit, args=(slow_job,))
+        worker.start()
+        started.wait(2)
+        with self.assertRaises(PoolBusyError):
+            pool.submit(sum, [])
+        release.set()
+        worker.join()
+        self.assertIsNotNone(pool.submit(sum, []))
+
+    def test_process_pool_embeds(self):
+        pool = EmbeddingPool(workers=1, max_pending=2)
+        try:
+            image = np.random.randint(0, 256, (150, 150, 3), dtype=np.uint8)
+            vector = pool.embed(image, (25, 125, 125, 25), timeout=60)
+        finally:
+            pool.shutdown()
+        self.assertEqual(vector.shape, (128,))
+
+    @patch('tracing.TRACING_ENABLED', True)
+    def test_worker_spans_join_the_caller_trace(self):
+        pool = EmbeddingPool(workers=1, max_pending=2)
+        trace = tracing.start_trace('unit')
+        try:
+            image = np.random.randint(0, 256, (150, 150, 3), dtype=np.uint8)
+            vector = pool.embed(image, (25, 125, 125, 25), timeout=60)
+        finally:
+            pool.shutdown()
+            trace.finished = True
+        self.assertEqual(vector.shape, (128,))
+        worker_spans = [s for s in trace.spans if s.get('process') == 'worker']
+        self.assertIn('encode', [s['name'] for s in worker_spans])
+        embedding = next(s for s in trace.spans if s['name'] == 'embedding')
+        self.assertLessEqual(worker_spans[0]['duration_ms'], embedding['duration_ms'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from unittest.mock import patch
+import embedding_pool
+import enrollment
+import services
+from app import app
+from embedding_pool import EmbeddingPool
+from test_support import DatabaseTestCase
+
+def fake_embed(data, face_location=None):
+    if data == b'no face':
+        return None
+    return np.full(128, len(data) / 100.0)
+
+class TestBulkEnrollment(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.patch('embedding_pool._pool', EmbeddingPool(workers=0, max_pending=2))
+        self.patch('embedding_pool.embed_encoded', side_effect=fake_embed)
+        self.patch('embedding_pool.embed_file', side_effect=lambda path, face_location=None: fake_embed(open(path, 'rb').read()))
+        self.client = app.test_client()
+
+    def test_label_from_filename(self):
+        self.assertEqual(enrollment.label_from_filename('imgs/Mario_Rossi.jpg'), 'Mario Rossi')
+
+    def test_multipart_batch_reports_each_item(self):
+        files = [
+            ('images', ('Mario_Rossi.jpg', b'a' * 50, 'image/jpeg')),
+            ('images', ('Luigi_Verdi.jpg', b'no face', 'image/jpeg')),
+            ('images', ('Anna_Bianchi.png', b'b' * 70, 'image/png')),
+        ]
+        response = self.client.post('/api/users/bulk', files=files)
+        self.assertEqual(response.status_code, 200)
+        report = response.json()
+        self.assertEqual((report['created'], report['failed']), (2, 1))
+        self.assertEqual([item['status'] for item in report['items']], ['created', 'failed', 'created'])
+        self.assertEqual(report['items'][1]['error'], 'No face detected')
+
+        user = services.get_user(report['items'][2]['id'])
+        self.assertEqual(user['name'], 'Anna Bianchi')
+        self.assertEqual(user['otp'], report['items'][2]['otp'])
+        self.assertTrue(np.allclose(user['vector'], 0.7))
+        self.assertEqual(services.count_users(), 2)
+
+    def test_directory_batch(self):
+        with tempfile.TemporaryDirectory() as root:
+            os.makedirs(os.path.join(root, 'site', 'Anna_Bianchi'))
+            for path in (os.path.join('site', 'Mario_Rossi.jpg'), os.path.join('site', 'Anna_Bianchi', '1.jpg'), os.path.join('site', 'notes.txt')):
+                with open(os.path.join(root, path), 'wb') as f:
+                    f.write(b'c' * 40)
+
+            with patch('enrollment.ENROLL_ROOT', root):
+                report = self.client.post('/api/users/bulk', json={'directory': 'site'}).json()
+                outside = self.client.post('/api/users/bulk', json={'directory': '..'})
+
+        self.assertEqual(report['created'], 2)
+        self.assertEqual(sorted(item['name'] for item in report['items']), ['Anna Bianchi', 'Mario Rossi'])
+        self.assertEqual(outside.status_code, 400)
+
+    def test_directory_disabled_without_root(self):
+        with patch('enrollment.ENROLL_ROOT', None):
+            response = self.client.post('/api/users/bulk', json={'directory': 'site'})
+        self.assertEqual(response.status_code, 403)
+
+    def test_otp_taken_by_another_enrollment_is_regenerated(self):
+        create_users = services.create_users
+        taken = []
+        def create_after_another_enrollment(users):
+            if not taken:
+                # Another enrollment stores the first generated OTP before this batch does
+                taken.append(users[0]['otp'])
+                services.create_user('Mario Rossi', users[0]['otp'], np.zeros(128))
+            return create_users(users)
+
+        with patch('services.create_users', side_effect=create_after_another_enrollment):
+            report = enrollment.enroll([('a.jpg', 'Anna Bianchi', b'a' * 10), ('b.jpg', 'Luigi Verdi', b'b' * 10)])
+
+        self.assertEqual((report['created'], report['failed']), (2, 0))
+        self.assertNotEqual(report['items'][0]['otp'], taken[0])
+        self.assertEqual(services.count_users(), 3)
+
+    def test_invalid_user_fails_only_its_item(self):
+        create_user = services.create_user
+        def reject_luigi(name, otp, vector):
+            if name == 'Luigi Verdi':
+                raise services.InvalidUserError('CHECK constraint failed')
+            return create_user(name, otp, vector)
+
+        with patch('services.create_users', side_effect=services.InvalidUserError('CHECK constraint failed')), \
+             patch('services.create_user', side_effect=reject_luigi):
+            report = enrollment.enroll([('a.jpg', 'Anna Bianchi', b'a' * 10), ('b.jpg', 'Luigi Verdi', b'b' * 10)])
+
+        self.assertEqual([item['status'] for item in report['items']], ['created', 'failed'])
+        self.assertEqual(report['items'][1]['error'], 'CHECK constraint failed')
+        self.assertEqual(services.count_users(), 1)
+
+    def test_missing_name_is_not_embedded(self):
+        report = enrollment.enroll([('_.jpg', '', b'a' * 10), ('b.jpg', 'Luigi Verdi', b'b' * 10)])
+        self.assertEqual(report['items'][0]['error'], 'Missing name')
+        self.assertEqual(embedding_pool.embed_encoded.call_count, 1)
+
+    def test_create_users_is_atomic(self):
+        services.create_user('Mario Rossi', '123456', np.zeros(128))
+        users = [{'name': 'Anna', 'otp': '111111', 'vector': np.ones(128)}, {'name': 'Luigi', 'otp': '123456', 'vector': np.ones(128)}]
+        with self.assertRaises(services.OtpInUseError) as context:
+            services.create_users(users)
+        self.assertEqual(context.exception.otp, '123456')
+        self.assertEqual(services.count_users(), 1)
+
+if __name__ == '__main__':
+    unittest.main()
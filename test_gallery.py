@@ -0,0 +1,188 @@
+import sqlite3
+import unittest
+import numpy as np
+from unittest.mock import patch
+import gallery
+from gallery import GalleryIndex, IVFIndex
+from hf_vectorizer import base64_encoder, blob_encoder, compare_vectors
+from test_support import DatabaseTestCase
+
+class TestGalleryIndex(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.vectors = rng.random((50, 128))
+        self.index = GalleryIndex(list(range(1, 51)), [f"user{i}" for i in range(1, 51)], self.vectors)
+
+    def test_distances_match_direct_norm(self):
+        query = np.random.rand(128)
+        expected = np.linalg.norm(self.vectors - query, axis=1)
+        self.assertTrue(np.allclose(self.index.distances(query)[0], expected))
+
+    def test_search_returns_nearest_first(self):
+        query = self.vectors[7] + 0.001
+        results = self.index.search(query, k=3)[0]
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0][0], 8)
+        self.assertEqual(results[0][1], "user8")
+        self.assertTrue(results[0][2] <= results[1][2] <= results[2][2])
+
+    def test_search_batch(self):
+        results = self.index.search(self.vectors[[0, 10, 20]], k=1)
+        self.assertEqual([r[0][0] for r in results], [1, 11, 21])
+
+    def test_search_k_larger_than_gallery(self):
+        results = self.index.search(self.vectors[0], k=100)[0]
+        self.assertEqual(len(results), 50)
+
+    def test_search_empty_gallery(self):
+        index = GalleryIndex([], [], [])
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.search(np.random.rand(128)), [[]])
+
+    def test_from_rows_decodes_base64(self):
+        rows = [{"id": 3, "name": "John Doe", "vector": base64_encoder(self.vectors[0])}]
+        index = GalleryIndex.from_rows(rows)
+        self.assertEqual(index.ids.tolist(), [3])
+        self.assertTrue(np.allclose(index.vectors[0], self.vectors[0]))
+
+    def test_position_of(self):
+        index = GalleryIndex([7, 3, 5], ["a", "b", "c"], self.vectors[:3])
+        self.assertEqual([index.position_of(user_id) for user_id in (3, 5, 7)], [1, 2, 0])
+        self.assertIsNone(index.position_of(4))
+
+    def test_identify_vector_agrees_with_compare_vectors(self):
+        query = self.vectors[4] + 0.01
+        with patch('gallery.get_index', return_value=self.index):
+            matches = gallery.identify_vector(query, k=2)
+        self.assertEqual(matches[0]["id"], 5)
+        self.assertEqual(matches[0]["match"], bool(compare_vectors(self.vectors[4], query)))
+        self.assertEqual(matches[1]["match"], bool(compare_vectors(self.vectors[matches[1]["id"] - 1], query)))
+
+class TestIVFIndex(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        centers = rng.random((40, 128))
+        self.vectors = centers[rng.integers(0, 40, 2000)] + rng.normal(0, 0.05, (2000, 128))
+        self.ids = list(range(1, 2001))
+        self.names = [f"user{i}" for i in self.ids]
+        self.flat = GalleryIndex(self.ids, self.names, self.vectors)
+        self.queries = self.vectors[rng.integers(0, 2000, 50)] + rng.normal(0, 0.01, (50, 128))
+
+    def test_every_user_is_in_one_list(self):
+        index = IVFIndex(self.ids, self.names, self.vectors, nlist=30)
+        self.assertEqual(index.nlist, 30)
+        self.assertEqual(sorted(index.lists.tolist()), list(range(2000)))
+        self.assertEqual(index.offsets[-1], 2000)
+
+    def test_probing_every_list_is_exact(self):
+        index = IVFIndex(self.ids, self.names, self.vectors, nlist=30, nprobe=30)
+        for approximate, exact in zip(index.search(self.queries, k=5), self.flat.search(self.queries, k=5)):
+            self.assertEqual([match[0] for match in approximate], [match[0] for match in exact])
+            self.assertTrue(np.allclose([match[2] for match in approximate], [match[2] for match in exact]))
+
+    def test_recall_with_few_probes(self):
+        index = IVFIndex(self.ids, self.names, self.vectors, nlist=45, nprobe=4)
+        exact = [matches[0][0] for matches in self.flat.search(self.queries)]
+        approximate = [matches[0][0] for matches in index.search(self.queries)]
+        self.assertGreaterEqual(np.mean(np.equal(exact, approximate)), 0.95)
+
+    def test_reranked_distances_are_exact(self):
+        index = IVFIndex(self.ids, self.names, self.vectors, dtype=np.float32, nlist=30, rerank=2)
+        for user_id, _, distance in index.search(self.queries[0], k=3)[0]:
+            self.assertEqual(distance, float(np.linalg.norm(self.vectors[user_id - 1].astype(np.float32).astype(np.float64) - self.queries[0].astype(np.float32))))
+
+    def test_returns_k_results_from_small_lists(self):
+        index = IVFIndex(self.ids[:20], self.names[:20], self.vectors[:20], nlist=10, nprobe=1)
+        self.assertEqual(len(index.search(self.queries[0], k=15)[0]), 15)
+
+    def test_reuses_centroids(self):
+        index = IVFIndex(self.ids, self.names, self.vectors, nlist=30)
+        reloaded = IVFIndex(self.ids[:1500], self.names[:1500], self.vectors[:1500], centroids=index.centroids, trained_size=index.trained_size)
+        self.assertTrue(np.array_equal(reloaded.centroids, index.centroids))
+        self.assertEqual(reloaded.trained_size, 2000)
+
+    def test_empty_index(self):
+        index = IVFIndex([], [], [])
+        self.assertEqual(index.search(np.zeros(128)), [[]])
+
+    def test_identify_vector_keeps_compare_vectors_decision(self):
+        index = IVFIndex(self.ids, self.names, self.vectors, nlist=30)
+        with patch('gallery.get_index', return_value=index):
+            matches = gallery.identify_vector(self.queries[0], k=3)
+        for match in matches:
+            self.assertEqual(match["match"], bool(compare_vectors(self.vectors[match["id"] - 1], self.queries[0])))
+
+class TestSharedGallery(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        gallery.invalidate()
+        self.addCleanup(gallery.invalidate)
+
+    def add_user(self, name, otp):
+        # A connection of its own, like another worker process
+        conn = sqlite3.connect(self.db_file)
+        conn.execute("INSERT INTO users (name, otp, vector) VALUES (?, ?, ?)", (name, otp, blob_encoder(np.zeros(128))))
+        conn.commit()
+        conn.close()
+
+    def test_index_reloads_when_another_process_writes(self):
+        self.add_user('John Doe', '123456')
+        first = gallery.get_index(self.db_file)
+        self.assertIs(gallery.get_index(self.db_file), first)
+
+        self.add_user('Jane Doe', '654321')
+        second = gallery.get_index(self.db_file)
+        self.assertIsNot(second, first)
+        self.assertEqual(sorted(second.names), ['Jane Doe', 'John Doe'])
+
+    @patch('gallery.BACKGROUND_RELOAD_USERS', 1)
+    def test_large_galleries_reload_in_background(self):
+        self.addCleanup(gallery.wait_for_reload)
+        self.add_user('John Doe', '123456')
+        first = gallery.get_index(self.db_file)
+
+        self.add_user('Jane Doe', '654321')
+        # The previous index keeps answering until the new one is loaded
+        self.assertIs(gallery.get_index(self.db_file), first)
+        gallery.wait_for_reload(5)
+        second = gallery.get_index(self.db_file)
+        self.assertEqual(sorted(second.names), ['Jane Doe', 'John Doe'])
+        self.assertIs(gallery.get_index(self.db_file), second)
+
+    @patch('gallery.BACKGROUND_RELOAD_USERS', 1)
+    def test_invalidate_during_reload_reloads_again(self):
+        self.addCleanup(gallery.wait_for_reload)
+        self.add_user('John Doe', '123456')
+        first = gallery.get_index(self.db_file)
+        gallery.invalidate()
+
+        load_index = gallery.load_index
+        def load_while_writing(*args, **kwargs):
+            gallery.invalidate()
+            return load_index(*args, **kwargs)
+
+        with patch('gallery.load_index', side_effect=load_while_writing):
+            self.assertIs(gallery.get_index(self.db_file), first)
+            gallery.wait_for_reload(5)
+        second = gallery.get_index(self.db_file)
+        self.assertIsNot(second, first)
+        gallery.wait_for_reload(5)
+        self.assertIsNot(gallery.get_index(self.db_file), second)
+
+    def test_large_galleries_use_ivf(self):
+        self.add_user('John Doe', '123456')
+        self.add_user('Jane Doe', '654321')
+        with patch('gallery.ANN_INDEX', 'ivf'), patch('gallery.ANN_MIN_USERS', 2):
+            index = gallery.get_index(self.db_file)
+            self.assertIsInstance(index, IVFIndex)
+            self.assertEqual(index.search(np.zeros(128), k=2)[0][0][2], 0.0)
+
+        with patch('gallery.ANN_INDEX', 'ivf'), patch('gallery.ANN_MIN_USERS', 3):
+            gallery.invalidate()
+            self.assertNotIsInstance(gallery.get_index(self.db_file), IVFIndex)
+
+if __name__ == '__main__':
+    unittest.main()
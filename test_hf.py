@@ -1,4 +1,5 @@
 import unittest
+import cv2
 import numpy as np
 from unittest.mock import patch, mock_open
 import hf_vectorizer
@@ -24,6 +25,39 @@ class TestHFVectorizer(unittest.TestCase):
             vector = hf_vectorizer.get_face_vector('invalid.jpeg')
             self.assertIsNone(vector)
 
+    def test_get_face_vector_known_location_skips_detection(self):
+        image = np.random.randint(0, 256, (100, 100, 3), dtype=np.uint8)
+        with patch('face_recognition.face_locations') as mock_locations:
+            with patch('face_recognition.face_encodings', return_value=[np.random.rand(128)]) as mock_encodings:
+                vector = hf_vectorizer.get_face_vector_from_image(image, (10, 60, 70, 20))
+                self.assertEqual(vector.shape, (128,))
+                mock_locations.assert_not_called()
+                mock_encodings.assert_called_once()
+                # Same BGR crop and scale as the detection path, the crop is the face
+                face_image = mock_encodings.call_args[0][0]
+                self.assertTrue(np.array_equal(face_image, cv2.resize(image[10:70, 20:60], (512, 512))))
+                self.assertEqual(mock_encodings.call_args[1]['known_face_locations'], [(0, 512, 512, 0)])
+
+    def test_both_paths_encode_the_same_crop(self):
+        image = np.random.randint(0, 256, (100, 100, 3), dtype=np.uint8)
+        with patch('face_recognition.face_locations', return_value=[(10, 60, 70, 20)]):
+            with patch('face_recognition.face_encodings', return_value=[np.random.rand(128)]) as mock_encodings:
+                hf_vectorizer.get_face_vector_from_image(image)
+                hf_vectorizer.get_face_vector_from_image(image, (10, 60, 70, 20))
+        detected, known = (call[0][0] for call in mock_encodings.call_args_list)
+        self.assertTrue(np.array_equal(detected, known))
+
+    def test_get_face_vector_known_location_falls_back(self):
+        image = np.random.randint(0, 256, (100, 100, 3), dtype=np.uint8)
+        with patch('face_recognition.face_locations', return_value=[(10, 30, 60, 20)]) as mock_locations:
+            with patch('face_recognition.face_encodings', side_effect=[[], [np.random.rand(128)]]):
+                vector = hf_vectorizer.get_face_vector_from_image(image, (10, 60, 70, 20))
+                self.assertEqual(vector.shape, (128,))
+                mock_locations.assert_called_once()
+
+    def test_box_to_location(self):
+        self.assertEqual(hf_vectorizer.box_to_location((20, 10, 40, 60)), (10, 60, 70, 20))
+
     def test_compare_vectors_equal(self):
         vector1 = np.random.rand(128)
         vector2 = vector1.copy()
@@ -73,5 +107,27 @@ class TestHFVectorizer(unittest.TestCase):
         base64_string = hf_vectorizer.base64_encoder(vector)
         self.assertEqual(base64_string, '')
 
+    def test_blob_round_trip_float32(self):
+        vector = np.random.rand(128)
+        blob = hf_vectorizer.blob_encoder(vector, 'float32')
+        self.assertEqual(len(blob), hf_vectorizer.BLOB_HEADER.size + 128 * 4)
+        decoded_vector = hf_vectorizer.blob_decoder(blob)
+        self.assertEqual(decoded_vector.dtype, np.float32)
+        self.assertTrue(np.allclose(vector, decoded_vector, atol=1e-6))
+
+    def test_blob_round_trip_float64(self):
+        vector = np.random.rand(128)
+        decoded_vector = hf_vectorizer.blob_decoder(hf_vectorizer.blob_encoder(vector, 'float64'))
+        self.assertTrue(np.array_equal(vector, decoded_vector))
+
+    def test_blob_decoder_invalid_header(self):
+        with self.assertRaises(ValueError):
+            hf_vectorizer.blob_decoder(b'not a vector blob')
+
+    def test_decode_vector_accepts_legacy_base64(self):
+        vector = np.random.rand(128)
+        decoded_vector = hf_vectorizer.decode_vector(hf_vectorizer.base64_encoder(vector))
+        self.assertTrue(np.array_equal(vector, decoded_vector))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,63 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import metrics
+from app import app
+from metrics import Counter, Histogram, ResourceSampler, timed
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram_renders_cumulative_buckets(self):
+        histogram = Histogram('test_seconds', 'Test.', ('stage',), buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.7, 3.0):
+            histogram.observe(value, stage='db')
+
+        lines = histogram.render()
+        self.assertIn('# TYPE test_seconds histogram', lines)
+        self.assertIn('test_seconds_bucket{stage="db",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{stage="db",le="1.0"} 3', lines)
+        self.assertIn('test_seconds_bucket{stage="db",le="+Inf"} 4', lines)
+        self.assertIn('test_seconds_sum{stage="db"} 4.25', lines)
+        self.assertIn('test_seconds_count{stage="db"} 4', lines)
+
+    def test_counter_requires_its_labels(self):
+        counter = Counter('test_total', 'Test.', ('result',))
+        counter.inc(result='match')
+        counter.inc(2, result='match')
+        self.assertEqual(counter.get(result='match'), 3)
+        with self.assertRaises(ValueError):
+            counter.inc(stage='db')
+
+    def test_timed_decorator_observes_stage(self):
+        before = metrics.STAGE_LATENCY.get_count(stage='unit_test')
+
+        @timed('unit_test')
+        def work():
+            return 42
+
+        self.assertEqual(work(), 42)
+        with self.assertRaises(RuntimeError):
+            with timed('unit_test'):
+                raise RuntimeError()
+        self.assertEqual(metrics.STAGE_LATENCY.get_count(stage='unit_test'), before + 2)
+
+    @patch('psutil.virtual_memory', return_value=MagicMock(percent=95.0))
+    @patch('psutil.cpu_percent', return_value=12.5)
+    def test_resource_sampler(self, mock_cpu, mock_memory):
+        sampler = ResourceSampler()
+        sampler.sample()
+        self.assertEqual(metrics.CPU_PERCENT.get(), 12.5)
+        self.assertEqual(metrics.MEMORY_PERCENT.get(), 95.0)
+        self.assertTrue(sampler.warning)
+
+    def test_metrics_endpoint(self):
+        metrics.record_match('verify', True)
+        metrics.record_failure('embedding')
+        response = app.test_client().get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['content-type'].startswith('text/plain'))
+        self.assertIn('devisu_matches_total{operation="verify",result="match"}', response.text)
+        self.assertIn('devisu_failures_total{stage="embedding"}', response.text)
+        self.assertIn('# TYPE devisu_stage_duration_seconds histogram', response.text)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,15 @@
 import unittest
-from unittest.mock import patch, MagicMock
-from app import app, reset_globals
+from types import SimpleNamespace
+from unittest.mock import patch
+from a2wsgi import WSGIMiddleware
+import sessions
+from app import app, reset_globals, set_wsgi_threads, WSGI_THREADS
+from test_support import DatabaseTestCase
 
-class TestRoutes(unittest.TestCase):
+class TestRoutes(DatabaseTestCase):
 
     def setUp(self):
+        super().setUp()
         self.app = app.test_client()
         reset_globals()
 
@@ -23,5 +28,34 @@ class TestRoutes(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         mock_set_global_name.assert_called_once_with('John Doe')
 
+    def test_sessions_keep_separate_state(self):
+        first = app.test_client()
+        second = app.test_client()
+        first.post('/add_name', data={'username': 'John Doe'})
+        second.post('/add_name', data={'username': 'Jane Doe'})
+
+        # The session cookie carries the id the state is stored under
+        serializer = app.app.session_interface.get_signing_serializer(app.app)
+        states = [sessions.session_store.get(serializer.loads(client.cookies['session'])['sid']) for client in (first, second)]
+        self.assertEqual([state['name'] for state in states], ['John Doe', 'Jane Doe'])
+
+    @patch('app.discard_capture')
+    @patch('app.embedding_pool.embed', side_effect=RuntimeError('embedding failed'))
+    @patch('app.get_capture')
+    def test_verify_check_discards_capture_on_error(self, mock_get_capture, mock_embed, mock_discard_capture):
+        response = self.app.get('/verify_check')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('embedding failed', response.text)
+        mock_discard_capture.assert_called_once()
+
+class TestWsgiThreads(unittest.TestCase):
+
+    def test_thread_pool_is_sized(self):
+        self.assertIsInstance(app._middleware_app.asgi_app, WSGIMiddleware)
+        self.assertEqual(app._middleware_app.asgi_app.executor._max_workers, WSGI_THREADS)
+
+    def test_unknown_layout_keeps_the_default(self):
+        self.assertFalse(set_wsgi_threads(SimpleNamespace(), 4))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,134 @@
+import asyncio
+import base64
+import unittest
+import numpy as np
+from unittest.mock import patch
+import gallery
+import serve
+import startup
+from embedding_pool import EmbeddingPool
+from hf_vectorizer import base64_encoder
+from test_support import DatabaseTestCase
+
+def fake_embed(data, face_location=None):
+    return np.full(128, float(data.decode()))
+
+class TestAsyncApi(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        gallery.invalidate()
+        self.addCleanup(gallery.invalidate)
+        self.patch('gallery.DATABASE', self.db_file)
+        self.patch('embedding_pool._pool', EmbeddingPool(workers=0, max_pending=2))
+        self.patch('embedding_pool.embed_encoded', side_effect=fake_embed)
+        # Without the context manager the lifespan, which sets up the default database, does not run
+        self.client = serve.create_api_app(lifespan=None).test_client()
+        self.vector = base64_encoder(np.full(128, 0.5))
+
+    def create_user(self, name='John Doe', otp='123456'):
+        return self.client.post('/api/users', json={'id': 0, 'name': name, 'otp': otp, 'vector': self.vector})
+
+    def test_user_lifecycle(self):
+        response = self.create_user()
+        self.assertEqual(response.status_code, 201)
+        user_id = response.json()['id']
+
+        self.assertEqual(self.client.get('/api/users/count').json(), {'count': 1})
+        self.assertEqual(self.client.get(f'/api/users/{user_id}').json()['otp'], '123456')
+        self.assertEqual(self.client.get('/api/users/by_otp/123456').json()['id'], user_id)
+        self.assertEqual(self.client.get('/api/users?fields=id,name').json(), [{'id': user_id, 'name': 'John Doe'}])
+
+        response = self.client.put(f'/api/users/{user_id}', json={'id': user_id, 'name': 'Jane Doe', 'otp': '654321', 'vector': self.vector})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get('/api/users/by_otp/654321/exists').json(), {'exists': True})
+
+        self.assertEqual(self.client.delete(f'/api/users/{user_id}').status_code, 200)
+        self.assertEqual(self.client.get('/api/users/exists').json(), {'exists': False})
+
+    def test_errors_are_problem_responses(self):
+        response = self.client.get('/api/users/999')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()['detail'], 'User with id 999 not found')
+
+        self.create_user()
+        self.assertEqual(self.create_user(name='Jane Doe').status_code, 409)
+        self.assertEqual(self.client.get('/api/users?fields=bogus').status_code, 400)
+
+    def test_identify_sees_users_created_by_other_processes(self):
+        self.assertEqual(self.client.post('/api/identify', json={'vector': self.vector}).json(), {'matches': []})
+        self.create_user()
+        matches = self.client.post('/api/identify', json={'vector': self.vector}).json()['matches']
+        self.assertEqual(len(matches), 1)
+        self.assertTrue(matches[0]['match'])
+
+    def test_verify_and_bulk_enroll(self):
+        self.create_user()
+        items = [{'otp': '123456', 'image': base64.b64encode(b'0.5').decode()}, {'otp': '000000', 'image': base64.b64encode(b'0.5').decode()}]
+        body = self.client.post('/api/verify', json={'items': items}).json()
+        self.assertEqual(body['matched'], 1)
+        self.assertEqual(body['results'][1]['error'], 'User not found')
+
+        response = self.client.post('/api/users/bulk', files=[('images', ('Mario_Rossi.jpg', b'0.1', 'image/jpeg'))])
+        self.assertEqual(response.json()['created'], 1)
+        self.assertEqual(response.json()['items'][0]['name'], 'Mario Rossi')
+
+    def test_verify_batch_too_large(self):
+        items = [{'otp': '123456', 'image': base64.b64encode(b'0.5').decode()}] * 257
+        self.assertEqual(self.client.post('/api/verify', json={'items': items}).status_code, 413)
+
+    def test_directory_enrollment_disabled(self):
+        with patch('enrollment.ENROLL_ROOT', None):
+            self.assertEqual(self.client.post('/api/users/bulk', json={'directory': 'people'}).status_code, 403)
+
+    def test_ready_after_initialize(self):
+        self.patch('startup._state', {'database': 'pending', 'warmup': 'disabled', 'steps': {}})
+        self.patch('metrics.start_resource_sampler')
+        self.assertEqual(self.client.get('/ready').status_code, 503)
+
+        startup.initialize(self.db_file, warmup=False)
+        response = self.client.get('/ready')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['database'], 'done')
+
+    def test_metrics(self):
+        self.assertIn('devisu_stage_duration_seconds', self.client.get('/metrics').text)
+
+class TestEmbedWorkers(unittest.TestCase):
+
+    @patch('os.cpu_count', return_value=8)
+    def test_workers_share_the_cpus(self, _):
+        environ = {}
+        serve.share_embed_workers(4, environ)
+        self.assertEqual(environ, {'DEVISU_EMBED_WORKERS': '2'})
+
+        environ = {}
+        serve.share_embed_workers(16, environ)
+        self.assertEqual(environ, {'DEVISU_EMBED_WORKERS': '1'})
+
+    def test_explicit_setting_and_single_worker_are_kept(self):
+        environ = {'DEVISU_EMBED_WORKERS': '3'}
+        serve.share_embed_workers(4, environ)
+        self.assertEqual(environ, {'DEVISU_EMBED_WORKERS': '3'})
+
+        environ = {}
+        serve.share_embed_workers(1, environ)
+        self.assertEqual(environ, {})
+
+class TestKioskDispatcher(unittest.TestCase):
+
+    def test_routes_by_prefix(self):
+        calls = []
+
+        def recorder(name):
+            async def asgi(scope, receive, send):
+                calls.append((name, scope['type']))
+            return asgi
+
+        dispatcher = serve.KioskDispatcher(recorder('api'), recorder('kiosk'))
+        for scope in ({'type': 'http', 'path': '/api/users'}, {'type': 'http', 'path': '/apiary'}, {'type': 'http', 'path': '/'}, {'type': 'lifespan'}):
+            asyncio.run(dispatcher(scope, None, None))
+        self.assertEqual(calls, [('api', 'http'), ('kiosk', 'http'), ('kiosk', 'http'), ('kiosk', 'lifespan')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+import startup
+from app import app
+
+class TestStartup(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_state = startup.status()
+
+    def tearDown(self):
+        startup.set_state('database', self.saved_state['database'])
+        startup.set_state('warmup', self.saved_state['warmup'])
+        startup.set_state('steps', self.saved_state['steps'])
+
+    def test_import_is_lazy(self):
+        code = 'import sys, app; print(" ".join(m for m in ("face_recognition", "dlib", "psutil") if m in sys.modules))'
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(output.returncode, 0, output.stderr)
+        self.assertEqual(output.stdout.strip(), '')
+
+    def test_warm_up_records_each_step(self):
+        def broken():
+            raise RuntimeError('no models')
+
+        startup.warm_up([('first', lambda: None), ('second', broken)])
+        state = startup.status()
+        self.assertEqual(state['warmup'], 'failed')
+        self.assertEqual(state['steps']['first']['status'], 'done')
+        self.assertEqual(state['steps']['second']['error'], 'no models')
+
+    def test_initialize_sets_up_database(self):
+        with tempfile.TemporaryDirectory() as temp_dir, patch('metrics.start_resource_sampler'):
+            db_file = os.path.join(temp_dir, 'users.db')
+            startup.initialize(db_file, warmup=False)
+            self.assertTrue(os.path.exists(db_file))
+        self.assertTrue(startup.is_ready())
+
+    def test_ready_endpoint(self):
+        client = app.test_client()
+        startup.set_state('database', 'done')
+        startup.set_state('warmup', 'running')
+        self.assertEqual(client.get('/ready').status_code, 503)
+        startup.set_state('warmup', 'done')
+        response = client.get('/ready')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['database'], 'done')
+
+    def test_failed_warm_up_is_not_ready(self):
+        def broken():
+            raise RuntimeError('no models')
+
+        startup.set_state('database', 'done')
+        startup.warm_up([('face_models', broken)])
+        response = app.test_client().get('/ready')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['failed'], ['face_models'])
+        self.assertEqual(response.json()['steps']['face_models']['error'], 'no models')
+
+    def test_server_start_runs_initialize(self):
+        with patch('startup.initialize') as mock_initialize:
+            with app.test_client():
+                pass
+        mock_initialize.assert_called_once()
+
+if __name__ == '__main__':
+    unittest.main()
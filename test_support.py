@@ -0,0 +1,31 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+import database
+
+# Each test runs against its own temporary database, which the services use too
+class DatabaseTestCase(unittest.TestCase):
+
+    setup_schema = True
+
+    def setUp(self):
+        fd, self.db_file = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(self.remove_database)
+        if self.setup_schema:
+            database.setup_database(self.db_file)
+        self.patch('services.DATABASE', self.db_file)
+
+    # Patches are undone when the test ends, before the database is removed
+    def patch(self, target, *args, **kwargs):
+        patcher = patch(target, *args, **kwargs)
+        mock = patcher.start()
+        self.addCleanup(patcher.stop)
+        return mock
+
+    def remove_database(self):
+        database.close_connections()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.db_file + suffix):
+                os.remove(self.db_file + suffix)
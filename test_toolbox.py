@@ -0,0 +1,50 @@
+import unittest
+from unittest.mock import patch
+from toolbox import generate_otp, generate_unique_otp, ExpiringStore
+
+class TestToolbox(unittest.TestCase):
+
+    def test_generate_otp_six_digits(self):
+        otp = generate_otp()
+        self.assertTrue(100000 <= otp <= 999999)
+
+    @patch('toolbox.generate_otp', side_effect=[111111, 222222, 333333])
+    def test_generate_unique_otp_retries_on_collision(self, mock_generate_otp):
+        used = {'111111', '222222'}
+        otp = generate_unique_otp(lambda otp: otp in used)
+        self.assertEqual(otp, 333333)
+        self.assertEqual(mock_generate_otp.call_count, 3)
+
+    def test_generate_unique_otp_gives_up(self):
+        with self.assertRaises(RuntimeError):
+            generate_unique_otp(lambda otp: True, max_attempts=3)
+
+class TestExpiringStore(unittest.TestCase):
+
+    def test_put_get_pop(self):
+        store = ExpiringStore()
+        store.put('a', 1)
+        self.assertEqual(store.get('a'), 1)
+        self.assertEqual(store.pop('a'), 1)
+        self.assertIsNone(store.get('a'))
+
+    def test_evicts_oldest_when_full(self):
+        store = ExpiringStore(max_entries=2)
+        store.put('a', 1)
+        store.put('b', 2)
+        store.put('c', 3)
+        self.assertIsNone(store.get('a'))
+        self.assertEqual(len(store), 2)
+
+    @patch('toolbox.time.monotonic')
+    def test_entries_expire(self, mock_monotonic):
+        mock_monotonic.return_value = 100.0
+        store = ExpiringStore(ttl=10)
+        store.put('a', 1)
+        mock_monotonic.return_value = 109.0
+        self.assertEqual(store.get('a'), 1)
+        mock_monotonic.return_value = 111.0
+        self.assertIsNone(store.get('a'))
+
+if __name__ == '__main__':
+    unittest.main()
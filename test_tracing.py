@@ -0,0 +1,85 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+import tracing
+from app import app
+from metrics import timed
+from test_support import DatabaseTestCase
+from tracing import span
+
+@patch('tracing.TRACING_ENABLED', True)
+class TestTracing(unittest.TestCase):
+
+    def test_spans_are_collected_on_the_current_trace(self):
+        trace = tracing.start_trace('unit')
+        with span('frame_read', camera='default'):
+            pass
+        with timed('db'):
+            pass
+        with self.assertLogs('devisu.trace', level='INFO') as logs:
+            tracing.finish_trace(status=200)
+
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['trace_id'], trace.trace_id)
+        self.assertEqual(record['status'], 200)
+        self.assertEqual([s['name'] for s in record['spans']], ['frame_read', 'db'])
+        self.assertEqual(record['spans'][0]['camera'], 'default')
+
+    def test_spans_after_finish_are_dropped(self):
+        trace = tracing.start_trace('unit')
+        with self.assertLogs('devisu.trace', level='INFO'):
+            tracing.finish_trace()
+        with span('late'):
+            pass
+        self.assertEqual(trace.spans, [])
+        self.assertEqual(trace.dropped, 1)
+
+    def test_span_count_is_bounded(self):
+        trace = tracing.start_trace('unit')
+        for _ in range(tracing.MAX_SPANS + 5):
+            with span('frame_read'):
+                pass
+        self.assertEqual(len(trace.spans), tracing.MAX_SPANS)
+        self.assertEqual(trace.dropped, 5)
+        trace.finished = True
+
+class TestRequestTracing(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.patch('tracing.TRACING_ENABLED', True)
+        self.addCleanup(tracing.profiler.configure, False, 0.0, False)
+        self.client = app.test_client()
+
+    def test_request_is_logged_with_its_spans(self):
+        with self.assertLogs('devisu.trace', level='INFO') as logs:
+            self.client.get('/api/users/count')
+        record = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(record['path'], '/api/users/count')
+        self.assertEqual(record['status'], 200)
+        self.assertIn('db', [s['name'] for s in record['spans']])
+
+    def test_admin_profiling_requires_token(self):
+        with patch.dict(os.environ, {'DEVISU_ADMIN_TOKEN': 'secret'}):
+            self.assertEqual(self.client.get('/admin/profiling').status_code, 403)
+            self.assertEqual(self.client.get('/admin/profiling', headers={'X-Admin-Token': 'wrong'}).status_code, 403)
+        with patch.dict(os.environ, {}, clear=True):
+            self.assertEqual(self.client.get('/admin/profiling', headers={'X-Admin-Token': ''}).status_code, 403)
+
+    def test_sampled_requests_are_profiled(self):
+        headers = {'X-Admin-Token': 'secret'}
+        with tempfile.TemporaryDirectory() as profile_dir, patch.dict(os.environ, {'DEVISU_ADMIN_TOKEN': 'secret'}), patch.object(tracing.profiler, 'directory', profile_dir):
+            response = self.client.post('/admin/profiling', json={'enabled': True, 'sample_rate': 1.0, 'memory': True}, headers=headers)
+            self.assertEqual(response.json()['sample_rate'], 1.0)
+            self.client.get('/api/users/count')
+            files = sorted(os.listdir(profile_dir))
+
+            self.assertEqual(self.client.post('/admin/profiling', json={'enabled': True, 'sample_rate': 2}, headers=headers).status_code, 400)
+
+        self.assertTrue(any(name.endswith('.prof') for name in files))
+        self.assertTrue(any(name.endswith('.mem.txt') for name in files))
+
+if __name__ == '__main__':
+    unittest.main()
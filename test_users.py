@@ -0,0 +1,79 @@
+import unittest
+import numpy as np
+import database
+from app import app
+from hf_vectorizer import base64_encoder
+from test_support import DatabaseTestCase
+
+class TestUsersAPI(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = app.test_client()
+
+    def create_user(self, otp, name='John Doe'):
+        user = {'id': 0, 'name': name, 'otp': otp, 'vector': base64_encoder(np.random.rand(128))}
+        return self.client.post('/api/users', json=user)
+
+    def test_create_and_read_by_otp(self):
+        response = self.create_user('123456')
+        self.assertEqual(response.status_code, 201)
+        response = self.client.get('/api/users/by_otp/123456')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['name'], 'John Doe')
+
+    def test_create_duplicate_otp_conflict(self):
+        self.assertEqual(self.create_user('123456').status_code, 201)
+        self.assertEqual(self.create_user('123456', name='Jane Doe').status_code, 409)
+
+    def test_otp_exists(self):
+        self.create_user('123456')
+        self.assertEqual(self.client.get('/api/users/by_otp/123456/exists').json(), {'exists': True})
+        self.assertEqual(self.client.get('/api/users/by_otp/654321/exists').json(), {'exists': False})
+
+    def test_update_and_delete(self):
+        user_id = self.create_user('123456').json()['id']
+        user = {'id': user_id, 'name': 'Jane Doe', 'otp': '654321', 'vector': base64_encoder(np.random.rand(128))}
+        self.assertEqual(self.client.put(f'/api/users/{user_id}', json=user).status_code, 200)
+        self.assertEqual(self.client.get(f'/api/users/{user_id}').json()['name'], 'Jane Doe')
+        self.assertEqual(self.client.delete(f'/api/users/{user_id}').status_code, 200)
+        self.assertEqual(self.client.delete(f'/api/users/{user_id}').status_code, 404)
+
+    def test_update_without_name_is_invalid(self):
+        user_id = self.create_user('123456').json()['id']
+        user = {'id': user_id, 'otp': '654321', 'vector': base64_encoder(np.random.rand(128))}
+        response = self.client.put(f'/api/users/{user_id}', json=user)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('NOT NULL', response.json()['detail'])
+
+    def test_read_all_paginates_by_cursor(self):
+        for otp in ('111111', '222222', '333333'):
+            self.create_user(otp)
+
+        response = self.client.get('/api/users?limit=2')
+        self.assertEqual([user['otp'] for user in response.json()], ['111111', '222222'])
+        cursor = response.headers['X-Next-Cursor']
+
+        response = self.client.get(f'/api/users?limit=2&after={cursor}')
+        self.assertEqual([user['otp'] for user in response.json()], ['333333'])
+        self.assertNotIn('X-Next-Cursor', response.headers)
+
+    def test_read_all_projects_fields(self):
+        self.create_user('123456')
+        self.assertEqual(self.client.get('/api/users?fields=name').json(), [{'name': 'John Doe'}])
+        self.assertEqual(self.client.get('/api/users?fields=id,vector2').status_code, 400)
+
+    def test_count_and_exists(self):
+        self.assertEqual(self.client.get('/api/users/exists').json(), {'exists': False})
+        self.create_user('123456')
+        self.create_user('654321')
+        self.assertEqual(self.client.get('/api/users/count').json(), {'count': 2})
+        self.assertEqual(self.client.get('/api/users/exists').json(), {'exists': True})
+
+    def test_otp_lookup_uses_index(self):
+        conn = database.get_connection(self.db_file)
+        plan = conn.execute("EXPLAIN QUERY PLAN SELECT * FROM users WHERE otp = ?", ('123456',)).fetchall()
+        self.assertIn('idx_users_otp', ' '.join(row[3] for row in plan))
+
+if __name__ == '__main__':
+    unittest.main()
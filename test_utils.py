@@ -1,29 +1,117 @@
+import threading
+import time
 import unittest
 from unittest.mock import patch, MagicMock
-from app import release_camera, initialize_camera, delete_all_images, reset_captured_image_path, get_user_by_otp, delete_user_by_otp
+import numpy as np
+from app import flask_app, cameras, release_camera, initialize_camera, generate, generate_capture_events
+from cameraUtils import CameraRegistry
+import sessions
 
 class TestUtilsFunctions(unittest.TestCase):
 
-    @patch('app.camera')
-    def test_release_camera(self, mock_camera):
+    def setUp(self):
+        self.context = flask_app.test_request_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+        cameras.release_all()
+
+    @patch('cameraUtils.VideoCamera')
+    def test_release_camera(self, mock_video_camera):
+        initialize_camera()
         release_camera()
-        mock_camera.camera.release.assert_called_once()
+        mock_video_camera.return_value.release_camera.assert_called_once()
+        self.assertEqual(cameras.cameras, {})
 
-    @patch('app.VideoCamera')
+    @patch('cameraUtils.VideoCamera')
     def test_initialize_camera_success(self, mock_video_camera):
         mock_instance = MagicMock()
         mock_video_camera.return_value = mock_instance
         mock_instance.camera_status = "Success"
         result = initialize_camera()
-        self.assertEqual(result, "(app.initialize_camera)Camera initialized successfully.")
+        self.assertEqual(result, "Camera initialized successfully.")
 
-    @patch('app.VideoCamera')
+    @patch('cameraUtils.VideoCamera')
     def test_initialize_camera_error(self, mock_video_camera):
         mock_instance = MagicMock()
         mock_video_camera.return_value = mock_instance
         mock_instance.camera_status = "Error"
         result = initialize_camera()
-        self.assertEqual(result, "(app.initialize_camera)Error: Failed to open the camera.")
+        self.assertEqual(result, "Error: Failed to open the camera.")
+
+    @patch('cameraUtils.VideoCamera')
+    def test_camera_registry_one_camera_per_device(self, mock_video_camera):
+        mock_video_camera.side_effect = lambda source: MagicMock(source=source)
+        registry = CameraRegistry({'kiosk1': 0, 'kiosk2': 'clip.mp4'})
+        self.assertIs(registry.get('kiosk1'), registry.get('kiosk1'))
+        self.assertEqual(registry.get('kiosk2').source, 'clip.mp4')
+        with self.assertRaises(KeyError):
+            registry.get('kiosk3')
+
+    @patch('app.STREAM_MAX_FPS', 1000)
+    def test_generate_streams_until_captured(self):
+        mock_camera = MagicMock()
+        frames = [np.zeros((48, 64, 3), dtype=np.uint8), np.full((48, 64, 3), 255, dtype=np.uint8), "captured"]
+        mock_camera.read_frame.side_effect = frames
+        state = {"capture_status": "not_captured"}
+
+        parts = list(generate(mock_camera, state, 'session-id'))
+        self.assertEqual(len(parts), 2)
+        self.assertTrue(all(part.startswith(b"--frame") for part in parts))
+        self.assertEqual(state["capture_status"], "captured")
+        mock_camera.read_frame.assert_called_with('session-id')
+
+    def test_capture_event_is_pushed_when_captured(self):
+        state = {"capture_status": "not_captured"}
+        events = generate_capture_events(state, heartbeat=5)
+        self.assertTrue(next(events).startswith("retry:"))
+
+        threading.Timer(0.05, sessions.mark_captured, args=(state,)).start()
+        start = time.monotonic()
+        self.assertEqual(next(events), "event: capture\ndata: captured\n\n")
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(list(events), [])
+
+    def test_capture_events_send_keepalives_until_deadline(self):
+        state = {"capture_status": "not_captured"}
+        events = list(generate_capture_events(state, heartbeat=0.02, max_duration=0.1))
+        self.assertGreaterEqual(events.count(": keepalive\n\n"), 2)
+        self.assertNotIn("event: capture\ndata: captured\n\n", events)
+
+    def test_check_capture_status_long_poll(self):
+        client = flask_app.test_client()
+        self.assertEqual(client.get('/check_capture_status').text, 'not_captured')
+        with client.session_transaction() as session:
+            session_id = session["sid"]
+
+        threading.Timer(0.05, lambda: sessions.mark_captured(sessions.session_store.get(session_id))).start()
+        self.assertEqual(client.get('/check_capture_status?wait=2').text, 'captured')
+
+    @patch('app.capture_waiters', new_callable=lambda: threading.BoundedSemaphore(1))
+    def test_capture_waits_are_capped(self, capture_waiters):
+        client = flask_app.test_client()
+        capture_waiters.acquire()
+        response = client.get('/capture_events')
+        self.assertEqual(response.status_code, 503)
+
+        start = time.monotonic()
+        self.assertEqual(client.get('/check_capture_status?wait=2').text, 'not_captured')
+        self.assertLess(time.monotonic() - start, 1)
+        capture_waiters.release()
+
+    @patch('app.capture_waiters', new_callable=lambda: threading.BoundedSemaphore(1))
+    def test_capture_event_stream_frees_its_slot(self, capture_waiters):
+        client = flask_app.test_client()
+        client.get('/check_capture_status')
+        with client.session_transaction() as session:
+            sessions.mark_captured(sessions.session_store.get(session["sid"]))
+
+        response = client.get('/capture_events')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('event: capture', response.text)
+        response.close()
+        self.assertTrue(capture_waiters.acquire(blocking=False))
 
     # @patch('os.listdir', return_value=['image1.jpg', 'image2.jpg', 'file.txt'])
     # @patch('os.remove')
@@ -0,0 +1,74 @@
+import base64
+import unittest
+import numpy as np
+from unittest.mock import patch
+import services
+from app import app
+from embedding_pool import EmbeddingPool
+from hf_vectorizer import compare_vector_pairs, compare_vectors
+from test_support import DatabaseTestCase
+
+def fake_embed(data, face_location=None):
+    if data == b'no face':
+        return None
+    return np.full(128, float(data.decode()))
+
+def encode(data):
+    return base64.b64encode(data).decode()
+
+class TestBatchVerification(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.patch('embedding_pool._pool', EmbeddingPool(workers=0, max_pending=2))
+        self.patch('embedding_pool.embed_encoded', side_effect=fake_embed)
+        self.client = app.test_client()
+        self.user = services.create_user('Mario Rossi', '123456', np.full(128, 0.5))
+
+    def test_compare_vector_pairs_agrees_with_compare_vectors(self):
+        db_vectors = np.random.rand(20, 128)
+        camera_vectors = db_vectors + np.random.rand(20, 128) * 0.08
+        distances, matches = compare_vector_pairs(db_vectors, camera_vectors)
+        self.assertTrue(np.allclose(distances, np.linalg.norm(db_vectors - camera_vectors, axis=1)))
+        self.assertEqual(matches.tolist(), [bool(compare_vectors(a, b)) for a, b in zip(db_vectors, camera_vectors)])
+
+    def test_verify_batch(self):
+        items = [
+            {'otp': '123456', 'image': encode(b'0.5')},
+            {'user_id': self.user['id'], 'image': encode(b'0.6')},
+            {'otp': '000000', 'image': encode(b'0.5')},
+            {'otp': '123456', 'image': encode(b'no face')},
+            {'otp': '123456', 'image': 'not base64!'},
+        ]
+        response = self.client.post('/api/verify', json={'items': items})
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        results = body['results']
+
+        self.assertEqual(body['matched'], 1)
+        self.assertEqual(results[0]['user_id'], self.user['id'])
+        self.assertTrue(results[0]['match'])
+        self.assertAlmostEqual(results[0]['distance'], 0.0)
+        self.assertFalse(results[1]['match'])
+        self.assertAlmostEqual(results[1]['distance'], np.sqrt(128) * 0.1, places=4)
+        self.assertEqual(results[2]['error'], 'User not found')
+        self.assertEqual(results[3]['error'], 'No face detected')
+        self.assertEqual(results[4]['error'], 'Invalid image data')
+
+    def test_verify_batch_requires_one_user_key(self):
+        response = self.client.post('/api/verify', json={'items': [{'image': encode(b'0.5')}]})
+        self.assertEqual(response.status_code, 400)
+
+    def test_verify_batch_too_large(self):
+        items = [{'otp': '123456', 'image': encode(b'0.5')}] * 257
+        response = self.client.post('/api/verify', json={'items': items})
+        self.assertEqual(response.status_code, 413)
+
+    def test_get_users_by_otps(self):
+        services.create_user('Anna Bianchi', '654321', np.zeros(128))
+        users = services.get_users_by_otps(['654321', '123456', '000000'])
+        self.assertEqual(sorted(users), ['123456', '654321'])
+        self.assertEqual(users['654321']['name'], 'Anna Bianchi')
+
+if __name__ == '__main__':
+    unittest.main()
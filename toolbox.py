@@ -17,6 +17,69 @@
 """
 
 import random
+import threading
+import time
+
+from collections import OrderedDict
 
 def generate_otp():
     return random.randint(100000, 999999)
+
+# Draw OTPs until one is not already in use, as reported by the otp_exists callback
+def generate_unique_otp(otp_exists, max_attempts=20):
+    for _ in range(max_attempts):
+        otp = generate_otp()
+        if not otp_exists(str(otp)):
+            return otp
+    raise RuntimeError(f"Could not generate an unused OTP after {max_attempts} attempts")
+
+# Thread-safe key/value store bounded both in size (oldest entries are evicted first) and in age
+class ExpiringStore:
+    def __init__(self, max_entries=32, ttl=60.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _purge(self, now):
+        while self._entries:
+            key, (expires_at, _) = next(iter(self._entries.items()))
+            if expires_at > now:
+                break
+            del self._entries[key]
+
+    def put(self, key, value):
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            self._entries.pop(key, None)
+            self._entries[key] = (now + self.ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            entry = self._entries.get(key)
+            return entry[1] if entry is not None else default
+
+    def pop(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            entry = self._entries.pop(key, None)
+            return entry[1] if entry is not None else default
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            self._purge(time.monotonic())
+            return len(self._entries)
@@ -0,0 +1,224 @@
+"""
+* tracing.py
+*
+* Copyright 2024, Filippini Giovanni
+*
+* Licensed under the Apache License, Version 2.0 (the "License");
+* you may not use this file except in compliance with the License.
+* You may obtain a copy of the License at
+*
+*         https://www.apache.org/licenses/LICENSE-2.0.txt
+*
+* Unless required by applicable law or agreed to in writing, software
+* distributed under the License is distributed on an "AS IS" BASIS,
+* WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+* See the License for the specific language governing permissions and
+* limitations under the License.
+"""
+
+# Per-request tracing: the hot stages open spans, which are collected on the trace of the current
+# request and logged as one JSON line when the request ends. Spans opened outside of a request are
+# not recorded. Jobs sent to the embedding worker processes by a traced request collect their spans
+# in the worker and bring them back with their result (run_traced / remote_result).
+#
+# A sampled fraction of requests can also be profiled with cProfile and tracemalloc, the profiles
+# are written to DEVISU_PROFILE_DIR. Profiling is switched on and off at runtime through /admin/profiling.
+
+import contextvars
+import cProfile
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+
+# Off by default: one log line per request floods the server logs and the benchmarks
+TRACING_ENABLED = os.environ.get("DEVISU_TRACING", "0") == "1"
+MAX_SPANS = 200
+PROFILE_DIR = os.environ.get("DEVISU_PROFILE_DIR", "profiles")
+TRACEMALLOC_TOP = 50
+
+logger = logging.getLogger("devisu.trace")
+if not logger.handlers:
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+_current_trace = contextvars.ContextVar("devisu_trace", default=None)
+
+class Trace:
+    def __init__(self, name, **attributes):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attributes = attributes
+        self.start = time.perf_counter()
+        self.spans = []
+        self.dropped = 0
+        self.finished = False
+
+    def add_span(self, name, start, duration, attributes):
+        # Long lived requests, like the video stream, would otherwise grow their trace forever
+        if self.finished or len(self.spans) >= MAX_SPANS:
+            self.dropped += 1
+            return
+        span = {"name": name, "start_ms": round((start - self.start) * 1000, 3), "duration_ms": round(duration * 1000, 3)}
+        if attributes:
+            span.update(attributes)
+        self.spans.append(span)
+
+    def to_dict(self):
+        record = {"trace_id": self.trace_id, "name": self.name, "duration_ms": round((time.perf_counter() - self.start) * 1000, 3)}
+        record.update(self.attributes)
+        record["spans"] = self.spans
+        if self.dropped:
+            record["dropped_spans"] = self.dropped
+        return record
+
+def current_trace():
+    return _current_trace.get()
+
+def start_trace(name, **attributes):
+    if not TRACING_ENABLED:
+        return None
+    trace = Trace(name, **attributes)
+    _current_trace.set(trace)
+    return trace
+
+def finish_trace(**attributes):
+    trace = _current_trace.get()
+    if trace is None or trace.finished:
+        return None
+    trace.attributes.update(attributes)
+    trace.finished = True
+    logger.info(json.dumps(trace.to_dict(), default=str))
+    return trace
+
+def record_span(name, start, duration, **attributes):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_span(name, start, duration, attributes)
+
+class span:
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        record_span(self.name, self.start, time.perf_counter() - self.start, **self.attributes)
+        return False
+
+# Result of a job run in another process, with the spans it recorded there
+class TracedResult:
+    def __init__(self, value, spans, duration):
+        self.value = value
+        self.spans = spans
+        self.duration = duration
+
+# Run in the worker process: the job gets a trace of its own, whatever tracing says there
+def run_traced(fn, *args):
+    trace = Trace(getattr(fn, "__name__", "job"))
+    token = _current_trace.set(trace)
+    try:
+        value = fn(*args)
+    finally:
+        _current_trace.reset(token)
+    return TracedResult(value, trace.spans, time.perf_counter() - trace.start)
+
+# The value of a job, whose worker spans are added to the trace of the caller when record is set.
+# The clocks of two processes cannot be compared, so the job is placed to end when its result arrived.
+def remote_result(result, record=True):
+    if not isinstance(result, TracedResult):
+        return result
+
+    trace = _current_trace.get()
+    if record and trace is not None:
+        start = time.perf_counter() - result.duration
+        for remote in result.spans:
+            attributes = {key: value for key, value in remote.items() if key not in ("name", "start_ms", "duration_ms")}
+            attributes["process"] = "worker"
+            trace.add_span(remote["name"], start + remote["start_ms"] / 1000, remote["duration_ms"] / 1000, attributes)
+    return result.value
+
+# On-demand profiling of a sample of the requests. Both profilers are process wide,
+# so at most one request is profiled at a time and the others are simply not sampled.
+class ProfilingSampler:
+    def __init__(self, directory=PROFILE_DIR):
+        self.directory = directory
+        self.enabled = False
+        self.sample_rate = 0.0
+        self.memory = False
+        self.lock = threading.Lock()
+        self.saved = 0
+
+    def configure(self, enabled, sample_rate=None, memory=None, directory=None):
+        self.enabled = bool(enabled)
+        if sample_rate is not None:
+            if not 0 <= sample_rate <= 1:
+                raise ValueError("sample_rate must be between 0 and 1")
+            self.sample_rate = float(sample_rate)
+        if memory is not None:
+            self.memory = bool(memory)
+        if directory:
+            self.directory = directory
+
+    def status(self):
+        return {"enabled": self.enabled, "sample_rate": self.sample_rate, "memory": self.memory, "directory": self.directory, "saved": self.saved}
+
+    # Returns a started profile, or None when this request is not sampled
+    def maybe_start(self, name):
+        if not self.enabled or random.random() >= self.sample_rate:
+            return None
+        if not self.lock.acquire(blocking=False):
+            return None
+
+        profile = {"name": name, "profiler": cProfile.Profile(), "memory": self.memory and not tracemalloc.is_tracing()}
+        if profile["memory"]:
+            tracemalloc.start()
+        try:
+            profile["profiler"].enable()
+        except ValueError:
+            # Another profiler is already active on this thread
+            if profile["memory"]:
+                tracemalloc.stop()
+            self.lock.release()
+            return None
+        return profile
+
+    def stop(self, profile):
+        try:
+            profile["profiler"].disable()
+            snapshot = tracemalloc.take_snapshot() if profile["memory"] else None
+            if profile["memory"]:
+                tracemalloc.stop()
+
+            os.makedirs(self.directory, exist_ok=True)
+            trace = current_trace()
+            label = re.sub(r"[^A-Za-z0-9_.-]+", "_", profile["name"]).strip("_") or "request"
+            base = os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{trace.trace_id if trace else uuid.uuid4().hex[:16]}-{label}")
+
+            paths = [base + ".prof"]
+            profile["profiler"].dump_stats(paths[0])
+            if snapshot is not None:
+                paths.append(base + ".mem.txt")
+                with open(paths[1], "w") as f:
+                    for stat in snapshot.statistics("lineno")[:TRACEMALLOC_TOP]:
+                        f.write(f"{stat}\n")
+            self.saved += 1
+            return paths
+        finally:
+            self.lock.release()
+
+profiler = ProfilingSampler()
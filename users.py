@@ -17,21 +17,43 @@
 """
 
 from flask import abort, make_response, request
-import sqlite3
-from database import create_connection
+from hf_vectorizer import base64_encoder, base64_decoder
 
-DATABASE = "users.db"
+import numpy as np
+import services
 
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
+# The API exchanges vectors as base64 float64, the services work with NumPy arrays
+def vector_from_json(vector):
+    try:
+        return base64_decoder(vector)
+    except (TypeError, ValueError) as e:
+        abort(400, f"Invalid vector: {e}")
 
-def read_all():
-    conn = get_db_connection()
-    users = conn.execute("SELECT * FROM users").fetchall()
-    conn.close()
-    return [dict(row) for row in users]
+DEFAULT_PAGE_SIZE = 100
+
+def user_to_json(user):
+    user = dict(user)
+    if "vector" in user:
+        user["vector"] = base64_encoder(np.asarray(user["vector"], dtype=np.float64))
+    return user
+
+def read_all(limit=DEFAULT_PAGE_SIZE, after=0, fields=None):
+    fields = [field.strip() for field in fields.split(",") if field.strip()] if fields else services.USER_FIELDS
+
+    try:
+        users, next_after = services.list_users_page(limit, after, fields)
+    except ValueError as e:
+        abort(400, str(e))
+
+    # The cursor of the next page travels in a header so the body stays a plain list of users
+    headers = {"X-Next-Cursor": str(next_after)} if next_after is not None else {}
+    return [user_to_json(user) for user in users], 200, headers
+
+def count():
+    return {"count": services.count_users()}
+
+def exists():
+    return {"exists": services.has_users()}
 
 def create():
     user = request.get_json()
@@ -42,23 +64,22 @@ def create():
     if not name or not otp or not vector:
         abort(400, "Invalid input")
     
-    conn = get_db_connection()
-    conn.execute("INSERT INTO users (name, otp, vector) VALUES (?, ?, ?)", (name, otp, vector))
-    conn.commit()
-    user_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
-    conn.close()
+    try:
+        created_user = services.create_user(name, otp, vector_from_json(vector))
+    except services.OtpInUseError as e:
+        abort(409, str(e))
+    except services.InvalidUserError as e:
+        abort(400, str(e))
     
-    return {"id": user_id, "name": name, "otp": otp, "vector": vector}, 201
+    return {"id": created_user["id"], "name": name, "otp": otp, "vector": vector}, 201
 
 def read_one(userId):
-    conn = get_db_connection()
-    user = conn.execute("SELECT * FROM users WHERE id = ?", (userId,)).fetchone()
-    conn.close()
+    user = services.get_user(userId)
     
     if user is None:
         abort(404, f"User with id {userId} not found")
     
-    return dict(user)
+    return user_to_json(user)
 
 def update(userId):
     user = request.get_json()
@@ -66,39 +87,31 @@ def update(userId):
     otp = user.get("otp")
     vector = user.get("vector")
     
-    conn = get_db_connection()
-    existing_user = conn.execute("SELECT * FROM users WHERE id = ?", (userId,)).fetchone()
+    try:
+        updated_user = services.update_user(userId, name, otp, vector_from_json(vector))
+    except services.OtpInUseError as e:
+        abort(409, str(e))
+    except services.InvalidUserError as e:
+        abort(400, str(e))
     
-    if existing_user is None:
-        conn.close()
+    if updated_user is None:
         abort(404, f"User with id {userId} not found")
     
-    conn.execute("UPDATE users SET name = ?, otp = ?, vector = ? WHERE id = ?", (name, otp, vector, userId))
-    conn.commit()
-    conn.close()
-    
     return {"id": userId, "name": name, "otp": otp, "vector": vector}
 
 def delete(userId):
-    conn = get_db_connection()
-    existing_user = conn.execute("SELECT * FROM users WHERE id = ?", (userId,)).fetchone()
-    
-    if existing_user is None:
-        conn.close()
+    if not services.delete_user(userId):
         abort(404, f"User with id {userId} not found")
     
-    conn.execute("DELETE FROM users WHERE id = ?", (userId,))
-    conn.commit()
-    conn.close()
-    
     return make_response(f"User with id {userId} successfully deleted", 200)
 
 def read_by_otp(otp):
-    conn = get_db_connection()
-    user = conn.execute("SELECT * FROM users WHERE otp = ?", (otp,)).fetchone()
-    conn.close()
+    user = services.get_user_by_otp(otp)
 
     if user is None:
         abort(404, f"User with OTP {otp} not found")
 
-    return dict(user)
+    return user_to_json(user)
+
+def check_otp(otp):
+    return {"exists": services.otp_exists(otp)}
@@ -0,0 +1,119 @@
+"""
+* verification.py
+*
+* Copyright 2024, Filippini Giovanni
+*
+* Licensed under the Apache License, Version 2.0 (the "License");
+* you may not use this file except in compliance with the License.
+* You may obtain a copy of the License at
+*
+*         https://www.apache.org/licenses/LICENSE-2.0.txt
+*
+* Unless required by applicable law or agreed to in writing, software
+* distributed under the License is distributed on an "AS IS" BASIS,
+* WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+* See the License for the specific language governing permissions and
+* limitations under the License.
+"""
+
+# Image based verification for headless clients (e.g. turnstile controllers): each item pairs a
+# user, by OTP or id, with a base64 encoded photo, and is checked like the camera verify flow does.
+
+import base64
+import binascii
+
+from flask import abort, request
+from hf_vectorizer import compare_vector_pairs
+from metrics import record_failure, record_match
+
+import embedding_pool
+import services
+
+DEFAULT_TOLERANCE = 0.45
+MAX_BATCH_SIZE = 256
+
+def decode_image_data(data):
+    try:
+        return base64.b64decode(data, validate=True)
+    except (binascii.Error, TypeError, ValueError):
+        return None
+
+# Verify (user, encoded image) pairs, where each user is a dict or None when it was not found.
+# Returns one result dict per pair, in order.
+def verify_pairs(pairs, tolerance=DEFAULT_TOLERANCE, pool=None):
+    pool = pool or embedding_pool.get_pool()
+    results = [{} for _ in pairs]
+
+    # Only pairs with a known user and a readable image are sent to the embedding pool
+    pending = []
+    for result, (user, image) in zip(results, pairs):
+        if user is None:
+            result["error"] = "User not found"
+        elif image is None:
+            result["error"] = "Invalid image data"
+        else:
+            pending.append((result, user, image))
+
+    compared = []
+    for (result, user, _), vector in zip(pending, pool.embed_many(image for _, _, image in pending)):
+        if isinstance(vector, Exception):
+            record_failure("embedding")
+            result["error"] = str(vector)
+        elif vector is None:
+            record_failure("embedding")
+            result["error"] = "No face detected"
+        elif len(vector) != len(user["vector"]):
+            result["error"] = "Stored vector has a different size"
+        else:
+            compared.append((result, user["vector"], vector))
+
+    if compared:
+        distances, matches = compare_vector_pairs([c[1] for c in compared], [c[2] for c in compared], tolerance)
+        for (result, _, _), distance, match in zip(compared, distances, matches):
+            result.update(distance=float(distance), match=bool(match))
+            record_match("verify_batch", match)
+
+    for result in results:
+        result.setdefault("match", False)
+    return results
+
+# Check a verification request, returns its items and tolerance
+def parse_batch(body):
+    items = body.get("items")
+    tolerance = body.get("tolerance", DEFAULT_TOLERANCE)
+
+    if not items or not isinstance(items, list):
+        abort(400, "Invalid input")
+    if len(items) > MAX_BATCH_SIZE:
+        abort(413, f"At most {MAX_BATCH_SIZE} items can be verified at once")
+
+    for item in items:
+        if not isinstance(item, dict) or ("otp" in item) == ("user_id" in item) or "image" not in item:
+            abort(400, "Each item needs an image and either an otp or a user_id")
+
+    return items, tolerance
+
+# Look up the users, decode the images and verify them, returns the response of the batch
+def verify_items(items, tolerance=DEFAULT_TOLERANCE):
+    users_by_otp = services.get_users_by_otps(str(item["otp"]) for item in items if "otp" in item)
+    users_by_id = services.get_users_by_ids(item["user_id"] for item in items if "user_id" in item)
+
+    pairs = []
+    for item in items:
+        user = users_by_otp.get(str(item["otp"])) if "otp" in item else users_by_id.get(item["user_id"])
+        pairs.append((user, decode_image_data(item["image"])))
+
+    results = verify_pairs(pairs, tolerance)
+
+    response = []
+    for item, (user, _), result in zip(items, pairs, results):
+        entry = {"otp": str(item["otp"])} if "otp" in item else {"user_id": item["user_id"]}
+        if user is not None:
+            entry["user_id"] = user["id"]
+        entry.update(result)
+        response.append(entry)
+
+    return {"matched": sum(result["match"] for result in results), "results": response}
+
+def verify_batch():
+    return verify_items(*parse_batch(request.get_json()))
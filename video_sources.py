@@ -0,0 +1,182 @@
+"""
+* video_sources.py
+*
+* Copyright 2024, Filippini Giovanni
+*
+* Licensed under the Apache License, Version 2.0 (the "License");
+* you may not use this file except in compliance with the License.
+* You may obtain a copy of the License at
+*
+*         https://www.apache.org/licenses/LICENSE-2.0.txt
+*
+* Unless required by applicable law or agreed to in writing, software
+* distributed under the License is distributed on an "AS IS" BASIS,
+* WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+* See the License for the specific language governing permissions and
+* limitations under the License.
+"""
+
+# Frame sources for VideoCamera, all with the cv2.VideoCapture interface the FrameGrabber reads:
+#   0, 1, ...              a camera device
+#   clip.mp4               a video file, replayed
+#   frames/                a directory of images, replayed in name order
+#   rtsp://... http://...  a network stream
+# Replayed sources run at their own frame rate (DEVISU_REPLAY_PACE=realtime) or as fast as they can be
+# read (DEVISU_REPLAY_PACE=fast), and start over when they end unless DEVISU_REPLAY_LOOP=0.
+#
+# Running this module serves a replayed source as an MJPEG stream, a stand-in for a network camera:
+#   python3 video_sources.py clip.mp4 --port 8081    then use http://localhost:8081/stream.mjpg
+
+import argparse
+import cv2
+import os
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPLAY_PACE = os.environ.get("DEVISU_REPLAY_PACE", "realtime")
+REPLAY_LOOP = os.environ.get("DEVISU_REPLAY_LOOP", "1") != "0"
+REPLAY_FPS = float(os.environ.get("DEVISU_REPLAY_FPS", 30))
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+STREAM_SCHEMES = ("rtsp://", "rtmp://", "http://", "https://", "udp://", "tcp://")
+
+# Reads the images of a directory as the frames of a video
+class ImageDirectoryCapture:
+    def __init__(self, directory):
+        self.directory = directory
+        self.paths = sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.lower().endswith(IMAGE_EXTENSIONS))
+        self.position = 0
+        self.opened = bool(self.paths)
+
+    def isOpened(self):
+        return self.opened
+
+    def read(self):
+        if not self.opened or self.position >= len(self.paths):
+            return False, None
+        frame = cv2.imread(self.paths[self.position])
+        self.position += 1
+        return frame is not None, frame
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FPS:
+            return REPLAY_FPS
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return len(self.paths)
+        if prop in (cv2.CAP_PROP_FRAME_WIDTH, cv2.CAP_PROP_FRAME_HEIGHT) and self.paths:
+            frame = cv2.imread(self.paths[0])
+            if frame is not None:
+                return frame.shape[1] if prop == cv2.CAP_PROP_FRAME_WIDTH else frame.shape[0]
+        return 0
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            self.position = int(value)
+            return True
+        return False
+
+    def getBackendName(self):
+        return "IMAGES"
+
+    def release(self):
+        self.opened = False
+
+# Wraps a recorded source: paces the reads to the recording's frame rate and loops at the end
+class ReplayCapture:
+    def __init__(self, capture, pace=REPLAY_PACE, loop=REPLAY_LOOP):
+        self.capture = capture
+        self.realtime = pace == "realtime"
+        self.loop = loop
+        fps = capture.get(cv2.CAP_PROP_FPS) or REPLAY_FPS
+        self.frame_interval = 1.0 / fps if fps > 0 else 1.0 / REPLAY_FPS
+        self.next_frame_time = None
+
+    def isOpened(self):
+        return self.capture.isOpened()
+
+    def read(self):
+        if self.realtime:
+            now = time.monotonic()
+            if self.next_frame_time is not None and self.next_frame_time > now:
+                time.sleep(self.next_frame_time - now)
+            # Schedule from the previous deadline so the average rate stays exact, unless we fell behind
+            self.next_frame_time = max(self.next_frame_time or now, now - self.frame_interval) + self.frame_interval
+
+        success, frame = self.capture.read()
+        if not success and self.loop:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            success, frame = self.capture.read()
+        return success, frame
+
+    def get(self, prop):
+        return self.capture.get(prop)
+
+    def getBackendName(self):
+        return f"REPLAY({self.capture.getBackendName()})"
+
+    def release(self):
+        self.capture.release()
+
+def is_device(source):
+    return isinstance(source, int) or (isinstance(source, str) and source.isdigit())
+
+def is_stream(source):
+    return isinstance(source, str) and source.lower().startswith(STREAM_SCHEMES)
+
+def open_video_source(source, pace=REPLAY_PACE, loop=REPLAY_LOOP):
+    if is_device(source):
+        return cv2.VideoCapture(int(source))
+    if is_stream(source):
+        return cv2.VideoCapture(source)
+    if os.path.isdir(source):
+        return ReplayCapture(ImageDirectoryCapture(source), pace, loop)
+    return ReplayCapture(cv2.VideoCapture(source), pace, loop)
+
+# Local stand-in for a network camera: streams a source as multipart MJPEG to every client
+class MJPEGStreamHandler(BaseHTTPRequestHandler):
+    source = None
+
+    def do_GET(self):
+        if self.path != "/stream.mjpg":
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=frame")
+        self.end_headers()
+        capture = open_video_source(self.source, "realtime", True)
+        try:
+            while True:
+                success, frame = capture.read()
+                if not success:
+                    break
+                ret, jpeg = cv2.imencode(".jpg", frame)
+                self.wfile.write(b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n" % len(jpeg))
+                self.wfile.write(jpeg.tobytes())
+                self.wfile.write(b"\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            capture.release()
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(source, host="127.0.0.1", port=8081):
+    handler = type("Handler", (MJPEGStreamHandler,), {"source": source})
+    server = ThreadingHTTPServer((host, port), handler)
+    print(f"Streaming {source} on http://{host}:{port}/stream.mjpg")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a video file or image directory as an MJPEG network camera")
+    parser.add_argument("source")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+    serve(args.source, args.host, args.port)